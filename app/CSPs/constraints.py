@@ -0,0 +1,331 @@
+# custom python-constraint constraints shared by the ShiftAssignmentSolver and RegenerateCSP
+from constraint import Constraint, AllDifferentConstraint, Unassigned
+from collections import defaultdict
+import math
+
+
+# finding the largest set of slots that can each get a different user (bipartite matching)
+# candidates maps each slot to the users that could fill it, returns {slot: user}
+def max_matching(candidates):
+    user_slot = {}
+
+    def augment(slot, visited):
+        # trying to give the slot a user, moving other slots onto different users if needed
+        for user in candidates[slot]:
+            if user in visited:
+                continue
+            visited.add(user)
+            if user not in user_slot or augment(user_slot[user], visited):
+                user_slot[user] = slot
+                return True
+        return False
+
+    for slot in candidates:
+        augment(slot, set())
+    return {slot: user for user, slot in user_slot.items()}
+
+
+class DayAllDifferentConstraint(AllDifferentConstraint):
+    # One shift per user per day, as a single constraint over all the slots of a day.
+    # Before the search starts it checks every slot of the day can get its own user
+    # (Hall's condition through a matching), so an impossible day fails straight away.
+    # The domains are left alone, infeasible is set instead so the same problem can be searched
+    # again, TimedBacktrackingSolver stops before searching when it is set and the check below
+    # keeps any other solver correct.
+    infeasible = False
+
+    def preProcess(self, variables, domains, constraints, vconstraints):
+        # python-constraint only resets the domains after preprocessing, so on a repeat search
+        # the values the last search hid are counted back in here
+        candidates = {variable: list(domains[variable]) + list(domains[variable]._hidden) for variable in variables}
+        self.infeasible = len(max_matching(candidates)) < len(variables)
+
+    def __call__(self, variables, domains, assignments, forwardcheck=False, _unassigned=Unassigned):
+        if self.infeasible:
+            return False
+        return super().__call__(variables, domains, assignments, forwardcheck, _unassigned)
+
+
+class IncrementalConstraint(Constraint):
+    # Base for constraints over the shift keys that keep running totals instead of
+    # re-counting the whole assignment on every check. The backtracking solver assigns and
+    # undoes variables in stack order, so the totals follow it by undoing anything it has
+    # backtracked over and adding the newest assignment.
+    # Subclasses fill in _clear, _add, _remove and _check.
+    def __init__(self, variables):
+        self.scope = set(variables)
+        self._covers_all = False
+        self._reset()
+
+    def _reset(self):
+        # (shift key, user) in the order the solver assigned them
+        self._stack = []
+        self._clear()
+
+    def preProcess(self, variables, domains, constraints, vconstraints):
+        # called before every search, so the totals from a previous search are dropped
+        self._reset()
+        # when the constraint covers every variable the fast length check below is valid
+        self._covers_all = len(variables) == len(domains)
+
+    def _push(self, key, user):
+        self._stack.append((key, user))
+        self._add(key, user)
+
+    def _pop(self):
+        key, user = self._stack.pop()
+        self._remove(key, user)
+
+    def _resync(self, assignments):
+        # rebuilding the totals from scratch, only needed if the solver didnt assign in stack order
+        self._reset()
+        for key, user in assignments.items():
+            if key in self.scope:
+                self._push(key, user)
+
+    def __call__(self, variables, domains, assignments, forwardcheck=False):
+        stack = self._stack
+        # undoing anything the solver has backtracked over since the last call
+        while stack and assignments.get(stack[-1][0], Unassigned) != stack[-1][1]:
+            self._pop()
+
+        # the solver assigns one variable at a time, the newest one is the last key added
+        new = None
+        last = next(reversed(assignments), None)
+        if last in self.scope and (not stack or stack[-1][0] != last):
+            new = (last, assignments[last])
+            self._push(*new)
+
+        if not self._covers_all or len(stack) != len(assignments):
+            self._resync(assignments)
+            return self._check(None, domains, assignments, forwardcheck)
+        return self._check(new, domains, assignments, forwardcheck)
+
+    def _clear(self):
+        pass
+
+    def _add(self, key, user):
+        pass
+
+    def _remove(self, key, user):
+        pass
+
+    # new is the (key, user) just added, or None after a full resync
+    def _check(self, new, domains, assignments, forwardcheck):
+        return True
+
+
+# the day limit counts over any run of this many days in a row, so on a horizon of several
+# weeks it carries across the week boundaries instead of starting again every monday
+DAY_LIMIT_WINDOW = 7
+
+
+# every run of DAY_LIMIT_WINDOW days in a row inside the days given, as (first day, last day)
+# a horizon shorter then the window is a single window
+def day_limit_windows(days):
+    if not days:
+        return []
+    first, last = min(days), max(days)
+    return [
+        (start, start + DAY_LIMIT_WINDOW - 1)
+        for start in range(first, max(first, last - DAY_LIMIT_WINDOW + 1) + 1)
+    ]
+
+
+# whether a user already working worked_days can take one more day without going over the limit
+# in any window holding that day
+def under_day_limit(worked_days, day, max_days):
+    for start in range(day - DAY_LIMIT_WINDOW + 1, day + 1):
+        if sum(1 for d in worked_days if start <= d < start + DAY_LIMIT_WINDOW) >= max_days:
+            return False
+    return True
+
+
+class MaxDaysConstraint(IncrementalConstraint):
+    # Limits how many different days each user can work in any DAY_LIMIT_WINDOW days in a row.
+    # Instead of waiting for every shift to be assigned, it keeps a running count of the days
+    # per user as the solver assigns and backtracks, so a branch is cut as soon as a user goes
+    # over the limit. When a user reaches the limit they are removed from the remaining shifts
+    # on their other days (forward checking).
+    # worked maps users to days they already work outside these keys (like last weeks roster),
+    # they count towards the limit from the start
+    # when every day fits in one window (a single week) it is simply a count of the days worked
+    def __init__(self, max_days, day_of, worked=None):
+        self.max_days = max_days
+        # maps each shift key to its day
+        self.day_of = day_of
+        self.worked = worked or {}
+        # shift keys grouped per day, used to hide users from the remaining days
+        self.keys_by_day = defaultdict(list)
+        for key, day in day_of.items():
+            self.keys_by_day[day].append(key)
+        all_days = list(self.keys_by_day) + [day for days in self.worked.values() for day in days]
+        self.rolling = bool(all_days) and max(all_days) - min(all_days) >= DAY_LIMIT_WINDOW
+        super().__init__(day_of)
+
+    def _clear(self):
+        # user -> day -> number of shifts on that day
+        self._user_days = defaultdict(lambda: defaultdict(int))
+        for user, days in self.worked.items():
+            for day in days:
+                self._user_days[user][day] += 1
+
+    def _add(self, key, user):
+        self._user_days[user][self.day_of[key]] += 1
+
+    def _remove(self, key, user):
+        days = self._user_days[user]
+        day = self.day_of[key]
+        days[day] -= 1
+        if not days[day]:
+            del days[day]
+
+    def _hide_user(self, user, domains, assignments, days=None):
+        # removing the user from unassigned shifts on days they are not already working
+        # (or only the days given, on a rolling limit where the other days are still open)
+        worked = self._user_days[user]
+        for day in (self.keys_by_day if days is None else days):
+            if day in worked:
+                continue
+            for key in self.keys_by_day.get(day, []):
+                if key in assignments:
+                    continue
+                domain = domains[key]
+                if user in domain:
+                    domain.hideValue(user)
+                    if not domain:
+                        return False
+        return True
+
+    def _check(self, new, domains, assignments, forwardcheck):
+        if new is None:
+            users = list(self._user_days)
+        else:
+            users = [new[1]]
+
+        for user in users:
+            if self.rolling:
+                if not self._check_rolling(user, new, domains, assignments, forwardcheck):
+                    return False
+                continue
+            worked = len(self._user_days[user])
+            if worked > self.max_days:
+                return False
+            # the user is now at the limit so prune them from the other days
+            if forwardcheck and worked == self.max_days:
+                if not self._hide_user(user, domains, assignments):
+                    return False
+        return True
+
+    def _check_rolling(self, user, new, domains, assignments, forwardcheck):
+        worked = self._user_days[user]
+        # only the windows holding the new day can have changed
+        days = [self.day_of[new[0]]] if new is not None else list(worked)
+        full = False
+        for day in days:
+            for start in range(day - DAY_LIMIT_WINDOW + 1, day + 1):
+                count = sum(1 for d in worked if start <= d < start + DAY_LIMIT_WINDOW)
+                if count > self.max_days:
+                    return False
+                full = full or count == self.max_days
+        if forwardcheck and full:
+            # the days near a full window that would now go over the limit
+            near = {d for day in days for d in range(day - DAY_LIMIT_WINDOW + 1, day + DAY_LIMIT_WINDOW)}
+            blocked = [d for d in near if d in self.keys_by_day and d not in worked and not under_day_limit(worked, d, self.max_days)]
+            if not self._hide_user(user, domains, assignments, blocked):
+                return False
+        return True
+
+
+# share of the slots that must change between two rosters returned from the same solve
+DEFAULT_DIVERSITY = 0.1
+
+
+# how many slots two rosters need to differ in, at least one
+def min_roster_distance(slot_count, min_difference=None):
+    if min_difference is not None:
+        return max(1, min(min_difference, slot_count))
+    return max(1, math.ceil(slot_count * DEFAULT_DIVERSITY))
+
+
+class HammingDistanceConstraint(IncrementalConstraint):
+    # Makes the roster differ from a previous one in at least min_distance slots.
+    # It counts how many slots still match the previous roster as the solver goes, and once
+    # no more matches are allowed the previous user is hidden from every slot left.
+    def __init__(self, previous, min_distance):
+        # previous maps each shift key to the user it had
+        self.previous = previous
+        self.max_matches = len(previous) - min_distance
+        super().__init__(previous)
+
+    def _clear(self):
+        self._matches = 0
+
+    def _add(self, key, user):
+        if self.previous[key] == user:
+            self._matches += 1
+
+    def _remove(self, key, user):
+        if self.previous[key] == user:
+            self._matches -= 1
+
+    def _check(self, new, domains, assignments, forwardcheck):
+        if self._matches > self.max_matches:
+            return False
+        # only prune when this assignment used up the last allowed match
+        just_matched = new is None or self.previous[new[0]] == new[1]
+        if forwardcheck and just_matched and self._matches == self.max_matches:
+            for key, user in self.previous.items():
+                if key in assignments:
+                    continue
+                domain = domains[key]
+                if user in domain:
+                    domain.hideValue(user)
+                    if not domain:
+                        return False
+        return True
+
+
+class MaxChangesConstraint(IncrementalConstraint):
+    # Limits how many slots can differ from an original roster, used to repair a roster while
+    # changing as little as possible. max_changes can be lowered between searches so each new
+    # search has to beat the best repair found so far (None means no limit yet).
+    # Slots not assigned yet whose original user has dropped out of their domain are counted as
+    # changes straight away, and once the limit is reached every other slot left can only keep
+    # its original user.
+    def __init__(self, original, max_changes=None):
+        # original maps each shift key to the user it had (None if it had nobody)
+        self.original = original
+        self.max_changes = max_changes
+        super().__init__(original)
+
+    def _clear(self):
+        self._changes = 0
+
+    def _add(self, key, user):
+        if self.original[key] != user:
+            self._changes += 1
+
+    def _remove(self, key, user):
+        if self.original[key] != user:
+            self._changes -= 1
+
+    def _check(self, new, domains, assignments, forwardcheck):
+        if self.max_changes is None:
+            return True
+        # slots left that have to change whatever user they get
+        open_keys = [key for key in self.original if key not in assignments]
+        forced = sum(1 for key in open_keys if self.original[key] not in domains[key])
+        changes = self._changes + forced
+        if changes > self.max_changes:
+            return False
+        if forwardcheck and changes == self.max_changes:
+            for key in open_keys:
+                user = self.original[key]
+                domain = domains[key]
+                if user not in domain:
+                    continue
+                for value in domain[:]:
+                    if value != user:
+                        domain.hideValue(value)
+        return True
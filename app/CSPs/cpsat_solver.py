@@ -0,0 +1,376 @@
+# importing the CP-SAT solver from google or-tools
+from ortools.sat.python import cp_model
+# shared shift time helpers
+from app.CSPs.shift_times import build_rest_conflict_table, rest_conflict_groups
+from app.CSPs.problem_index import ProblemIndex
+from app.CSPs.constraints import min_roster_distance, day_limit_windows
+from app.CSPs.diagnosis import diagnose, diagnosis_result
+from app.CSPs.local_search import improve_roster
+from app.CSPs.fairness import OBJECTIVES, OPTIMIZE_TIME_SECONDS, resolve_weights, fairness_report, is_night, is_weekend
+# for default dictionary behaviour
+from collections import defaultdict
+# for shuffling users different solution each time
+import random
+import threading
+import time
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+# how often a running cp-sat search looks for a cancel
+CANCEL_POLL_SECONDS = 0.1
+# search workers per cp-sat solve (CPSAT_WORKERS in the .env file), every core by default
+# with several solver pool workers on one machine it is worth lowering so they dont fight for cores
+CPSAT_WORKERS = int(os.getenv("CPSAT_WORKERS", os.cpu_count() or 1))
+
+class CPSATShiftSolver:
+    # same inputs as the ShiftAssignmentSolver so the route can swap between them
+    def __init__(self, users, shifts, shift_details, user_availability, user_expertise, shift_expertise, max_days_per_user=5, max_time_seconds=10.0, time_limit_ms=None, count=1, min_difference=None, objective=None, weights=None, hint=None, improve_ms=None, fixed_assignments=None, progress=None, max_time_ms=None):
+        build_started = time.perf_counter()
+        self.users = list(users)
+        self.shifts = shifts
+        self.shift_details = shift_details
+        self.user_availability = user_availability
+        self.max_days_per_user = max_days_per_user
+        # a time limit in milliseconds from the route takes over the default
+        self.max_time_seconds = time_limit_ms / 1000.0 if time_limit_ms else max_time_seconds
+        # "fairness" minimizes the weighted spread of hours, nights and weekends between users
+        if objective is not None and objective not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective}")
+        self.objective = objective
+        self.weights = resolve_weights(weights)
+        # the optimizing search keeps improving until the time is up, so it gets a shorter default
+        if objective and not time_limit_ms:
+            self.max_time_seconds = min(self.max_time_seconds, OPTIMIZE_TIME_SECONDS)
+        # max_time_ms is the most the whole solve can take (the time left in the solver pool),
+        # the search and the local search both have to fit in it
+        self.max_deadline = None
+        if max_time_ms is not None:
+            self.max_time_seconds = min(self.max_time_seconds, max_time_ms / 1000.0)
+            self.max_deadline = build_started + max_time_ms / 1000.0
+        # a previous roster (like last weeks active one) given to cp-sat as a solution hint
+        self.hint = hint or []
+        # how many different rosters to return, each differing in at least min_difference slots
+        self.count = count
+        self.min_difference = min_difference
+        # optional time budget for a local search that improves a single roster once it is found
+        self.improve_ms = improve_ms
+        # optional ProgressChannel, gets events as the solve goes on and can cancel the search
+        self.progress = progress
+        # shuffling the users so the solver doesnt always favour the same people
+        random.shuffle(self.users)
+
+        # dense integer form of the problem, expertise as bitmasks, days off as a users x days
+        # matrix and shift times in whole minutes, shared with the csp solver
+        self.index = ProblemIndex(self.users, self.shifts, self.shift_details, self.user_availability, user_expertise, shift_expertise)
+        # shift start and end in minutes from midnight
+        self.shift_minutes = self.index.shift_minutes
+        # the shift keys sorted by day and start time, the same as the csp solver
+        self.shift_keys = list(self.index.keys)
+        # assignments worked before the horizon, kept as fixed context for the rest gap and day limit
+        self.fixed = self.index.fixed_context(fixed_assignments)
+        # valid users for every shift key, same rules as the csp domains
+        self.domains = self.index.context_domains(self.index.domains(), self.fixed, self.max_days_per_user)
+
+        self.model = cp_model.CpModel()
+        # boolean variable per (shift key, user) saying if the user works that slot
+        self.x = {}
+        # the fairness objective, kept aside so a roster can be found without it first
+        self.fairness = None
+        # search statistics from the last solve
+        self.stats = {}
+        self._build_model()
+        if self.progress is not None:
+            self.progress.emit(
+                "model_built", force=True, slots=len(self.shift_keys), users=len(self.users),
+                build_ms=round((time.perf_counter() - build_started) * 1000, 1),
+            )
+
+    def _build_model(self):
+        model = self.model
+        # per user, per day list of variables (used for one shift a day and max days)
+        user_day_vars = defaultdict(lambda: defaultdict(list))
+
+        for key in self.shift_keys:
+            sid, day, slot = key
+            slot_vars = []
+            for user in self.domains[key]:
+                var = model.NewBoolVar(f"x_{sid}_{day}_{slot}_{user}")
+                self.x[key, user] = var
+                slot_vars.append(var)
+                user_day_vars[user][day].append(var)
+            # every slot needs exactly one user
+            model.AddExactlyOne(slot_vars)
+
+        # days each user already works in the fixed context
+        fixed_days = defaultdict(set)
+        for (_, day, _), user in self.fixed.items():
+            fixed_days[user].add(day)
+        windows = day_limit_windows([key[1] for key in list(self.fixed) + self.shift_keys])
+        for user, days in user_day_vars.items():
+            works = {}
+            for day, day_vars in days.items():
+                # a user can only work one shift a day, works on the day is true exactly when
+                # one of its slots is picked
+                works[day] = model.NewBoolVar(f"works_{user}_{day}")
+                model.AddExactlyOne(day_vars + [works[day].Not()])
+            # counting the days worked in any 7 days in a row with one literal per day (rather then
+            # every slot of every day), less the days already worked there in the fixed context
+            for first, last in windows:
+                window_days = [var for day, var in works.items() if first <= day <= last]
+                if window_days:
+                    already = sum(1 for day in fixed_days[user] if first <= day <= last)
+                    model.Add(sum(window_days) <= self.max_days_per_user - already)
+
+        # stopping users working a day shift straight after a night shift
+        # each group is the slots of two clashing shifts on consecutive days, worked out once
+        # (the fixed context was already taken off the domains it clashes with)
+        self.conflict_table = build_rest_conflict_table(self.shift_minutes)
+        for group in rest_conflict_groups(self.shift_keys, self.conflict_table):
+            group_users = defaultdict(list)
+            for key in group:
+                for user in self.domains[key]:
+                    group_users[user].append(self.x[key, user])
+            for user_vars in group_users.values():
+                if len(user_vars) > 1:
+                    model.AddAtMostOne(user_vars)
+
+        if self.objective == "fairness":
+            self._add_fairness_objective()
+
+        # hinting the previous user for every slot they can still work, and everyone else off
+        # that slot, when the hint is complete and still valid cp-sat takes it as the first roster
+        previous = {(a['shift_id'], a['day_id'], a['slot']): a['user_id'] for a in self.hint}
+        for key in self.shift_keys:
+            if (key, previous.get(key)) not in self.x:
+                continue
+            for user in self.domains[key]:
+                model.AddHint(self.x[key, user], user == previous[key])
+        # without another objective, keeping as many previous assignments as possible is the goal
+        if previous and self.objective is None:
+            model.Maximize(sum(self.x[key, user] for key, user in previous.items() if (key, user) in self.x))
+
+    def _add_fairness_objective(self):
+        model = self.model
+        # per user totals as linear expressions over the slot variables
+        hours = defaultdict(list)
+        nights = defaultdict(list)
+        weekends = defaultdict(list)
+        for (key, user), var in self.x.items():
+            sid, day, _ = key
+            start, end = self.shift_minutes[sid]
+            hours[user].append((end - start) * var)
+            if is_night(start, end):
+                nights[user].append(var)
+            if is_weekend(day):
+                weekends[user].append(var)
+
+        # cp-sat only takes whole numbers, so hours are counted in minutes and a night or weekend
+        # shift counts as 60 minutes, with the weights scaled by 100 to keep two decimals
+        longest = max((end - start for start, end in self.shift_minutes.values()), default=0)
+        terms = []
+        for name, per_user, unit, bound in (
+            ("hours", hours, 1, longest * len(self.shift_keys)),
+            ("nights", nights, 60, len(self.shift_keys)),
+            ("weekends", weekends, 60, len(self.shift_keys)),
+        ):
+            weight = round(self.weights[name] * 100)
+            if not weight:
+                continue
+            # users with nothing they can work still count, with a total of 0
+            totals = [sum(per_user[user]) for user in self.users]
+            highest = model.NewIntVar(0, bound, f"max_{name}")
+            lowest = model.NewIntVar(0, bound, f"min_{name}")
+            model.AddMaxEquality(highest, totals)
+            model.AddMinEquality(lowest, totals)
+            terms.append(weight * unit * (highest - lowest))
+        if terms:
+            self.fairness = sum(terms)
+
+    def solve(self):
+        # failing straight away when a quick check shows there is no roster at all
+        # (a slot nobody can fill, a day with too few users, more slots then the team can cover)
+        diagnosis = diagnose(self.domains, self.max_days_per_user)
+        if diagnosis:
+            return diagnosis_result(diagnosis)
+
+        solver = cp_model.CpSolver()
+        solver.parameters.max_time_in_seconds = self.max_time_seconds
+        solver.parameters.random_seed = random.randint(0, 2**31 - 1)
+        solver.parameters.num_workers = CPSAT_WORKERS
+        callback = ProgressCallback(self.progress, len(self.shift_keys)) if self.progress is not None else None
+        # the time limit covers every roster asked for, not each one
+        started = time.perf_counter()
+        status, chosen = self._search(solver, callback, started)
+        # keeping the search statistics for benchmarking
+        self.stats = {"branches": solver.NumBranches(), "conflicts": solver.NumConflicts(), "wall_time": solver.WallTime()}
+        if callback is not None and callback.cancelled and status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return {
+                "assignments": [],
+                "total_solutions": 0,
+                "cancelled": True,
+                "failure_reasons": ["Solve cancelled before a roster was found"]
+            }
+        if status == cp_model.UNKNOWN:
+            # the time ran out before cp-sat found any roster
+            return {
+                "assignments": [],
+                "total_solutions": 0,
+                "timed_out": True,
+                "failure_reasons": [f"Time limit of {self.max_time_seconds * 1000:g} ms reached before a roster was found"]
+            }
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            print("No valid shift assignments found.")
+            return {"assignments": [], "total_solutions": 0}
+
+        solutions = [chosen]
+        # finding more rosters on the same model if asked for, after each one a hamming distance
+        # cut stops the next roster keeping more then (slots - min distance) of its assignments
+        min_distance = min_roster_distance(len(self.shift_keys), self.min_difference)
+        while len(solutions) < self.count:
+            if callback is not None and callback.cancelled:
+                break
+            chosen = solutions[-1]
+            self.model.Add(sum(self.x[key, user] for key, user in chosen.items()) <= len(chosen) - min_distance)
+            _, chosen = self._search(solver, callback, started)
+            if chosen is None:
+                break
+            solutions.append(chosen)
+
+        # the same local search as the csp solver, mostly useful when cp-sat had no objective
+        improvement = None
+        if self.improve_ms and len(solutions) == 1:
+            improve_ms = self.improve_ms
+            if self.max_deadline is not None:
+                improve_ms = max(1, min(improve_ms, int((self.max_deadline - time.perf_counter()) * 1000)))
+            improved, improvement = improve_roster(
+                solutions[0], self.domains, self.users, self.shift_minutes, self.conflict_table,
+                self.max_days_per_user, self.weights, improve_ms, fixed=self.fixed, progress=self.progress,
+            )
+            solutions = [improved]
+
+        # formating assignments the same way as the csp solver
+        formatted = []
+        for chosen in solutions:
+            assignments = [
+                {"user_id": user, "shift_id": sid, "day_id": day, "slot": slot}
+                for (sid, day, slot), user in chosen.items()
+            ]
+            assignments.sort(key=lambda x: x["day_id"])
+            formatted.append(assignments)
+        result = {"assignments": formatted, "total_solutions": len(formatted)}
+        # adding how fair each roster is and the totals per user
+        result.update(fairness_report(solutions, self.users, self.shift_minutes, self.weights))
+        if improvement:
+            result["improvement"] = improvement
+        # a roster found before a cancel is still a full roster, the caller decides what to do with it
+        if self.progress is not None and self.progress.cancelled():
+            result["cancelled"] = True
+        return result
+
+    def _search(self, solver, callback, started):
+        # one roster in the time left, returns the cp-sat status and the user for each slot
+        # (None when no roster was found)
+        # with the fairness objective any roster is found first, as searching with the objective from
+        # the start can use up the whole time on a big team without finding a single roster
+        remaining = self.max_time_seconds - (time.perf_counter() - started)
+        if remaining <= 0:
+            return cp_model.UNKNOWN, None
+        solver.parameters.max_time_in_seconds = remaining
+        if self.fairness is not None:
+            self.model.ClearObjective()
+        status = self._run(solver, callback)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return status, None
+        chosen = self._chosen_users(solver)
+        if self.fairness is None:
+            return status, chosen
+
+        # a short optimizing search from that roster, which is enough to prove the best one on a small team
+        optimal, chosen = self._optimize(solver, callback, chosen, remaining / 4, started)
+        remaining = self.max_time_seconds - (time.perf_counter() - started)
+        if optimal or remaining <= 0 or (callback is not None and callback.cancelled):
+            return status, chosen
+        # on a bigger team the local search gains far more per second then cp-sat on one core,
+        # so it gets half the time left and cp-sat tries to improve on its roster with the rest
+        chosen, _ = improve_roster(
+            chosen, self.domains, self.users, self.shift_minutes, self.conflict_table,
+            self.max_days_per_user, self.weights, remaining * 1000 / 2, fixed=self.fixed, progress=self.progress,
+        )
+        _, chosen = self._optimize(solver, callback, chosen, self.max_time_seconds, started)
+        return status, chosen
+
+    def _optimize(self, solver, callback, chosen, seconds, started):
+        # minimizing the fairness objective for up to seconds (never past the time limit) with chosen
+        # as the hint, returns whether the roster is the best there is and the fairer of the two rosters
+        seconds = min(seconds, self.max_time_seconds - (time.perf_counter() - started))
+        if seconds <= 0 or (callback is not None and callback.cancelled):
+            return False, chosen
+        self.model.ClearHints()
+        for (key, user), var in self.x.items():
+            self.model.AddHint(var, chosen[key] == user)
+        self.model.Minimize(self.fairness)
+        solver.parameters.max_time_in_seconds = seconds
+        status = self._run(solver, callback)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return False, chosen
+        # keeping the hint when cp-sat didnt get back to it in time
+        optimized = self._chosen_users(solver)
+        before, after = fairness_report([chosen, optimized], self.users, self.shift_minutes, self.weights)["objective_values"]
+        return status == cp_model.OPTIMAL, optimized if after <= before else chosen
+
+    def _run(self, solver, callback):
+        # one cp-sat solve, watched for a cancel when there is a progress channel
+        if callback is None:
+            return solver.Solve(self.model)
+        callback.watch(solver)
+        try:
+            return solver.Solve(self.model, callback)
+        finally:
+            callback.stop_watching()
+
+    def _chosen_users(self, solver):
+        # reading back which user was picked for each slot
+        chosen = {}
+        for (key, user), var in self.x.items():
+            if solver.BooleanValue(var):
+                chosen[key] = user
+        return chosen
+
+
+class ProgressCallback(cp_model.CpSolverSolutionCallback):
+    # reports the better rosters cp-sat finds, while a small thread watches for a cancel and
+    # stops the search (cp-sat only calls back on a roster, so a cancel before the first one
+    # would otherwise go unseen until the time limit)
+    # the first roster always goes out, the ones after it are rate limited like the search updates
+    # as an optimizing search can find a burst of them
+    def __init__(self, progress, slots):
+        super().__init__()
+        self.progress = progress
+        self.slots = slots
+        self.cancelled = False
+        self.found = False
+        self._done = None
+
+    def on_solution_callback(self):
+        self.progress.emit(
+            "solution_found", force=not self.found, slots_filled=self.slots, slots=self.slots,
+            best_objective=self.ObjectiveValue(), branches=self.NumBranches(),
+        )
+        self.found = True
+
+    def watch(self, solver):
+        done = self._done = threading.Event()
+
+        def check():
+            while not done.wait(CANCEL_POLL_SECONDS):
+                if self.progress.cancelled():
+                    self.cancelled = True
+                    solver.StopSearch()
+                    return
+
+        threading.Thread(target=check, daemon=True).start()
+
+    def stop_watching(self):
+        self._done.set()
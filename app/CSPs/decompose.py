@@ -0,0 +1,42 @@
+# splitting a roster problem into parts that share no users and can be solved on their own
+from dotenv import load_dotenv
+import os
+from collections import defaultdict
+
+load_dotenv()
+
+# solving the parts in separate processes (SOLVER_PARALLEL_COMPONENTS in the .env file)
+PARALLEL_COMPONENTS = os.getenv("SOLVER_PARALLEL_COMPONENTS", "false").lower() == "true"
+
+
+# grouping the shift keys into connected components of the user/slot compatibility graph
+# every constraint is about one user (one shift a day, rest gap, max days), so two slots with no
+# possible user in common, directly or through other slots, never affect each other
+# domains maps each shift key to the users that can work it, returns [(keys, users)]
+def connected_components(shift_keys, domains):
+    parent = {key: key for key in shift_keys}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    # joining every slot a user can work to the first slot they were seen on
+    first_key = {}
+    for key in shift_keys:
+        for user in domains[key]:
+            if user not in first_key:
+                first_key[user] = key
+                continue
+            a, b = find(first_key[user]), find(key)
+            if a != b:
+                parent[b] = a
+
+    keys_by_root = defaultdict(list)
+    for key in shift_keys:
+        keys_by_root[find(key)].append(key)
+    users_by_root = defaultdict(list)
+    for user, key in first_key.items():
+        users_by_root[find(key)].append(user)
+    return [(keys, users_by_root[root]) for root, keys in keys_by_root.items()]
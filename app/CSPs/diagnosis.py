@@ -0,0 +1,102 @@
+# quick checks run before the search, finding the obvious reasons a roster cant exist
+# so a hopeless solve fails straight away with something the employer can fix
+from collections import defaultdict
+from app.CSPs.constraints import max_matching, DAY_LIMIT_WINDOW
+
+
+# how many of the slots the users could cover at most, a user works one slot a day and
+# no more then max_days days in any 7 days in a row (so max_days a week over a longer horizon)
+def _capacity(keys, domains, max_days, horizon_days):
+    weeks, rest = divmod(horizon_days, DAY_LIMIT_WINDOW)
+    limit = weeks * max_days + min(rest, max_days)
+    user_days = defaultdict(set)
+    for key in keys:
+        for user in domains[key]:
+            user_days[user].add(key[1])
+    return sum(min(limit, len(days)) for days in user_days.values())
+
+
+# domains maps each (shift_id, day_id, slot) key to the users that can work it
+# returns a list of problems found, empty if nothing obvious is wrong
+def diagnose(domains, max_days):
+    problems = []
+    days = [key[1] for key in domains]
+    horizon_days = max(days) - min(days) + 1 if days else 0
+    keys_by_day = defaultdict(list)
+    keys_by_shift = defaultdict(list)
+    for key in domains:
+        keys_by_shift[key[0]].append(key)
+        keys_by_day[key[1]].append(key)
+
+    # slots nobody can work, one entry per shift and day
+    empty = defaultdict(int)
+    for key, users in domains.items():
+        if not users:
+            empty[key[0], key[1]] += 1
+    for (shift_id, day_id), slots in empty.items():
+        problems.append({
+            "type": "no_qualified_user",
+            "shift_id": shift_id,
+            "day_id": day_id,
+            "slots": slots,
+            "message": f"Nobody with the required expertise is available for shift {shift_id} on day {day_id}",
+        })
+
+    # days where the slots cant all get a different user (Hall's condition through a matching)
+    for day_id, keys in keys_by_day.items():
+        if any((key[0], day_id) in empty for key in keys):
+            continue
+        matched = len(max_matching({key: domains[key] for key in keys}))
+        if matched < len(keys):
+            problems.append({
+                "type": "day_understaffed",
+                "day_id": day_id,
+                "slots": len(keys),
+                "assignable": matched,
+                "message": f"Day {day_id} has {len(keys)} slots but only {matched} can be given to different available users",
+            })
+
+    # slots only a certain group of users can work (like every shift needing one expertise)
+    # against what that group can cover, checked for each shifts group of qualified users
+    qualified = {}
+    for shift_id, keys in keys_by_shift.items():
+        qualified[shift_id] = frozenset(user for key in keys for user in domains[key])
+    everyone = frozenset(user for users in domains.values() for user in users)
+    for group in set(qualified.values()):
+        # the whole team is checked below
+        if group == everyone:
+            continue
+        keys = [key for key in domains if domains[key] and group.issuperset(domains[key])]
+        capacity = _capacity(keys, domains, max_days, horizon_days)
+        if capacity < len(keys):
+            shift_ids = sorted({key[0] for key in keys})
+            problems.append({
+                "type": "qualified_capacity",
+                "shift_ids": shift_ids,
+                "users": sorted(group),
+                "slots": len(keys),
+                "capacity": capacity,
+                "message": f"Shifts {', '.join(map(str, shift_ids))} have {len(keys)} slots that only {len(group)} users can work, covering at most {capacity} within {max_days} days a week each",
+            })
+
+    # every slot of the week against what the whole team can cover
+    capacity = _capacity(list(domains), domains, max_days, horizon_days)
+    if capacity < len(domains):
+        problems.append({
+            "type": "week_capacity",
+            "slots": len(domains),
+            "capacity": capacity,
+            "message": f"The roster has {len(domains)} slots but the team can cover at most {capacity} within {max_days} days a week each",
+        })
+    return problems
+
+
+# the solver result for a roster that failed the checks
+def diagnosis_result(problems):
+    print("No valid shift assignments found.")
+    return {
+        "assignments": [],
+        "total_solutions": 0,
+        "failure_reasons": [problem["message"] for problem in problems],
+        "diagnosis": problems,
+    }
@@ -0,0 +1,76 @@
+from dotenv import load_dotenv
+import os
+import time
+from app.CSPs.solver_csp import ShiftAssignmentSolver
+from app.CSPs.cpsat_solver import CPSATShiftSolver
+from app.CSPs.regen_csp import RegenerateCSP
+
+load_dotenv()
+
+# all solving engines that can build a roster, picked by name
+ENGINES = {
+    "csp": ShiftAssignmentSolver,
+    "cpsat": CPSATShiftSolver,
+}
+
+# engine used when the request doesnt ask for one (SOLVER_ENGINE in the .env file)
+DEFAULT_ENGINE = os.getenv("SOLVER_ENGINE", "csp")
+
+if DEFAULT_ENGINE not in ENGINES:
+    raise ValueError(f"Unknown solver engine {DEFAULT_ENGINE}")
+
+
+# building the solver for the chosen engine from the create_schedule request data
+# options are extra solver settings from the route, like time_limit_ms
+# progress is an optional ProgressChannel for events and cancelling, kept out of options so it
+# never ends up in the cache fingerprint
+def build_assignment_solver(request_data, engine=None, options=None, progress=None):
+    engine = engine or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown solver engine {engine}")
+    return ENGINES[engine](
+        users=request_data["users"],
+        shifts=request_data["shifts"],
+        shift_details=request_data["shift_details"],
+        user_availability=request_data["user_availability"],
+        user_expertise=request_data["user_expertise"],
+        shift_expertise=request_data["shift_expertise"],
+        # last weeks active roster before a horizon, missing for data built by hand
+        fixed_assignments=request_data.get("fixed_assignments", []),
+        progress=progress,
+        **(options or {})
+    )
+
+
+# building the regeneration csp from the regenerate_solution request data
+# options are extra settings from the route, like mode and target_changes
+def build_regeneration_solver(request_data, options=None, progress=None):
+    return RegenerateCSP(
+        users=request_data["users"],
+        shifts=request_data["shifts"],
+        user_availability=request_data["user_availability"],
+        user_expertise=request_data["user_expertise"],
+        shift_expertise=request_data["shift_expertise"],
+        shift_details=request_data["shift_times"],
+        original_assignments=request_data["original_assignments"],
+        locked_assignments=request_data["locked_assignments"],
+        progress=progress,
+        **(options or {})
+    )
+
+
+# the time left before the deadline from the solver pool, given to the solver as max_time_ms
+# so a solve stops on its own by the time the request gives up on it
+def with_deadline(options, deadline):
+    if deadline is None:
+        return options
+    return dict(options or {}, max_time_ms=max(1, int((deadline - time.time()) * 1000)))
+
+
+# top level functions so they can be sent to a worker process
+def run_assignment_solver(request_data, engine=None, options=None, progress=None, deadline=None):
+    return build_assignment_solver(request_data, engine, with_deadline(options, deadline), progress).solve()
+
+
+def run_regeneration_solver(request_data, options=None, progress=None, deadline=None):
+    return build_regeneration_solver(request_data, with_deadline(options, deadline), progress).solve()
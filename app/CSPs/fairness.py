@@ -0,0 +1,77 @@
+# fairness objective shared by the solvers, how evenly the hours, nights and weekends are spread
+from dotenv import load_dotenv
+import os
+from app.CSPs.shift_times import MINUTES_PER_DAY
+
+load_dotenv()
+
+# objective names the solvers understand (None means just find any valid roster)
+OBJECTIVES = ["fairness"]
+
+# how much each spread counts in the objective, can be changed in the .env file or per request
+DEFAULT_WEIGHTS = {
+    "hours": float(os.getenv("FAIRNESS_WEIGHT_HOURS", 1.0)),
+    "nights": float(os.getenv("FAIRNESS_WEIGHT_NIGHTS", 1.0)),
+    "weekends": float(os.getenv("FAIRNESS_WEIGHT_WEEKENDS", 1.0)),
+}
+
+# default time budget for an optimizing cp-sat solve, it returns the best roster found by then
+OPTIMIZE_TIME_SECONDS = float(os.getenv("FAIRNESS_TIME_SECONDS", 5.0))
+
+# days are numbered from monday = 1, so saturday and sunday are 6 and 0 after % 7
+WEEKEND_DAYS = {6, 0}
+# shifts starting before this (in minutes) count as nights, as do shifts running past midnight
+NIGHT_START_BEFORE = 6 * 60
+
+
+# filling in any weight not given with the default
+def resolve_weights(weights=None):
+    resolved = dict(DEFAULT_WEIGHTS)
+    for name, value in (weights or {}).items():
+        if value is not None:
+            resolved[name] = value
+    return resolved
+
+
+def is_weekend(day_id):
+    return day_id % 7 in WEEKEND_DAYS
+
+
+def is_night(start, end):
+    return end > MINUTES_PER_DAY or start < NIGHT_START_BEFORE
+
+
+# hours, nights, weekend shifts and days worked per user for one roster
+# every user is listed even with nothing assigned, as they count towards the spread
+def user_totals(roster, users, shift_minutes):
+    totals = {user: {"user_id": user, "hours": 0.0, "nights": 0, "weekends": 0, "days": 0} for user in users}
+    for (sid, day, _), user in roster.items():
+        start, end = shift_minutes[sid]
+        total = totals[user]
+        total["hours"] += (end - start) / 60.0
+        total["nights"] += is_night(start, end)
+        total["weekends"] += is_weekend(day)
+        total["days"] += 1
+    return list(totals.values())
+
+
+# weighted sum of (max - min) for hours, nights and weekends, lower is fairer
+def fairness_objective(totals, weights):
+    if not totals:
+        return 0.0
+    objective = 0.0
+    for name in ("hours", "nights", "weekends"):
+        values = [total[name] for total in totals]
+        objective += weights[name] * (max(values) - min(values))
+    return round(objective, 3)
+
+
+# the objective value and per user totals for every roster returned, in the same order
+def fairness_report(rosters, users, shift_minutes, weights):
+    objective_values = []
+    totals = []
+    for roster in rosters:
+        roster_totals = user_totals(roster, users, shift_minutes)
+        objective_values.append(fairness_objective(roster_totals, weights))
+        totals.append(roster_totals)
+    return {"objective_values": objective_values, "user_totals": totals}
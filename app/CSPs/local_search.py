@@ -0,0 +1,187 @@
+# improving a finished roster with a time boxed local search
+# every move keeps the hard rules of the solvers (a qualified and available user, one shift a
+# day, the rest gap between days and the day limit), so the roster stays valid the whole time
+# and the search can stop at any point with a roster at least as good as the one it started from
+from dotenv import load_dotenv
+import os
+import random
+import time
+from collections import defaultdict
+from app.CSPs.fairness import is_night, is_weekend
+from app.CSPs.constraints import under_day_limit
+
+load_dotenv()
+
+# largest time budget a request can ask for (IMPROVE_MAX_TIME_MS in the .env file)
+IMPROVE_MAX_TIME_MS = int(os.getenv("IMPROVE_MAX_TIME_MS", 10000))
+
+SPREADS = ("hours", "nights", "weekends")
+
+
+class RosterImprover:
+    # roster maps each (shift_id, day_id, slot) key to a user, domains the users allowed on each key
+    # the roster is scored by the weighted fairness spread first and then by how many times a user
+    # goes from a night shift to a day shift the next day, lower is better for both
+    # two kinds of move are tried at random:
+    #   reassign - give one slot to another user who can take it
+    #   swap - two users working the same day swap their slots
+    # a move is kept when the score doesnt get worse, so the search can walk across equal rosters
+    # fixed is context from before the horizon (key -> user), it is never moved or scored but
+    # still counts for the rest gap and the day limit
+    def __init__(self, roster, domains, users, shift_minutes, conflict_table, max_days, weights, fixed=None, check_every=64):
+        self.roster = dict(roster)
+        self.domains = {key: set(users_) for key, users_ in domains.items()}
+        self.candidates = {key: list(users_) for key, users_ in domains.items()}
+        self.users = list(users)
+        self.conflict_table = conflict_table
+        self.max_days = max_days
+        self.weights = weights
+        self.check_every = check_every
+        self.hours = {sid: (end - start) / 60.0 for sid, (start, end) in shift_minutes.items()}
+        self.night = {sid: is_night(start, end) for sid, (start, end) in shift_minutes.items()}
+
+        # the days each user works (day -> shift id) and their hours, nights and weekends so far
+        self.worked = defaultdict(dict)
+        self.totals = {user: {name: 0.0 for name in SPREADS} for user in self.users}
+        for key, user in self.roster.items():
+            self._add(user, key)
+        for (sid, day, _), user in (fixed or {}).items():
+            self.worked[user][day] = sid
+        self.keys = list(self.roster)
+        self.keys_by_day = defaultdict(list)
+        for key in self.keys:
+            self.keys_by_day[key[1]].append(key)
+        self.transitions = sum(self._transitions(user) for user in list(self.worked))
+
+        # search statistics
+        self.moves = 0
+        self.accepted = 0
+
+    def _add(self, user, key):
+        sid, day, _ = key
+        self.worked[user][day] = sid
+        total = self.totals.setdefault(user, {name: 0.0 for name in SPREADS})
+        total["hours"] += self.hours[sid]
+        total["nights"] += self.night[sid]
+        total["weekends"] += is_weekend(day)
+
+    def _remove(self, user, key):
+        sid, day, _ = key
+        del self.worked[user][day]
+        total = self.totals[user]
+        total["hours"] -= self.hours[sid]
+        total["nights"] -= self.night[sid]
+        total["weekends"] -= is_weekend(day)
+
+    def _transitions(self, user):
+        # night shift followed by a shift that isnt a night the next day
+        worked = self.worked[user]
+        return sum(
+            1 for day, sid in worked.items()
+            if self.night[sid] and day + 1 in worked and not self.night[worked[day + 1]]
+        )
+
+    def fairness(self):
+        objective = 0.0
+        for name in SPREADS:
+            values = [total[name] for total in self.totals.values()]
+            if values:
+                objective += self.weights[name] * (max(values) - min(values))
+        return round(objective, 3)
+
+    def score(self):
+        return (self.fairness(), self.transitions)
+
+    def _fits(self, user, key):
+        # can the user take this slot, given the rest of what they work (without this day)
+        sid, day, _ = key
+        if user not in self.domains[key]:
+            return False
+        worked = self.worked[user]
+        if self.conflict_table.get((worked.get(day - 1), sid)) or self.conflict_table.get((sid, worked.get(day + 1))):
+            return False
+        # a user already working this day keeps the same number of days
+        return day in worked or under_day_limit(worked, day, self.max_days)
+
+    def _move(self, changes):
+        # changes is a list of (key, new user), applied together and undone if the score is worse
+        # returns True when the move was kept
+        before = self.score()
+        touched = {self.roster[key] for key, _ in changes} | {user for _, user in changes}
+        old_transitions = sum(self._transitions(user) for user in touched)
+        for key, _ in changes:
+            self._remove(self.roster[key], key)
+        old_users = [self.roster[key] for key, _ in changes]
+        for key, user in changes:
+            self.roster[key] = user
+            self._add(user, key)
+        self.transitions += sum(self._transitions(user) for user in touched) - old_transitions
+        if self.score() <= before:
+            return True
+        # undoing the move
+        new_transitions = sum(self._transitions(user) for user in touched)
+        for key, _ in changes:
+            self._remove(self.roster[key], key)
+        for (key, _), user in zip(changes, old_users):
+            self.roster[key] = user
+            self._add(user, key)
+        self.transitions += sum(self._transitions(user) for user in touched) - new_transitions
+        return False
+
+    def _reassign(self, key):
+        current = self.roster[key]
+        user = random.choice(self.candidates[key])
+        if user == current or key[1] in self.worked[user]:
+            return None
+        if not self._fits(user, key):
+            return None
+        return [(key, user)]
+
+    def _swap(self, key):
+        same_day = self.keys_by_day[key[1]]
+        other = random.choice(same_day)
+        a, b = self.roster[key], self.roster[other]
+        if other == key or a == b or key[0] == other[0]:
+            return None
+        # both already work that day, so only the qualification and the rest gap can stop it
+        if not (self._fits(b, key) and self._fits(a, other)):
+            return None
+        return [(key, b), (other, a)]
+
+    def improve(self, time_limit_ms, progress=None):
+        # running moves until the time is up (or the solve is cancelled), returns the improved roster
+        deadline = time.perf_counter() + time_limit_ms / 1000.0
+        if not self.keys:
+            return self.roster
+        while True:
+            if self.moves % self.check_every == 0:
+                if time.perf_counter() >= deadline:
+                    break
+                if progress is not None:
+                    progress.emit("improving", moves=self.moves, best_objective=self.fairness(), transitions=self.transitions)
+                    if progress.cancelled():
+                        break
+            self.moves += 1
+            key = random.choice(self.keys)
+            changes = self._reassign(key) if random.random() < 0.5 else self._swap(key)
+            if changes and self._move(changes):
+                self.accepted += 1
+        return self.roster
+
+
+# improving a roster for time_limit_ms, returns the roster and what the search did
+def improve_roster(roster, domains, users, shift_minutes, conflict_table, max_days, weights, time_limit_ms, fixed=None, progress=None):
+    time_limit_ms = min(time_limit_ms, IMPROVE_MAX_TIME_MS)
+    improver = RosterImprover(roster, domains, users, shift_minutes, conflict_table, max_days, weights, fixed)
+    objective_before, transitions_before = improver.score()
+    improved = improver.improve(time_limit_ms, progress)
+    objective_after, transitions_after = improver.score()
+    return improved, {
+        "time_limit_ms": time_limit_ms,
+        "moves": improver.moves,
+        "accepted_moves": improver.accepted,
+        "objective_before": objective_before,
+        "objective_after": objective_after,
+        "transitions_before": transitions_before,
+        "transitions_after": transitions_after,
+    }
@@ -0,0 +1,110 @@
+# compact form of a roster problem shared by the solvers and the diagnosis
+# users, shifts, days and expertise get dense integer indexes, expertise becomes bitmasks,
+# days off a numpy users x days matrix and the shift times whole minutes from midnight
+import numpy as np
+from collections import defaultdict
+from app.CSPs.shift_times import build_shift_minutes, build_rest_conflict_table
+from app.CSPs.constraints import under_day_limit
+
+
+class ProblemIndex:
+    # built once from the same inputs the solvers take, the users keep the order they are given in
+    # so a shuffled team still gives shuffled domains
+    def __init__(self, users, shifts, shift_details, user_availability, user_expertise, shift_expertise):
+        # position -> user id and user id -> position
+        self.users = list(users)
+        self.user_index = {user: i for i, user in enumerate(self.users)}
+
+        # shift ids with their (start, end) minutes from midnight and length in hours
+        self.shift_minutes = build_shift_minutes(shift_details)
+        self.shift_ids = list(self.shift_minutes)
+        self.shift_index = {sid: i for i, sid in enumerate(self.shift_ids)}
+        self.shift_hours = {sid: (end - start) / 60.0 for sid, (start, end) in self.shift_minutes.items()}
+
+        # one bit per expertise, a user or shift mask has the bits of every expertise it has or needs
+        expertise_ids = sorted({ue['expertise_id'] for ue in user_expertise} | {se['expertise_id'] for se in shift_expertise})
+        self.expertise_bit = {e: 1 << i for i, e in enumerate(expertise_ids)}
+        self.user_mask = [0] * len(self.users)
+        for ue in user_expertise:
+            i = self.user_index.get(ue['user_id'])
+            if i is not None:
+                self.user_mask[i] |= self.expertise_bit[ue['expertise_id']]
+        self.shift_mask = [0] * len(self.shift_ids)
+        for se in shift_expertise:
+            j = self.shift_index.get(se['shift_id'])
+            if j is not None:
+                self.shift_mask[j] |= self.expertise_bit[se['expertise_id']]
+
+        # the (shift_id, day_id, slot) keys without duplicates, sorted by day and start time
+        self.keys = list(dict.fromkeys((s['shift_id'], s['day_id'], s['slot']) for s in shifts))
+        self.keys.sort(key=lambda key: (key[1], self.shift_minutes[key[0]][0]))
+        self.key_index = {key: k for k, key in enumerate(self.keys)}
+
+        # the days in the problem, the first one is the start of the week
+        self.days = sorted({key[1] for key in self.keys})
+        self.day_index = {day: d for d, day in enumerate(self.days)}
+
+        # available[user, day] is False on an approved day off
+        self.available = np.ones((len(self.users), len(self.days)), dtype=bool)
+        for ua in user_availability:
+            i = self.user_index.get(ua['user_id'])
+            d = self.day_index.get(ua['day_id'])
+            if i is not None and d is not None:
+                self.available[i, d] = False
+
+    def fixed_context(self, fixed_assignments):
+        # assignments already worked before the horizon (like last weeks active roster moved to
+        # days 0 and below) as {key: user}, sorted by day and start time
+        # shifts that no longer exist and keys inside the horizon are left out
+        fixed = {}
+        for a in fixed_assignments or []:
+            key = (a['shift_id'], a['day_id'], a['slot'])
+            if a['shift_id'] in self.shift_minutes and key not in self.key_index:
+                fixed[key] = a['user_id']
+        return dict(sorted(fixed.items(), key=lambda item: (item[0][1], self.shift_minutes[item[0][0]][0])))
+
+    def context_domains(self, domains, fixed, max_days):
+        # taking the users the fixed context already rules out off the slots, so the search never
+        # has to look at the context: a shift too close after one they worked before the horizon,
+        # or a day that would go over the day limit counted with the days already worked
+        if not fixed:
+            return domains
+        conflict_table = build_rest_conflict_table(self.shift_minutes)
+        fixed_days = defaultdict(dict)
+        for (sid, day, _), user in fixed.items():
+            fixed_days[user][day] = sid
+
+        def fits(user, sid, day):
+            worked = fixed_days.get(user)
+            if not worked:
+                return True
+            if day in worked or conflict_table.get((worked.get(day - 1), sid)) or conflict_table.get((sid, worked.get(day + 1))):
+                return False
+            return under_day_limit(worked, day, max_days)
+
+        return {key: [user for user in users if fits(user, key[0], key[1])] for key, users in domains.items()}
+
+    def qualified(self, user, shift_id):
+        # a shift with no expertise needed can be worked by anyone, otherwise one shared bit is enough
+        required = self.shift_mask[self.shift_index[shift_id]]
+        return not required or bool(self.user_mask[self.user_index[user]] & required)
+
+    def valid_matrix(self):
+        # valid[key, user] is True when the user can work the slot, worked out as whole matrices
+        # instead of checking every key against every user one at a time
+        # the expertise bitmasks unpacked to users x expertise and shifts x expertise matrices,
+        # a user is qualified for a shift when they share any bit with it (or it needs none)
+        bits = np.arange(len(self.expertise_bit), dtype=object)
+        user_has = (np.array(self.user_mask, dtype=object)[:, None] >> bits & 1).astype(bool)
+        shift_needs = (np.array(self.shift_mask, dtype=object)[:, None] >> bits & 1).astype(bool)
+        qualified = (user_has.astype(np.int32) @ shift_needs.T.astype(np.int32) > 0) | ~shift_needs.any(axis=1)
+        # picking the column of each key's shift and day, then and-ing availability with expertise
+        key_shift = np.array([self.shift_index[key[0]] for key in self.keys], dtype=np.int64)
+        key_day = np.array([self.day_index[key[1]] for key in self.keys], dtype=np.int64)
+        return (qualified[:, key_shift] & self.available[:, key_day]).T
+
+    def domains(self):
+        # valid users for every key, the users available that day with the expertise the shift needs
+        valid = self.valid_matrix()
+        users = np.array(self.users)
+        return {key: users[valid[k]].tolist() for k, key in enumerate(self.keys)}
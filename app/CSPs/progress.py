@@ -0,0 +1,40 @@
+# progress events from a running solve, sent back to the server while the search goes on
+from dotenv import load_dotenv
+import os
+import time
+
+load_dotenv()
+
+# least time between two progress events of the same kind (PROGRESS_INTERVAL_MS in the .env file)
+PROGRESS_INTERVAL_MS = int(os.getenv("PROGRESS_INTERVAL_MS", 500))
+
+
+class ProgressChannel:
+    # Handed to a solver so it can report how the solve is going and hear about a cancel.
+    # events is a queue the server reads from and cancel an event the server sets to stop the
+    # search, both shared between processes so the channel can go to a solver pool worker.
+    # Updates during the search are rate limited to one every interval_ms per stage, so a burst
+    # of searching updates doesnt hold back the next roster found. A forced event (like the model
+    # being built or the first roster) always goes through.
+    def __init__(self, solve_id, events, cancel, interval_ms=PROGRESS_INTERVAL_MS):
+        self.solve_id = solve_id
+        self.events = events
+        self.cancel = cancel
+        self.interval_ms = interval_ms
+        # set on the servers copy when it cancels the solve, "cancelled" or "superseded"
+        self.stop_reason = None
+        # stage -> when its last event was sent
+        self._last = {}
+
+    def emit(self, stage, force=False, **data):
+        # returns True when the event was sent
+        now = time.monotonic()
+        last = self._last.get(stage)
+        if not force and last is not None and (now - last) * 1000 < self.interval_ms:
+            return False
+        self._last[stage] = now
+        self.events.put({"type": "solve_progress", "solve_id": self.solve_id, "stage": stage, **data})
+        return True
+
+    def cancelled(self):
+        return self.cancel.is_set()
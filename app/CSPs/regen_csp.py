@@ -1,13 +1,34 @@
 # importing constraint library to solve CSP problems
 from constraint import *
-# imporing datetime library to handle time calculations
-import datetime
-from datetime import datetime, time, timedelta
-from collections import defaultdict
+from app.CSPs.constraints import MaxDaysConstraint, DayAllDifferentConstraint, MaxChangesConstraint, HammingDistanceConstraint
+from app.CSPs.shift_times import build_rest_conflict_table, rest_conflict_groups
+from app.CSPs.problem_index import ProblemIndex
+from app.CSPs.search import TimedBacktrackingSolver
+from app.CSPs.diagnosis import diagnose, diagnosis_result
+from dotenv import load_dotenv
+import os
+import time as timer
+from collections import defaultdict, Counter
 from itertools import islice
+import random
+
+load_dotenv()
+
+# how regeneration can change the roster:
+#   different - a new roster that changes as many of the unlocked slots as it can
+#   repair - keeps the locked slots and changes as few slots as possible (fixing what broke)
+REGEN_MODES = ["different", "repair"]
+# time budget for a repair when the request doesnt give one, the fewest changes found by then is kept
+REPAIR_TIME_LIMIT_MS = int(os.getenv("REPAIR_TIME_LIMIT_MS", 2000))
+# time budget for a different roster, a search that gets stuck is restarted with a new
+# random user order after REGEN_RESTART_MS
+REGEN_TIME_LIMIT_MS = int(os.getenv("REGEN_TIME_LIMIT_MS", 10000))
+REGEN_RESTART_MS = int(os.getenv("REGEN_RESTART_MS", 500))
+
 # RegenerateCSP class to handle the constraint satisfaction problem for shift assignments regeneration
 class RegenerateCSP:
-    def __init__(self, users, shifts, user_availability, user_expertise, shift_expertise, shift_details, original_assignments, locked_assignments, max_days_per_user=5):
+    def __init__(self, users, shifts, user_availability, user_expertise, shift_expertise, shift_details, original_assignments, locked_assignments, max_days_per_user=5, mode="different", target_changes=None, time_limit_ms=None, progress=None, max_time_ms=None):
+        build_started = timer.perf_counter()
         # storing the parameters in instance variables
         self.users = users
         self.shifts = shifts
@@ -16,176 +37,151 @@ class RegenerateCSP:
         self.original_assignments = original_assignments
         self.locked_assignments = locked_assignments
         self.max_days_per_user = max_days_per_user
+        if mode not in REGEN_MODES:
+            raise ValueError(f"Unknown regeneration mode {mode}")
+        self.mode = mode
+        # in repair mode, change at least this many slots (but still as few as possible past it)
+        self.target_changes = target_changes
+        self.time_limit_ms = time_limit_ms
+        # the most the whole solve can take (the time left in the solver pool), caps either time limit
+        self.max_time_ms = max_time_ms
+        # optional ProgressChannel, gets events as the solve goes on and can cancel the search
+        self.progress = progress
 
-        # user_expertise and shift_expertise are dictionaries mapping user_id and shift_id to their respective expertise
-        self.user_expertise = defaultdict(list)
-        for ue in user_expertise:
-            self.user_expertise[ue['user_id']].append(ue['expertise_id'])
-
-        self.shift_expertise = defaultdict(list)
-        for se in shift_expertise:
-            self.shift_expertise[se['shift_id']].append(se['expertise_id'])
-
-        self.shift_time_range = {}
-        
-        for shift in self.shift_details:
-            shift_id = shift['id']
-            start = shift['start']
-            end = shift['end']
-            # Converting to datetime if its a string or combining if already datetime.time
-            start = datetime.strptime(start, "%H:%M") if isinstance(start, str) else datetime.combine(datetime.today(), start)
-            end = datetime.strptime(end, "%H:%M") if isinstance(end, str) else datetime.combine(datetime.today(), end)
-            # Adjustment for overnight shifts
-            if end <= start:
-                # adding the day by one if its overnight
-                end += timedelta(days=1)
-            self.shift_time_range[shift_id] = (start, end)
-            
-        # Calculating how long each shift lasts (in hours)
-        self.shift_duration = {
-            sid: (end - start).total_seconds() / 3600.0
-            for sid, (start, end) in self.shift_time_range.items()
+        # indexing the original and locked users by (shift_id, day_id, slot) so each slot is one lookup
+        self.original_by_key = {
+            (a['shift_id'], a['day_id'], a['slot']): a['user_id'] for a in self.original_assignments
         }
+        self.locked_by_key = {
+            (a['shift_id'], a['day_id'], a['slot']): a['user_id'] for a in self.locked_assignments
+        }
+        # days each user worked in the original roster
+        self.original_days = defaultdict(set)
+        for (_, day_id, _), user in self.original_by_key.items():
+            self.original_days[user].add(day_id)
+
+        # shuffling the users so a regenerated roster doesnt keep handing slots to the same people
+        random.shuffle(self.users)
 
-        self.unavailable_map = defaultdict(set)
-        for ua in self.user_availability:
-            self.unavailable_map[ua['user_id']].add(ua['day_id'])
+        # dense integer form of the problem, expertise as bitmasks, days off as a users x days
+        # matrix and shift times in whole minutes, built after the shuffle so domains follow it
+        self.index = ProblemIndex(self.users, self.shifts, self.shift_details, self.user_availability, user_expertise, shift_expertise)
+        # how long each shift lasts (in hours)
+        self.shift_duration = self.index.shift_hours
 
-        # creating a new problem instance
-        self.problem = Problem()
-        # to hold all variable keys for the csp
-        self.shift_keys = set()  # Changed to a set to ensure uniqueness
+        # creating a new problem instance, repairs try the original user first for every slot
+        value_order = self._original_first if mode == "repair" else self._changes_first
+        on_check = self._on_check if progress is not None else None
+        self.search = TimedBacktrackingSolver(value_order=value_order, on_check=on_check)
+        # random order between otherwise equal users, redrawn on every restart
+        self._tie_break = {}
+        self.problem = Problem(self.search)
+        # variable keys for the csp without duplicates, sorted by day and start time
+        self.shift_keys = list(self.index.keys)
         # maps each shift key to original shift dictionary
-        self.shift_map = {}  
-        # loop to build the shift keys and maps to shift
+        self.shift_map = {}
         for shift in self.shifts:
-            sid, day, slot = shift['shift_id'], shift['day_id'], shift['slot']
-            key = (sid, day, slot)
-            if key not in self.shift_keys:
-                self.shift_keys.add(key)  # Ensures no duplicate keys
-                self.shift_map[key] = shift
-
-        # sorting the shift key by day and start_time
-        self.shift_keys = sorted(self.shift_keys, key=lambda x: (x[1], self.shift_time_range[x[0]][0]))
+            self.shift_map.setdefault((shift['shift_id'], shift['day_id'], shift['slot']), shift)
 
-        # Assign valid users for each shift variable
-        for key in self.shift_keys:
-            sid, day, slot = key
-            duration = self.shift_duration[sid]
-            required_exp = set(self.shift_expertise[sid])
-            valid_users = []
-            # loop through users and check if the user is unavailable that day
-            for user in self.users:
-                if day in self.unavailable_map[user]:
-                    continue
-                # checking if the shift needs expertise
-                if required_exp and not any(e in self.user_expertise[user] for e in required_exp):
-                    continue
-                # appending valid users
-                valid_users.append(user)
+        # Assign valid users for each shift variable, locked slots keep their user
+        self.domains = {
+            key: [self.locked_by_key[key]] if key in self.locked_by_key else valid_users
+            for key, valid_users in self.index.domains().items()
+        }
+        # checking for obvious reasons there is no roster (like a slot nobody can work any more)
+        # before building the search at all
+        self.diagnosis = diagnose(self.domains, self.max_days_per_user)
+        if self.diagnosis:
+            return
+        for key, valid_users in self.domains.items():
             # adding the valid users as domains
             self.problem.addVariable(key, valid_users)
 
-        # Add variables to the problem
-        self._initialize_variables()
-
         # Add constraints
         self._add_constraints()
+        if self.progress is not None:
+            self.progress.emit(
+                "model_built", force=True, slots=len(self.shift_keys), users=len(self.users),
+                build_ms=round((timer.perf_counter() - build_started) * 1000, 1),
+            )
 
-    def _initialize_variables(self):
-    # looping through each shift to add it as a variable in the problem instance
-        for shift in self.shifts:
-            key = (shift['shift_id'], shift['day_id'], shift['slot'])
-            locked = shift.get('locked', False)
-            
-            # Skip if the variable for this shift already exists
-            if key in self.problem._variables:
-                continue  # If the shift key is already in the CSP, skip it
-            
-            # if the shift is locked, we find the user assigned to it and add it as a variable
-            if locked:
-                # finding the user assigned to the locked shift
-                # using next to find the first matching assignment in locked_assignments 
-                user = next((a['user_id'] for a in self.locked_assignments 
-                            if a['shift_id'] == shift['shift_id'] and 
-                                a['day_id'] == shift['day_id'] and 
-                                a['slot'] == shift['slot']), None)
-                if user is not None:
-                    # directly assign the user to the shift if locked
-                    self.problem.addVariable(key, [user])  # Locked shifts get only one possible user
-            else:
-                possible_users = [
-                    u for u in self.users
-                    if not any(u == ua['user_id'] and shift['day_id'] == ua['day_id'] 
-                            for ua in self.user_availability)
-                ]
-                # adding the variable with all possible users as values
-                self.problem.addVariable(key, possible_users)
+    def _on_check(self, search):
+        # reporting how far the search got, and stopping it if the solve was cancelled
+        self.progress.emit("searching", nodes=search.nodes, slots_filled=len(search.best_partial), slots=len(self.shift_keys))
+        return self.progress.cancelled()
+
+    def _report_solution(self, solution):
+        # the objective is the number of changed slots, lower for a repair and higher for a different roster
+        if self.progress is not None:
+            self.progress.emit(
+                "solution_found", force=True, nodes=self.search.nodes, slots_filled=len(solution),
+                slots=len(self.shift_keys), best_objective=self._count_changes(solution),
+            )
 
+    def _cancelled_result(self):
+        return {
+            "assignments": [],
+            "total_solutions": 0,
+            "changed_count": 0,
+            "fallback_count": 0,
+            "skipped_count": 0,
+            "skipped_assignments": [],
+            "cancelled": True,
+            "failure_reasons": ["Solve cancelled before a roster was found"],
+        }
 
     def _add_constraints(self):
-        # user must match required expertise
-        def expertise_match(shift_key, user):
-            # getting the required expertise
-            required = self.shift_expertise.get(shift_key[0], [])
-            # getting the user expertise
-            user_exps = self.user_expertise.get(user, [])
-            # checking if they match
-            return not required or any(exp in user_exps for exp in required)
-
-        # applying the constraint to each shift
+        # user must match required expertise, a single and of the two bitmasks
         for shift_key in self.shift_keys:
-            self.problem.addConstraint(lambda user, sk=shift_key: expertise_match(sk, user), (shift_key,))
+            self.problem.addConstraint(lambda user, sid=shift_key[0]: self.index.qualified(user, sid), (shift_key,))
 
         # constraint to stop users working double shifts or a day shift after night shift
-        for i in range(len(self.shift_keys)):
-            key1 = self.shift_keys[i]
-            id1, day1, _ = key1
-            for j in range(i + 1, len(self.shift_keys)):
-                key2 = self.shift_keys[j]
-                id2, day2, _ = key2
-
-                if day2 != day1 + 1:
-                    continue
-                s1_start, s1_end = self.shift_time_range[id1]
-                s2_start, s2_end = self.shift_time_range[id2]
-
-                s1_start += timedelta(days=day1)
-                s1_end += timedelta(days=day1)
-                s2_start += timedelta(days=day2)
-                s2_end += timedelta(days=day2)
-
-                def no_conflict(u1, u2, s1=s1_start, e1=s1_end, s2=s2_start, e2=s2_end):
-                    if u1 != u2:
-                        return True
-                    gap = timedelta(hours=11)
-                    return e1 + gap <= s2 or e2 + gap <= s1
-
-                self.problem.addConstraint(no_conflict, (key1, key2))
+        # the clashing shift pairs are worked out once in minutes, then each clashing pair of
+        # shifts on consecutive days becomes one all different constraint over their slots
+        conflict_table = build_rest_conflict_table(self.index.shift_minutes)
+        for group in rest_conflict_groups(self.shift_keys, conflict_table):
+            self.problem.addConstraint(AllDifferentConstraint(), group)
 
         daily_keys = defaultdict(list)
         for key in self.shift_keys:
             daily_keys[key[1]].append(key)
 
+        # one all different constraint per day instead of one per pair of slots
         for day, keys in daily_keys.items():
-            for i in range(len(keys)):
-                for j in range(i + 1, len(keys)):
-                    self.problem.addConstraint(lambda u1, u2: u1 != u2, (keys[i], keys[j]))
+            self.problem.addConstraint(DayAllDifferentConstraint(), keys)
 
-        self.problem.addConstraint(self._max_day_constraint, self.shift_keys)
-
-    def _max_day_constraint(self, *users):
-        user_day_count = defaultdict(set)
-        for i, user in enumerate(users):
-            _, day, _ = self.shift_keys[i]
-            user_day_count[user].add(day)
-        return all(len(days) <= self.max_days_per_user for days in user_day_count.values())
+        day_of = {key: key[1] for key in self.shift_keys}
+        self.problem.addConstraint(MaxDaysConstraint(self.max_days_per_user, day_of), self.shift_keys)
 
     def solve(self):
-        solutions = self.problem.getSolutionIter()
-        limited_solutions = list(islice(solutions, 5))
+        # failing straight away with the reasons found before the search
+        if self.diagnosis:
+            return dict(diagnosis_result(self.diagnosis), changed_count=0, fallback_count=0, skipped_count=0, skipped_assignments=[])
+        if self.mode == "repair":
+            return self._repair()
+        time_limit_ms = self._time_limit_ms(REGEN_TIME_LIMIT_MS)
+        deadline = timer.perf_counter() + time_limit_ms / 1000.0
+        limited_solutions = []
+        while not limited_solutions:
+            remaining_ms = (deadline - timer.perf_counter()) * 1000
+            if remaining_ms <= 0:
+                break
+            self._tie_break = {user: random.random() for user in self.users}
+            self.search.time_limit_ms = min(REGEN_RESTART_MS, remaining_ms)
+            solutions = self.problem.getSolutionIter()
+            limited_solutions = list(islice(solutions, 5))
+            # the search finished without running out of time so there is no roster at all
+            if not self.search.timed_out:
+                break
 
+        for sol in limited_solutions:
+            self._report_solution(sol)
+        if self.search.cancelled and not limited_solutions:
+            return self._cancelled_result()
         if not limited_solutions:
+            reason = "No valid shift assignments found"
+            if self.search.timed_out:
+                reason = f"Time limit of {time_limit_ms} ms reached before a new roster was found"
             return {
                 "assignments": [],
                 "total_solutions": 0,
@@ -193,26 +189,14 @@ class RegenerateCSP:
                 "fallback_count": 0,
                 "skipped_count": 0,
                 "skipped_assignments": [],
-                "failure_reasons": ["No valid shift assignments found"]
+                "failure_reasons": [reason]
             }
 
         best_solution = None
         max_changes = -1
 
         for sol in limited_solutions:
-            changes = 0
-            for (shift_id, day_id, slot), user in sol.items():
-                locked = any(
-                    a['shift_id'] == shift_id and a['day_id'] == day_id and a['slot'] == slot and a['user_id'] == user
-                    for a in self.locked_assignments
-                )
-                if locked:
-                    continue
-                orig = next((a for a in self.original_assignments if 
-                            a['shift_id'] == shift_id and a['day_id'] == day_id and a['slot'] == slot), None)
-                if orig and user != orig['user_id']:
-                    changes += 1
-            
+            changes = self._count_changes(sol)
             if not self._is_same_as_original(sol):
                 if changes > max_changes:
                     best_solution = sol
@@ -229,16 +213,113 @@ class RegenerateCSP:
                 "failure_reasons": ["All solutions matched original (no change)"]
             }
 
+        result = self._format_result(best_solution, len(limited_solutions))
+        result["message"] = "New solution generated (best of 5 with max changes)"
+        if self.search.cancelled:
+            result["cancelled"] = True
+        return result
+
+    def _time_limit_ms(self, default_ms):
+        # the requested time limit (or the modes default), never past max_time_ms
+        time_limit_ms = self.time_limit_ms or default_ms
+        if self.max_time_ms is not None:
+            time_limit_ms = min(time_limit_ms, self.max_time_ms)
+        return time_limit_ms
+
+    def _is_same_as_original(self, solution_dict):
+        for key, user in self.original_by_key.items():
+            if solution_dict.get(key) != user:
+                return False
+        return True
+
+    def _changes_first(self, key, users, assignments):
+        # trying anyone but the original user first, the users with the fewest shifts so far
+        # before the rest, and a random order between users that are otherwise equal
+        original = self.original_by_key.get(key)
+        load = Counter(assignments.values())
+        return sorted(users, key=lambda user: (user != original, -load[user], self._tie_break.get(user, 0)))
+
+    def _original_first(self, key, users, assignments):
+        # the search tries the last value first, so the original user goes at the end and
+        # just before them the users who were off that day, as moving them breaks nothing else
+        original = self.original_by_key.get(key)
+        day = key[1]
+        return sorted(users, key=lambda user: (user == original, day not in self.original_days[user]))
+
+    def _count_changes(self, solution):
+        return sum(
+            1 for key, user in solution.items()
+            if key not in self.locked_by_key and self.original_by_key.get(key) != user
+        )
+
+    def _repair(self):
+        # branch and bound on the number of changed slots: every roster found sets a lower
+        # limit for the next search, until no roster with fewer changes exists or the time is up
+        original = {key: self.original_by_key.get(key) for key in self.shift_keys}
+        budget = MaxChangesConstraint(original)
+        self.problem.addConstraint(budget, self.shift_keys)
+        lower_bound = 0
+        if self.target_changes:
+            target = min(self.target_changes, len(self.shift_keys))
+            self.problem.addConstraint(HammingDistanceConstraint(original, target), self.shift_keys)
+            lower_bound = target
+        # slots whose original user cant work them any more have to change whatever happens
+        forced = sum(1 for key in self.shift_keys if original[key] not in self.problem._variables[key])
+        lower_bound = max(lower_bound, forced)
+
+        time_limit_ms = self._time_limit_ms(REPAIR_TIME_LIMIT_MS)
+        deadline = timer.perf_counter() + time_limit_ms / 1000.0
+        best = None
+        searches = 0
+        while True:
+            remaining_ms = (deadline - timer.perf_counter()) * 1000
+            if remaining_ms <= 0:
+                break
+            self.search.time_limit_ms = remaining_ms
+            solution = self.problem.getSolution()
+            searches += 1
+            if not solution:
+                break
+            best = solution
+            self._report_solution(solution)
+            changes = self._count_changes(solution)
+            # nothing can do better then the slots that are forced to change
+            if changes <= lower_bound:
+                break
+            budget.max_changes = changes - 1
+
+        if not best and self.search.cancelled:
+            return self._cancelled_result()
+        if not best:
+            reason = "No valid shift assignments found"
+            if self.search.timed_out:
+                reason = f"Time limit of {time_limit_ms} ms reached before a repaired roster was found"
+            return {
+                "assignments": [],
+                "total_solutions": 0,
+                "changed_count": 0,
+                "fallback_count": 0,
+                "skipped_count": 0,
+                "skipped_assignments": [],
+                "failure_reasons": [reason]
+            }
+
+        result = self._format_result(best, searches)
+        result["message"] = f"Roster repaired with {result['changed_count']} changes"
+        if self.search.timed_out:
+            result["message"] += " (time limit reached, fewer changes may be possible)"
+        if self.search.cancelled:
+            result["cancelled"] = True
+            result["message"] += " (cancelled, fewer changes may be possible)"
+        return result
+
+    def _format_result(self, solution, total_solutions):
         formatted = []
         changed_count = 0
-        for (shift_id, day_id, slot), user in best_solution.items():
-            locked = any(
-                a['shift_id'] == shift_id and a['day_id'] == day_id and a['slot'] == slot and a['user_id'] == user
-                for a in self.locked_assignments
-            )
-            orig = next((a for a in self.original_assignments if 
-                        a['shift_id'] == shift_id and a['day_id'] == day_id and a['slot'] == slot), None)
-            if orig and user != orig['user_id'] and not locked:
+        for key, user in solution.items():
+            shift_id, day_id, slot = key
+            locked = self.locked_by_key.get(key) == user
+            if not locked and self.original_by_key.get(key) != user:
                 changed_count += 1
             formatted.append({
                 "user_id": user,
@@ -247,23 +328,13 @@ class RegenerateCSP:
                 "slot": slot,
                 "locked": locked
             })
-
         formatted.sort(key=lambda x: (x["day_id"], x["shift_id"], x["slot"]))
-
         return {
             "assignments": formatted,
-            "total_solutions": len(limited_solutions),
+            "total_solutions": total_solutions,
             "changed_count": changed_count,
             "fallback_count": 0,
             "skipped_count": 0,
             "skipped_assignments": [],
             "failure_reasons": [],
-            "message": "New solution generated (best of 5 with max changes)"
         }
-
-    def _is_same_as_original(self, solution_dict):
-        for orig in self.original_assignments:
-            key = (orig['shift_id'], orig['day_id'], orig['slot'])
-            if solution_dict.get(key) != orig['user_id']:
-                return False
-        return True
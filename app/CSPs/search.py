@@ -0,0 +1,145 @@
+# backtracking search for python-constraint problems that can stop at a time limit
+from constraint import BacktrackingSolver
+import time
+
+
+class TimedBacktrackingSolver(BacktrackingSolver):
+    # Same search as python-constraint's BacktrackingSolver, with these changes:
+    # - it stops once time_limit_ms has passed (checked every few nodes to keep it cheap)
+    # - it remembers the largest partial assignment it reached, so a timed out solve
+    #   can still hand back the best roster found so far
+    # - the slot with the fewest users left goes first and the degree only breaks ties, the first
+    #   and last day have fewer rest gap constraints so the degree alone left them for the end even
+    #   when last weeks roster had taken most of their users
+    # value_order(variable, values, assignments) can reorder a variables values before they are
+    # tried, the last value in the returned list is tried first
+    # on_check(search) is called along with the time check, for progress reports, and returning
+    # True from it stops the search straight away (a cancel)
+    def __init__(self, time_limit_ms=None, forwardcheck=True, check_every=64, value_order=None, on_check=None):
+        super().__init__(forwardcheck=forwardcheck)
+        self.time_limit_ms = time_limit_ms
+        self.check_every = check_every
+        self.value_order = value_order
+        self.on_check = on_check
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.nodes = 0
+        self.timed_out = False
+        self.cancelled = False
+        self.best_partial = {}
+
+    def _should_stop(self, deadline):
+        if self.nodes % self.check_every:
+            return False
+        if self.on_check is not None and self.on_check(self):
+            self.cancelled = True
+            return True
+        if deadline is not None and time.perf_counter() >= deadline:
+            self.timed_out = True
+            return True
+        return False
+
+    def getSolutionIter(self, domains, constraints, vconstraints):
+        self._reset_stats()
+        # a constraint that already knows there is no solution (like a day that cant be covered)
+        # ends the search before it starts
+        if any(getattr(constraint, "infeasible", False) for constraint, _ in constraints):
+            return
+        deadline = None
+        if self.time_limit_ms is not None:
+            deadline = time.perf_counter() + self.time_limit_ms / 1000.0
+        forwardcheck = self._forwardcheck
+        assignments = {}
+
+        queue = []
+
+        while True:
+
+            # Minimum Remaing Values (MRV) first, then the Degree heuristic
+            lst = [
+                (len(domains[variable]), -len(vconstraints[variable]), variable)
+                for variable in domains
+            ]
+            lst.sort()
+            for item in lst:
+                if item[-1] not in assignments:
+                    # Found unassigned variable
+                    variable = item[-1]
+                    values = domains[variable][:]
+                    if self.value_order:
+                        values = self.value_order(variable, values, assignments)
+                    if forwardcheck:
+                        pushdomains = [
+                            domains[x]
+                            for x in domains
+                            if x not in assignments and x != variable
+                        ]
+                    else:
+                        pushdomains = None
+                    break
+            else:
+                # No unassigned variables. We've got a solution. Go back
+                # to last variable, if there's one.
+                yield assignments.copy()
+                if not queue:
+                    return
+                variable, values, pushdomains = queue.pop()
+                if pushdomains:
+                    for domain in pushdomains:
+                        domain.popState()
+
+            while True:
+                # We have a variable. Do we have any values left?
+                if not values:
+                    # No. Go back to last variable, if there's one.
+                    del assignments[variable]
+                    while queue:
+                        variable, values, pushdomains = queue.pop()
+                        if pushdomains:
+                            for domain in pushdomains:
+                                domain.popState()
+                        if values:
+                            break
+                        del assignments[variable]
+                    else:
+                        return
+
+                # stopping the search once the time budget is used up (or it was cancelled)
+                self.nodes += 1
+                if self._should_stop(deadline):
+                    self._restore(domains)
+                    return
+
+                # Got a value. Check it.
+                assignments[variable] = values.pop()
+
+                if pushdomains:
+                    for domain in pushdomains:
+                        domain.pushState()
+
+                for constraint, variables in vconstraints[variable]:
+                    if not constraint(variables, domains, assignments, pushdomains):
+                        # Value is not good.
+                        break
+                else:
+                    break
+
+                if pushdomains:
+                    for domain in pushdomains:
+                        domain.popState()
+
+            # keeping the deepest consistent assignment seen so far
+            if len(assignments) > len(self.best_partial):
+                self.best_partial = assignments.copy()
+
+            # Push state before looking for next variable.
+            queue.append((variable, values, pushdomains))
+
+        raise RuntimeError("Can't happen")
+
+    @staticmethod
+    def _restore(domains):
+        # putting back every value hidden by forward checking so the problem can be searched again
+        for domain in domains.values():
+            domain.resetState()
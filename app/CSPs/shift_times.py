@@ -0,0 +1,59 @@
+# shared shift time handling for the solvers, everything is kept as whole minutes
+from datetime import datetime
+from collections import defaultdict
+
+# minimum rest between two shifts worked by the same user (in minutes)
+REST_GAP_MINUTES = 11 * 60
+MINUTES_PER_DAY = 24 * 60
+
+
+# converting "HH:MM" strings or datetime.time objects to minutes from midnight
+def to_minutes(value):
+    if isinstance(value, str):
+        value = datetime.strptime(value, "%H:%M").time()
+    return value.hour * 60 + value.minute
+
+
+# mapping each shift id to its (start, end) minutes, overnight shifts end past midnight
+def build_shift_minutes(shift_details):
+    shift_minutes = {}
+    for shift in shift_details:
+        start = to_minutes(shift['start'])
+        end = to_minutes(shift['end'])
+        # Adjustment for overnight shifts
+        if end <= start:
+            end += MINUTES_PER_DAY
+        shift_minutes[shift['id']] = (start, end)
+    return shift_minutes
+
+
+# working out once which shift on one day cant be followed by which shift on the next day
+# returns {(shift_id on day d, shift_id on day d + 1): True} for every pair breaking the rest gap
+def build_rest_conflict_table(shift_minutes):
+    table = {}
+    for sid1, (s1, e1) in shift_minutes.items():
+        for sid2, (s2, e2) in shift_minutes.items():
+            # the second shift is a day later
+            s2_next, e2_next = s2 + MINUTES_PER_DAY, e2 + MINUTES_PER_DAY
+            if not (e1 + REST_GAP_MINUTES <= s2_next or e2_next + REST_GAP_MINUTES <= s1):
+                table[sid1, sid2] = True
+    return table
+
+
+# grouping the shift keys into sets where no user can appear twice because of the rest gap
+# each group is every slot of a shift on one day plus every slot of a clashing shift the next day
+def rest_conflict_groups(shift_keys, conflict_table):
+    keys_by_shift_day = defaultdict(list)
+    shifts_by_day = defaultdict(list)
+    for key in shift_keys:
+        if (key[0], key[1]) not in keys_by_shift_day:
+            shifts_by_day[key[1]].append(key[0])
+        keys_by_shift_day[key[0], key[1]].append(key)
+
+    groups = []
+    for (sid1, day1), keys1 in keys_by_shift_day.items():
+        # only the following day can clash
+        for sid2 in shifts_by_day.get(day1 + 1, []):
+            if conflict_table.get((sid1, sid2)):
+                groups.append(keys1 + keys_by_shift_day[sid2, day1 + 1])
+    return groups
@@ -1,7 +1,18 @@
 # importing csp solver tools
 from constraint import *
-# for time handling
-from datetime import datetime, timedelta
+from app.CSPs.constraints import MaxDaysConstraint, DayAllDifferentConstraint, HammingDistanceConstraint, min_roster_distance, under_day_limit
+from app.CSPs.shift_times import build_rest_conflict_table, rest_conflict_groups
+from app.CSPs.problem_index import ProblemIndex
+from app.CSPs.search import TimedBacktrackingSolver
+from app.CSPs.fairness import OBJECTIVES, resolve_weights, fairness_report, is_night, is_weekend
+from app.CSPs.decompose import connected_components, PARALLEL_COMPONENTS
+from app.CSPs.diagnosis import diagnose, diagnosis_result
+from app.CSPs.local_search import improve_roster
+# for solving independent parts of the team in parallel
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import os
+import time
 # for default dictionary behaviour
 from collections import defaultdict
 # for shuffling users different solution each time
@@ -9,167 +20,349 @@ import random
 
 class ShiftAssignmentSolver:
     # construcing the solver with relevant variables needed for the solving
-    def __init__(self, users, shifts, shift_details, user_availability, user_expertise, shift_expertise, max_days_per_user=5):
+    def __init__(self, users, shifts, shift_details, user_availability, user_expertise, shift_expertise, max_days_per_user=5, time_limit_ms=None, count=1, min_difference=None, objective=None, weights=None, decompose=True, parallel=None, hint=None, improve_ms=None, fixed_assignments=None, progress=None, max_time_ms=None):
+        build_started = time.perf_counter()
         self.users = users
         self.shifts = shifts
         self.shift_details = shift_details
         self.user_availability = user_availability
         # added this to make sure no user is working more then 5 days
         self.max_days_per_user = max_days_per_user
+        # optional time budget, once its used up the best partial roster is returned
+        # max_time_ms is the most the whole solve can take (the time left in the solver pool),
+        # the search and the local search both have to fit in it
+        self.max_deadline = None
+        if max_time_ms is not None:
+            time_limit_ms = min(time_limit_ms or max_time_ms, max_time_ms)
+            self.max_deadline = build_started + max_time_ms / 1000.0
+        self.time_limit_ms = time_limit_ms
+        # how many different rosters to return, each differing in at least min_difference slots
+        self.count = count
+        self.min_difference = min_difference
+        # "fairness" spreads the hours, nights and weekends as evenly as it can
+        if objective is not None and objective not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective}")
+        self.objective = objective
+        self.weights = resolve_weights(weights)
+        # splitting the team into groups of users that never share a slot and solving each alone
+        self.decompose = decompose
+        self.parallel = PARALLEL_COMPONENTS if parallel is None else parallel
+        # a previous roster (like last weeks active one), its user for each slot is tried first
+        self.hint_assignments = hint or []
+        self.hint = {(a['shift_id'], a['day_id'], a['slot']): a['user_id'] for a in self.hint_assignments}
+        # optional time budget for a local search that improves the roster once it is found
+        self.improve_ms = improve_ms
+        self.improvement = None
+        # optional ProgressChannel, gets events as the solve goes on and can cancel the search
+        self.progress = progress
         # shuffling the users
         random.shuffle(self.users)
 
-        # mapping user expertise to a dictionary, to allow csp to access
-        self.user_expertise = defaultdict(list)
-        for ue in user_expertise:
-            self.user_expertise[ue['user_id']].append(ue['expertise_id'])
-            
-        # mapping shift_expertise to a dictionary, to allow csp to access
-        self.shift_expertise = defaultdict(list)
-        for se in shift_expertise:
-            self.shift_expertise[se['shift_id']].append(se['expertise_id'])
-        # looping through the shifts and converting start and end to datetime ranges
-        self.shift_time_range = {}
-        for shift in self.shift_details:
-            shift_id = shift['id']
-            start = shift['start']
-            end = shift['end']
-            # Converting to datetime if its a string or combining if already datetime.time
-            start = datetime.strptime(start, "%H:%M") if isinstance(start, str) else datetime.combine(datetime.today(), start)
-            end = datetime.strptime(end, "%H:%M") if isinstance(end, str) else datetime.combine(datetime.today(), end)
-            # Adjustment for overnight shifts
-            if end <= start:
-                # adding the day by one if its overnight
-                end += timedelta(days=1)
-            self.shift_time_range[shift_id] = (start, end)
-            
-         # Calculating how long each shift lasts (in hours)
-        self.shift_duration = {
-            # had to divide the seconds to get in hours
-            sid: (end - start).total_seconds() / 3600.0
-            for sid, (start, end) in self.shift_time_range.items()
-        }
-        
-        # Mapping user to a set of unavailable days
-        self.unavailable_map = defaultdict(set)
-        for ua in self.user_availability:
-            self.unavailable_map[ua['user_id']].add(ua['day_id'])
-            
-        # initialising the csp problem
-        self.problem = Problem()
-        # to hold all variable keys for the csp
-        self.shift_keys = []
+        # the raw expertise rows, kept for splitting the problem into components
+        self.user_expertise = user_expertise
+        self.shift_expertise = shift_expertise
+        # dense integer form of the problem, expertise as bitmasks, days off as a users x days
+        # matrix and shift times in whole minutes, built after the shuffle so domains follow it
+        self.index = ProblemIndex(self.users, self.shifts, self.shift_details, self.user_availability, user_expertise, shift_expertise)
+        # the shift times in whole minutes, shared with the rest gap and fairness helpers
+        self.shift_minutes = self.index.shift_minutes
+        # how long each shift lasts (in hours)
+        self.shift_duration = self.index.shift_hours
+
+        # initialising the csp problem with a search that can stop at the time limit
+        # when optimizing for fairness the least loaded user is tried first for every slot,
+        # and with a hint the previous user goes before anyone else
+        value_order = self._order_values if self.objective == "fairness" or self.hint else None
+        on_check = self._on_check if progress is not None else None
+        self.search = TimedBacktrackingSolver(time_limit_ms, value_order=value_order, on_check=on_check)
+        self.problem = Problem(self.search)
+        # variable keys for the csp, sorted by day and start time
+        self.shift_keys = list(self.index.keys)
+        # assignments already worked before the horizon (like last weeks active roster, on days
+        # 0 and below) kept as fixed context, so the rest gap and the day limit see them
+        self.fixed_assignments = fixed_assignments or []
+        self.fixed = self.index.fixed_context(self.fixed_assignments)
         # maps each shift key to original shift dictionary
-        self.shift_map = {}  
-        # loop to build the shift keys and maps to shift
+        self.shift_map = {}
         for shift in self.shifts:
-            sid, day, slot = shift['shift_id'], shift['day_id'], shift['slot']
-            key = (sid, day, slot)
-            self.shift_keys.append(key)
-            self.shift_map[key] = shift
-            
-        # sorting the shift key by day and start_time
-        self.shift_keys.sort(key=lambda x: (x[1], self.shift_time_range[x[0]][0]))
-        # assigning valid users for each shift variable
+            self.shift_map[shift['shift_id'], shift['day_id'], shift['slot']] = shift
+        # assigning valid users for each shift variable, less anyone the fixed context rules out
+        self.domains = self.index.context_domains(self.index.domains(), self.fixed, self.max_days_per_user)
+        # checking for obvious reasons there is no roster before building the search at all
+        self.diagnosis = diagnose(self.domains, self.max_days_per_user)
+        if self.diagnosis:
+            return
         for key in self.shift_keys:
-            sid, day, slot = key
-            duration = self.shift_duration[sid]
-            required_exp = set(self.shift_expertise[sid])
-            valid_users = []
-            # loop through users and check if the user is unavailable that day
-            for user in self.users:
-                if day in self.unavailable_map[user]:
-                    continue
-                # checking if the shift needs expertise
-                if required_exp and not any(e in self.user_expertise[user] for e in required_exp):
-                    continue
-                # appending valid users
-                valid_users.append(user)
             # adding the valid users as domains
-            self.problem.addVariable(key, valid_users)
+            self.problem.addVariable(key, self.domains[key])
         # adding all constraints
         self._add_constraints()
+        if self.progress is not None:
+            self.progress.emit(
+                "model_built", force=True, slots=len(self.shift_keys), users=len(self.users),
+                build_ms=round((time.perf_counter() - build_started) * 1000, 1),
+            )
+
+    def _on_check(self, search):
+        # reporting how far the search got, and stopping it if the solve was cancelled
+        self.progress.emit("searching", nodes=search.nodes, slots_filled=len(search.best_partial), slots=len(self.shift_keys))
+        return self.progress.cancelled()
 
     def _add_constraints(self):
-        # user must match required expertise
-        def expertise_match(shift_key, user):
-            # getting the required expertise
-            required = self.shift_expertise.get(shift_key[0], [])
-            # getting the user expertise
-            user_exps = self.user_expertise.get(user, [])
-            # checking if they match
-            return not required or any(exp in user_exps for exp in required)
-        # applying the constraint to each shift
+        # user must match required expertise, a single and of the two bitmasks
         for shift_key in self.shift_keys:
-            self.problem.addConstraint(lambda user, sk=shift_key: expertise_match(sk, user), (shift_key,))
+            self.problem.addConstraint(lambda user, sid=shift_key[0]: self.index.qualified(user, sid), (shift_key,))
 
         # constraint to stop users working double shifts or a day shift after night shift
-        for i in range(len(self.shift_keys)):
-            key1 = self.shift_keys[i]
-            id1, day1, _ = key1
-            for j in range(i + 1, len(self.shift_keys)):
-                key2 = self.shift_keys[j]
-                id2, day2, _ = key2
-
-                # only comparing days that are the day after
-                # keeps from checking reduant shifts on other days
-                if day2 != day1 + 1:
-                    continue
-                # getting the start date/time for comparison
-                s1_start, s1_end = self.shift_time_range[id1]
-                s2_start, s2_end = self.shift_time_range[id2]
-
-                s1_start += timedelta(days=day1)
-                s1_end += timedelta(days=day1)
-                s2_start += timedelta(days=day2)
-                s2_end += timedelta(days=day2)
-
-                def no_conflict(u1, u2, s1=s1_start, e1=s1_end, s2=s2_start, e2=s2_end):
-                    # if its two seperate users it will return true and assign
-                    if u1 != u2:
-                        return True
-                    gap = timedelta(hours=11)
-                    # must the gap between the end of the shift on day 1 must  be more then 11 hours legal amount
-                    return e1 + gap <= s2 or e2 + gap <= s1
-                
-                # adding the constraint
-                self.problem.addConstraint(no_conflict, (key1, key2))
+        # the clashing shift pairs are worked out once in minutes, then each clashing pair of
+        # shifts on consecutive days becomes one all different constraint over their slots
+        # (the fixed context was already taken off the domains it clashes with)
+        self.conflict_table = build_rest_conflict_table(self.shift_minutes)
+        for group in rest_conflict_groups(self.shift_keys, self.conflict_table):
+            self.problem.addConstraint(AllDifferentConstraint(), group)
         # constraint to check there was no double bookings on the same day
         # as in a user can only work one shift a day
         daily_keys = defaultdict(list)
         for key in self.shift_keys:
             daily_keys[key[1]].append(key)
 
+        # one all different constraint per day instead of one per pair of slots,
+        # it also checks before searching that every slot on the day can get its own user
         for day, keys in daily_keys.items():
-            for i in range(len(keys)):
-                for j in range(i + 1, len(keys)):
-                    self.problem.addConstraint(lambda u1, u2: u1 != u2, (keys[i], keys[j]))
-
-        # adding constraint to the problem
-        self.problem.addConstraint(self._max_day_constraint, self.shift_keys)
-    # this constrint makes sure a single user can only work a certain amount of days to ensure equal distribution
-    def _max_day_constraint(self, *users):
-        # Counting how many unique days each user is assigned
-        user_day_count = defaultdict(set)
-        for i, user in enumerate(users):
-            _, day, _ = self.shift_keys[i]
-            user_day_count[user].add(day)
-            # returning true only if all users are within the day limit
-        return all(len(days) <= self.max_days_per_user for days in user_day_count.values())
+            self.problem.addConstraint(DayAllDifferentConstraint(), keys)
+
+        # this constrint makes sure a single user can only work a certain amount of days to ensure equal distribution
+        # it counts the days as the solver goes so a user over the limit is caught straight away
+        # over several weeks it is any 7 days in a row, the days worked in the fixed context count from the start
+        fixed_days = defaultdict(set)
+        for (_, day, _), user in self.fixed.items():
+            fixed_days[user].add(day)
+        day_of = {key: key[1] for key in self.shift_keys}
+        self.problem.addConstraint(MaxDaysConstraint(self.max_days_per_user, day_of, fixed_days), self.shift_keys)
 
     def solve(self):
+        # failing straight away with the reasons found before the search
+        if self.diagnosis:
+            return diagnosis_result(self.diagnosis)
+        # teams with separate pools of users (like nurses and porters) are solved one part at a time
+        if self.decompose and self.count == 1:
+            components = connected_components(self.shift_keys, self.problem._variables)
+            if len(components) > 1:
+                return self._solve_components(components)
+        # the time limit covers every roster asked for, not each one
+        deadline = None
+        if self.time_limit_ms is not None:
+            deadline = time.perf_counter() + self.time_limit_ms / 1000.0
         # trying to find only a single solution
         solution = self.problem.getSolution()
+        # if the time limit ran out (or the solve was cancelled) return the best partial roster found so far
+        if not solution and (self.search.timed_out or self.search.cancelled):
+            return self._partial_result(self.search.best_partial, self.search.cancelled)
         # if no solution provide return
         if not solution:
             print("No valid shift assignments found.")
             return {"assignments": [], "total_solutions": 0}
+        solutions = [solution]
+        self._report_solution(solution)
+        # finding more rosters if asked for, each one has to differ from every roster
+        # already found in enough slots (a hamming distance cut) so they are real alternatives
+        min_distance = min_roster_distance(len(self.shift_keys), self.min_difference)
+        while len(solutions) < self.count:
+            if deadline is not None:
+                remaining_ms = (deadline - time.perf_counter()) * 1000
+                if remaining_ms <= 0:
+                    break
+                self.search.time_limit_ms = remaining_ms
+            self.problem.addConstraint(HammingDistanceConstraint(dict(solution), min_distance), self.shift_keys)
+            solution = self.problem.getSolution()
+            if not solution:
+                break
+            solutions.append(solution)
+            self._report_solution(solution)
+
+        return self._format_solutions(self._improve(solutions))
+
+    def _report_solution(self, solution):
+        if self.progress is not None:
+            objective = fairness_report([solution], self.users, self.shift_minutes, self.weights)["objective_values"][0]
+            self.progress.emit("solution_found", force=True, nodes=self.search.nodes, slots_filled=len(solution), slots=len(self.shift_keys), best_objective=objective)
+
+    def _improve(self, solutions):
+        # a single roster gets the local search when asked for, several rosters are left alone
+        # as moving slots around could take them closer together then min_difference
+        if not self.improve_ms or len(solutions) != 1:
+            return solutions
+        improve_ms = self.improve_ms
+        if self.max_deadline is not None:
+            improve_ms = max(1, min(improve_ms, int((self.max_deadline - time.perf_counter()) * 1000)))
+        improved, self.improvement = improve_roster(
+            solutions[0], self.domains, self.users, self.shift_minutes, self.conflict_table,
+            self.max_days_per_user, self.weights, improve_ms, fixed=self.fixed, progress=self.progress,
+        )
+        # keeping the same key order as the search
+        return [{key: improved[key] for key in solutions[0]}]
+
+    def _format_solutions(self, solutions):
         # formating assignments
+        formatted = []
+        for solution in solutions:
+            assignments = [
+                {"user_id": user, "shift_id": sid, "day_id": day, "slot": slot}
+                for (sid, day, slot), user in solution.items()
+            ]
+            # sorting assignments by day_id
+            assignments.sort(key=lambda x: x["day_id"])
+            formatted.append(assignments)
+        result = {"assignments": formatted, "total_solutions": len(formatted)}
+        # adding how fair each roster is and the totals per user
+        result.update(fairness_report(solutions, self.users, self.shift_minutes, self.weights))
+        if self.improvement:
+            result["improvement"] = self.improvement
+        # a full roster can still come back after a cancel (like during the local search),
+        # the caller decides what to do with it
+        if self.progress is not None and self.progress.cancelled():
+            result["cancelled"] = True
+        # return
+        return result
+
+    def _component_kwargs(self, keys, users, time_limit_ms):
+        # the solver inputs for one component, only its own slots and users
+        user_set = set(users)
+        key_set = set(keys)
+        return {
+            "users": list(users),
+            "shifts": [self.shift_map[key] for key in keys],
+            "shift_details": self.shift_details,
+            "user_availability": [ua for ua in self.user_availability if ua['user_id'] in user_set],
+            "user_expertise": [ue for ue in self.user_expertise if ue['user_id'] in user_set],
+            "shift_expertise": self.shift_expertise,
+            "max_days_per_user": self.max_days_per_user,
+            "time_limit_ms": time_limit_ms,
+            "objective": self.objective,
+            "weights": self.weights,
+            "decompose": False,
+            "hint": [a for a in self.hint_assignments if (a['shift_id'], a['day_id'], a['slot']) in key_set],
+            "fixed_assignments": [a for a in self.fixed_assignments if a['user_id'] in user_set],
+            # each part reports its own search and stops on the same cancel
+            "progress": self.progress,
+        }
+
+    def _solve_components(self, components):
+        # each component is solved as its own problem, then the rosters are joined back together
+        if self.parallel:
+            jobs = [self._component_kwargs(keys, users, self.time_limit_ms) for keys, users in components]
+            workers = min(len(jobs), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+                results = list(pool.map(solve_component, jobs))
+        else:
+            # one after the other the components share the time limit
+            deadline = None
+            if self.time_limit_ms is not None:
+                deadline = time.perf_counter() + self.time_limit_ms / 1000.0
+            results = []
+            for keys, users in components:
+                time_limit_ms = None
+                if deadline is not None:
+                    time_limit_ms = max(1, (deadline - time.perf_counter()) * 1000)
+                results.append(solve_component(self._component_kwargs(keys, users, time_limit_ms)))
+
+        merged = {}
+        timed_out = False
+        cancelled = False
+        for result in results:
+            if not result["assignments"] and not result.get("timed_out") and not result.get("cancelled"):
+                # one part has no roster so the whole team has none
+                print("No valid shift assignments found.")
+                return {"assignments": [], "total_solutions": 0}
+            timed_out = timed_out or result.get("timed_out", False)
+            cancelled = cancelled or result.get("cancelled", False)
+            for assignment in (result["assignments"][0] if result["assignments"] else []):
+                merged[assignment["shift_id"], assignment["day_id"], assignment["slot"]] = assignment["user_id"]
+        if timed_out or cancelled:
+            return self._partial_result(merged, cancelled)
+        # keeping the same key order as a single solve
+        return self._format_solutions(self._improve([{key: merged[key] for key in self.shift_keys}]))
+
+    def _order_values(self, key, users, assignments):
+        if self.objective == "fairness":
+            users = self._least_loaded_first(key, users, assignments)
+        if self.hint:
+            # the search tries the last value first so the hinted user goes at the end
+            previous = self.hint.get(key)
+            users = sorted(users, key=lambda user: user == previous)
+        return users
+
+    def _least_loaded_first(self, key, users, assignments):
+        # ordering the users by how much they already work, weighted the same way as the objective
+        # only nights count towards a night slot and weekends towards a weekend slot
+        sid, day, _ = key
+        night = is_night(*self.shift_minutes[sid])
+        weekend = is_weekend(day)
+        load = defaultdict(float)
+        for (assigned_sid, assigned_day, _), user in assignments.items():
+            load[user] += self.weights["hours"] * self.shift_duration[assigned_sid]
+            if night and is_night(*self.shift_minutes[assigned_sid]):
+                load[user] += self.weights["nights"]
+            if weekend and is_weekend(assigned_day):
+                load[user] += self.weights["weekends"]
+        # the search tries the last value first so the least loaded user goes at the end
+        return sorted(users, key=lambda user: load[user], reverse=True)
+
+    def _partial_result(self, partial, cancelled=False):
+        # formating the slots that were filled before the time ran out or the solve was cancelled
         assignments = [
             {"user_id": user, "shift_id": sid, "day_id": day, "slot": slot}
-            for (sid, day, slot), user in solution.items()
+            for (sid, day, slot), user in partial.items()
         ]
-        # sorting assignments by day_id
         assignments.sort(key=lambda x: x["day_id"])
-        # return
-        return {"assignments": [assignments], "total_solutions": 1}
+
+        # listing every slot left empty with the reason it couldnt be filled
+        # the fixed context counts here as it can be why a user cant work
+        user_days = defaultdict(dict)
+        for (sid, day, slot), user in list(partial.items()) + list(self.fixed.items()):
+            user_days[user][day] = sid
+        skipped = []
+        for key in self.shift_keys:
+            if key in partial:
+                continue
+            sid, day, slot = key
+            skipped.append({"shift_id": sid, "day_id": day, "slot": slot, "reason": self._unfilled_reason(key, user_days, cancelled)})
+
+        result = {
+            "assignments": [assignments] if assignments else [],
+            "total_solutions": 0,
+            "timed_out": not cancelled,
+            "skipped_count": len(skipped),
+            "skipped_assignments": skipped,
+            "failure_reasons": sorted({s["reason"] for s in skipped}),
+            "message": f"Time limit of {self.time_limit_ms} ms reached, returning the best partial roster"
+        }
+        if cancelled:
+            result.update(cancelled=True, message="Solve cancelled, returning the best partial roster")
+        return result
+
+    def _unfilled_reason(self, key, user_days, cancelled=False):
+        sid, day, _ = key
+        candidates = self.problem._variables[key]
+        if not candidates:
+            return "No available user has the required expertise"
+        for user in candidates:
+            worked = user_days[user]
+            # already working that day
+            if day in worked:
+                continue
+            # would break the rest gap with the day before or after
+            if self.conflict_table.get((worked.get(day - 1), sid)) or self.conflict_table.get((sid, worked.get(day + 1))):
+                continue
+            # already at the day limit
+            if not under_day_limit(worked, day, self.max_days_per_user):
+                continue
+            if cancelled:
+                return "Solve cancelled before this slot could be filled"
+            return "Time limit reached before this slot could be filled"
+        return "Every qualified user is already working that day, resting after another shift or at the day limit"
+
+
+# top level so a component can be solved in another process
+def solve_component(kwargs):
+    return ShiftAssignmentSolver(**kwargs).solve()
@@ -1,120 +1,394 @@
 from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, union_all, literal, null
 from app.models import User, UserAvailability, Shift, Week, Solution, Assignment
+from app.enums import SolutionStatus
 from app.association import day_shift_team, user_expertise, shift_expertise
 from fastapi import HTTPException
 from collections import defaultdict
-def create_schedule(db: Session, team_id: int, week_id: int):
-    # checking if week exists
-    week = db.query(Week).filter(Week.id == week_id).first()
-    if not week:
-        raise HTTPException(status_code=404, detail="Week not found")
-    # Get all users in the team (filter by team_id)
-    users = db.query(User.id).filter(User.team_id == team_id).all()
-    # Convert the list of tuples into a simple list of user IDs
-    users = [user[0] for user in users] 
-    
-    # Get all day-shift pairs for the team (day_id, shift_id)
-    shifts = db.query(day_shift_team.c.day_id, day_shift_team.c.shift_id).filter(
-        day_shift_team.c.team_id == team_id
-    ).all()
-
-    # Get the availability of users (only approved availability entries)
-    user_availability = db.query(UserAvailability.user_id, UserAvailability.day_id).filter(
-        UserAvailability.team_id == team_id,
-        UserAvailability.approved == True
-    ).all()
-
-    # Get shift information
-    shift_details = db.query(
-        Shift.id, Shift.time_start, Shift.time_end, Shift.no_of_users
-    ).filter(Shift.team_id == team_id).all()
-
-    # Get expertise data
-    user_expertise_list = db.query(user_expertise.c.user_id, user_expertise.c.expertise_id).filter(
-        user_expertise.c.user_id.in_(users)
-    ).all()
-
-    shift_ids = [shift[0] for shift in shift_details]  # Extract shift IDs
-    shift_expertise_list = db.query(shift_expertise.c.shift_id, shift_expertise.c.expertise_id).filter(
-        shift_expertise.c.shift_id.in_(shift_ids)
-    ).all()
+from dotenv import load_dotenv
+import os
+import datetime
+
+load_dotenv()
+
+# days in a week, a roster over several weeks numbers its days on from the first week
+# (day 8 is the monday of the second week) and last weeks roster sits on days -6 to 0
+DAYS_PER_WEEK = 7
+# most weeks that can be solved together in one roster (MAX_HORIZON_WEEKS in the .env file)
+MAX_HORIZON_WEEKS = int(os.getenv("MAX_HORIZON_WEEKS", 8))
+
+# loading everything the solvers need for many teams in two round trips and indexing it per team
+# returns {team_id: snapshot}, each snapshot a dict:
+#   weeks: {week_id: week_number} for the week_ids given that exist (the same for every team)
+#   users: team member ids
+#   user_expertise: {user_id: set of expertise ids}
+#   unavailable: {user_id: set of approved day off ids}
+#   shifts: {shift_id: {"id", "start", "end", "users", "expertise": set, "days": list}}
+def load_solver_snapshots(db: Session, team_ids, week_ids=()):
+    team_ids = list(dict.fromkeys(team_ids))
+    # one query for the people side: members, their expertise, approved days off (and the weeks)
+    people = [
+        select(User.team_id, User.id, literal("member"), null()).where(User.team_id.in_(team_ids)),
+        select(User.team_id, user_expertise.c.user_id, literal("expertise"), user_expertise.c.expertise_id)
+            .join(User, User.id == user_expertise.c.user_id)
+            .where(User.team_id.in_(team_ids)),
+        select(UserAvailability.team_id, UserAvailability.user_id, literal("unavailable"), UserAvailability.day_id)
+            .where(UserAvailability.team_id.in_(team_ids), UserAvailability.approved == True),
+    ]
+    week_ids = list(week_ids)
+    if week_ids:
+        people.append(select(null(), Week.id, literal("week"), Week.week_number).where(Week.id.in_(week_ids)))
+
+    weeks = {}
+    snapshots = {
+        team_id: {
+            "weeks": weeks,
+            "users": [],
+            "user_expertise": defaultdict(set),
+            "unavailable": defaultdict(set),
+            "shifts": {},
+        }
+        for team_id in team_ids
+    }
+    for team_id, row_id, kind, value in db.execute(union_all(*people)):
+        if kind == "week":
+            weeks[row_id] = value
+        elif kind == "member":
+            snapshots[team_id]["users"].append(row_id)
+        elif kind == "expertise":
+            snapshots[team_id]["user_expertise"][row_id].add(value)
+        else:
+            snapshots[team_id]["unavailable"][row_id].add(value)
+
+    # one query for the shift side: every team shift with its expertise and the days it runs
+    shift_rows = db.query(
+        Shift.team_id, Shift.id, Shift.time_start, Shift.time_end, Shift.no_of_users,
+        shift_expertise.c.expertise_id, day_shift_team.c.day_id
+    ).outerjoin(
+        shift_expertise, shift_expertise.c.shift_id == Shift.id
+    ).outerjoin(
+        day_shift_team, (day_shift_team.c.shift_id == Shift.id) & (day_shift_team.c.team_id == Shift.team_id)
+    ).filter(Shift.team_id.in_(team_ids)).all()
+
+    for team_id, shift_id, start, end, no_of_users, expertise_id, day_id in shift_rows:
+        shift = snapshots[team_id]["shifts"].setdefault(shift_id, {
+            "id": shift_id, "start": start, "end": end, "users": no_of_users, "expertise": set(), "days": [],
+        })
+        if expertise_id is not None:
+            shift["expertise"].add(expertise_id)
+        # the joins repeat each day once per expertise so only keep it once
+        if day_id is not None and day_id not in shift["days"]:
+            shift["days"].append(day_id)
+
+    return snapshots
+
+
+# the snapshot of a single team, with week_exists set to whether week_id exists
+# weeks holds every week from week_id to to_week_id that exists
+def load_solver_snapshot(db: Session, team_id: int, week_id: int = None, to_week_id: int = None):
+    week_ids = []
+    if week_id is not None:
+        week_ids = range(week_id, (week_id if to_week_id is None else to_week_id) + 1)
+    snapshot = load_solver_snapshots(db, [team_id], week_ids)[team_id]
+    snapshot["week_exists"] = week_id in snapshot["weeks"]
+    return snapshot
+
+
+# turning the indexed snapshot back into the lists the solvers take
+def _snapshot_request_data(snapshot, shift_ids):
+    shifts = snapshot["shifts"]
+    return {
+        "users": list(snapshot["users"]),
+        "shift_details": [
+            {"id": sid, "start": shifts[sid]["start"], "end": shifts[sid]["end"], "users": shifts[sid]["users"]}
+            for sid in shift_ids
+        ],
+        "user_availability": [
+            {"user_id": user_id, "day_id": day_id}
+            for user_id, days in snapshot["unavailable"].items() for day_id in sorted(days)
+        ],
+        "shift_expertise": [
+            {"shift_id": sid, "expertise_id": expertise_id}
+            for sid in shift_ids for expertise_id in sorted(shifts[sid]["expertise"])
+        ],
+        "user_expertise": [
+            {"user_id": user_id, "expertise_id": expertise_id}
+            for user_id, expertises in snapshot["user_expertise"].items() for expertise_id in sorted(expertises)
+        ],
+    }
 
+
+# the solver lists for week_count weeks of a team, one slot for every user a shift needs
+def _expand_request_data(snapshot, week_count=1):
     #Expand domains based on the number of users required for each shift 
     expanded_shifts = []
-    for shift in shifts:
-        day_id, shift_id = shift
-        # finding the corresponding shift id with in the many to many and the shift details
-        shift_info = next((s for s in shift_details if s[0] == shift_id), None)
-        
-        # Extracting the number of required users for this shift 
-        if shift_info:
-            # Getting the num of users which is at index 3
-            num_users_required = shift_info[3]  
-            
-            # Creating a new slot for every user needed
-            for slot in range(num_users_required):
-                expanded_shifts.append({
-                    "day_id": day_id,
-                    "shift_id": shift_id,
-                    "slot": slot
-                })
+    for offset in range(week_count):
+        for shift_id, shift in snapshot["shifts"].items():
+            for day_id in shift["days"]:
+                # Creating a new slot for every user needed
+                for slot in range(shift["users"]):
+                    expanded_shifts.append({
+                        "day_id": day_id + offset * DAYS_PER_WEEK,
+                        "shift_id": shift_id,
+                        "slot": slot
+                    })
+    expanded_shifts.sort(key=lambda x: (x["day_id"], x["shift_id"], x["slot"]))
 
     # preparing the data to pass it to the csp
-    request_data = {
-        "users": users,
-        "shifts": expanded_shifts,
-        "shift_details": [{"id": shift[0], "start": shift[1], "end": shift[2], "users": shift[3]} for shift in shift_details],
-        "user_availability": [{"user_id": ua[0], "day_id": ua[1]} for ua in user_availability],
-        "shift_expertise": [{"shift_id": se[0], "expertise_id": se[1]} for se in shift_expertise_list],
-        "user_expertise": [{"user_id": ue[0], "expertise_id": ue[1]} for ue in user_expertise_list],
-    }
+    request_data = _snapshot_request_data(snapshot, list(snapshot["shifts"]))
+    request_data["shifts"] = expanded_shifts
+    # approved days off are days of the week, so they repeat in every week of the roster
+    if week_count > 1:
+        request_data["user_availability"] = [
+            {"user_id": ua["user_id"], "day_id": ua["day_id"] + offset * DAYS_PER_WEEK}
+            for offset in range(week_count) for ua in request_data["user_availability"]
+        ]
+    return request_data
+
+
+# loading the solver data for one week, or every week from week_id to to_week_id as one roster
+# the days of later weeks carry on from the first (day 8 is the second monday) so the rest gap and
+# the day limit work across the weeks, and last weeks ACTIVE roster comes along as fixed context
+def create_schedule(db: Session, team_id: int, week_id: int, to_week_id: int = None):
+    if to_week_id is not None:
+        if to_week_id < week_id:
+            raise HTTPException(status_code=400, detail="The last week must come after the first week")
+        if to_week_id - week_id + 1 > MAX_HORIZON_WEEKS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_HORIZON_WEEKS} weeks can be scheduled together")
+    snapshot = load_solver_snapshot(db, team_id, week_id, to_week_id)
+    # checking if week exists
+    if not snapshot["week_exists"]:
+        raise HTTPException(status_code=404, detail="Week not found")
+    # the weeks in calendar order, they have to follow on from each other with none missing
+    weeks = snapshot["weeks"]
+    week_ids = sorted(weeks, key=weeks.get)
+    week_count = 1 if to_week_id is None else to_week_id - week_id + 1
+    if len(week_ids) != week_count or weeks[week_ids[-1]] - weeks[week_ids[0]] != week_count - 1:
+        raise HTTPException(status_code=404, detail="Week not found")
+
+    request_data = _expand_request_data(snapshot, week_count)
+    request_data["week_ids"] = week_ids
+    request_data["fixed_assignments"] = load_week_before(db, team_id, weeks[week_ids[0]])
 
     return request_data
 
 
+# the assignments of one solution with 0 based slots in the order they were saved, like create_schedule does
+# solution_id can be a subquery so the whole lookup is one query
+def _solution_slots(db: Session, solution_id):
+    rows = db.query(Assignment.user_id, Assignment.shift_id, Assignment.day_id).filter(
+        Assignment.solution_id == solution_id
+    ).order_by(Assignment.id).all()
+    return _number_slots(rows)
+
+
+# giving each (user_id, shift_id, day_id) row its slot, counting up per shift and day
+def _number_slots(rows):
+    assignments = []
+    next_slot = defaultdict(int)
+    for user_id, shift_id, day_id in rows:
+        slot = next_slot[shift_id, day_id]
+        next_slot[shift_id, day_id] += 1
+        assignments.append({"user_id": user_id, "shift_id": shift_id, "day_id": day_id, "slot": slot})
+    return assignments
+
+
+# the newest ACTIVE solution of a team, optionally only for one week, as a subquery
+def _latest_active(team_id: int, week_id=None):
+    query = select(Solution.id).where(Solution.team_id == team_id, Solution.status == SolutionStatus.ACTIVE)
+    if week_id is not None:
+        query = query.where(Solution.week_id == week_id)
+    return query.order_by(Solution.created_at.desc(), Solution.id.desc()).limit(1).scalar_subquery()
+
+
+# the teams most recent ACTIVE roster as solver hints, in one query
+# on a roster of several weeks it is repeated for every week
+def load_previous_roster(db: Session, team_id: int, weeks: int = 1):
+    hint = _solution_slots(db, _latest_active(team_id))
+    return [
+        dict(a, day_id=a["day_id"] + offset * DAYS_PER_WEEK)
+        for offset in range(weeks) for a in hint
+    ]
+
+
+# the ACTIVE roster of the week before week_number, on days -6 to 0 so it sits just before the
+# first day of the new roster, in one query (empty if that week has no active roster)
+def load_week_before(db: Session, team_id: int, week_number: int):
+    previous_week = select(Week.id).where(Week.week_number == week_number - 1).scalar_subquery()
+    return [
+        dict(a, day_id=a["day_id"] - DAYS_PER_WEEK)
+        for a in _solution_slots(db, _latest_active(team_id, previous_week))
+    ]
+
+
+# the ACTIVE roster of the week before for many (team_id, week_number) pairs at once, keyed by the
+# pair, in two queries whatever the number of teams (the newest active solution of each team and
+# week first, then all their assignments)
+def load_weeks_before(db: Session, team_weeks):
+    wanted = {(team_id, week_number - 1): (team_id, week_number) for team_id, week_number in team_weeks}
+    if not wanted:
+        return {}
+    rows = db.query(Solution.id, Solution.team_id, Week.week_number).join(
+        Week, Week.id == Solution.week_id
+    ).filter(
+        Solution.team_id.in_({team_id for team_id, _ in wanted}),
+        Week.week_number.in_({number for _, number in wanted}),
+        Solution.status == SolutionStatus.ACTIVE,
+    ).order_by(Solution.created_at.desc(), Solution.id.desc()).all()
+    # keeping only the newest solution of every pair asked for
+    latest = {}
+    for solution_id, team_id, week_number in rows:
+        if (team_id, week_number) in wanted:
+            latest.setdefault(wanted[team_id, week_number], solution_id)
+
+    before = {pair: [] for pair in wanted.values()}
+    if latest:
+        rows = db.query(Assignment.solution_id, Assignment.user_id, Assignment.shift_id, Assignment.day_id).filter(
+            Assignment.solution_id.in_(latest.values())
+        ).order_by(Assignment.id).all()
+        by_solution = defaultdict(list)
+        for solution_id, user_id, shift_id, day_id in rows:
+            by_solution[solution_id].append((user_id, shift_id, day_id))
+        for pair, solution_id in latest.items():
+            before[pair] = [dict(a, day_id=a["day_id"] - DAYS_PER_WEEK) for a in _number_slots(by_solution[solution_id])]
+    return before
+
+
+# loading the solver data for many (team_id, week_id) pairs at once, for generating the rosters of
+# a whole site, in four queries whatever the number of teams
+# returns {(team_id, week_id): request_data}, pairs with a week that doesnt exist are left out
+def create_schedules(db: Session, team_weeks):
+    team_weeks = list(dict.fromkeys(team_weeks))
+    snapshots = load_solver_snapshots(db, [team_id for team_id, _ in team_weeks], [week_id for _, week_id in team_weeks])
+    weeks = next(iter(snapshots.values()))["weeks"] if snapshots else {}
+    team_weeks = [(team_id, week_id) for team_id, week_id in team_weeks if week_id in weeks]
+    before = load_weeks_before(db, [(team_id, weeks[week_id]) for team_id, week_id in team_weeks])
+
+    schedules = {}
+    for team_id, week_id in team_weeks:
+        request_data = _expand_request_data(snapshots[team_id])
+        request_data["week_ids"] = [week_id]
+        request_data["fixed_assignments"] = before[team_id, weeks[week_id]]
+        schedules[team_id, week_id] = request_data
+    return schedules
+
+
+# splitting a roster over several weeks back into each weeks own days
+# every assignment gets its week_id and a day_id from 1 to 7 again
+def split_roster_by_week(roster, week_ids):
+    split = []
+    for assignment in roster:
+        offset, day = divmod(assignment["day_id"] - 1, DAYS_PER_WEEK)
+        split.append(dict(assignment, week_id=week_ids[offset], day_id=day + 1))
+    return split
+
+
+# saving every generated roster as a DRAFT solution with its assignments, returns the new solution ids
+# everything goes in one transaction: the few solution rows are flushed to get their ids and
+# all the assignments (the hundreds of rows) are written with a single executemany insert
+def save_generated_solutions(db: Session, team_id: int, week_id: int, rosters):
+    return save_team_rosters(db, [(team_id, week_id, roster) for roster in rosters])
+
+
+# saving rosters over several weeks, each roster becomes one DRAFT solution per week
+# returns the new solution ids per roster, in week order
+def save_horizon_solutions(db: Session, team_id: int, week_ids, rosters):
+    team_rosters = []
+    for roster in rosters:
+        by_week = {week_id: [] for week_id in week_ids}
+        for assignment in split_roster_by_week(roster, week_ids):
+            by_week[assignment["week_id"]].append(assignment)
+        team_rosters.extend((team_id, week_id, week_roster) for week_id, week_roster in by_week.items())
+    solution_ids = save_team_rosters(db, team_rosters)
+    return [solution_ids[i:i + len(week_ids)] for i in range(0, len(solution_ids), len(week_ids))]
+
+
+# team_rosters is a list of (team_id, week_id, roster), one new DRAFT solution each, so the rosters
+# of many teams can be saved in the same transaction, returns the solution ids in the same order
+def save_team_rosters(db: Session, team_rosters):
+    try:
+        solutions = [
+            Solution(team_id=team_id, week_id=week_id, status="DRAFT", created_at=datetime.datetime.now())
+            for team_id, week_id, _ in team_rosters
+        ]
+        db.add_all(solutions)
+        db.flush()
+        solution_ids = [solution.id for solution in solutions]
+
+        rows = [
+            {
+                "user_id": assignment["user_id"],
+                "shift_id": assignment["shift_id"],
+                "day_id": assignment["day_id"],
+                "team_id": team_id,
+                "solution_id": solution_id,
+                "locked": False,
+            }
+            for solution_id, (team_id, _, roster) in zip(solution_ids, team_rosters) for assignment in roster
+        ]
+        if rows:
+            db.execute(insert(Assignment), rows)
+        db.commit()
+    except Exception:
+        # nothing is kept if any part fails, so there is never a half written solution
+        db.rollback()
+        raise
+    return solution_ids
+
+
+# replacing the assignments of a regenerated solution in one transaction
+def replace_solution_assignments(db: Session, solution_id: int, team_id: int, assignments):
+    solution = db.query(Solution).filter(Solution.id == solution_id).first()
+    if not solution:
+        raise HTTPException(status_code=404, detail="Solution not found")
+    try:
+        # updating the solution status to draft if its not 
+        solution.status = "DRAFT"
+        solution.created_at = datetime.datetime.now()
+        # Delete existing assignments for that solution
+        db.query(Assignment).filter(Assignment.solution_id == solution_id).delete()
+        # Inserting the updated assignments (including locked ones)
+        rows = [
+            {
+                "user_id": assignment["user_id"],
+                "shift_id": assignment["shift_id"],
+                "day_id": assignment["day_id"],
+                "team_id": team_id,
+                "solution_id": solution_id,
+                "locked": assignment["locked"],
+            }
+            for assignment in assignments
+        ]
+        if rows:
+            db.execute(insert(Assignment), rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return solution
+
+
 # regeneration crud to pass the data to the regen csp
 def regenerate_solution(db: Session, solution_id: int):
+    # the solution and all its assignments in one query
+    rows = db.query(Solution, Assignment).outerjoin(
+        Assignment, Assignment.solution_id == Solution.id
+    ).filter(Solution.id == solution_id).order_by(Assignment.id).all()
     # Checking if Solution exists
-    solution = db.query(Solution).filter(Solution.id == solution_id).first()
-    if not solution:
+    if not rows:
         raise HTTPException(status_code=404, detail="Solution not found")
-    
-    # All assignments based on solution_id
-    assignments = db.query(Assignment).filter(Assignment.solution_id == solution_id).all()
+    solution = rows[0][0]
+    assignments = [a for _, a in rows if a is not None]
     if not assignments:
         raise HTTPException(status_code=404, detail="Assignments not found")
 
-    users = db.query(User.id).filter(User.team_id == solution.team_id).all()
-    # Converting to list of user IDs
-    users = [user[0] for user in users]  
-    
-    # Getting availability of users (only approved availability entries)
-    user_availability = db.query(UserAvailability.user_id, UserAvailability.day_id).filter(
-        UserAvailability.team_id == solution.team_id,
-        UserAvailability.approved == True
-    ).all()
-
-    # Getting expertise data for users
-    user_expertise_list = db.query(user_expertise.c.user_id, user_expertise.c.expertise_id).filter(
-        user_expertise.c.user_id.in_(users)
-    ).all()
-    
-    # Getting expertise data for shifts
-    shift_ids = list(set(a.shift_id for a in assignments))
-    shift_expertise_list = db.query(shift_expertise.c.shift_id, shift_expertise.c.expertise_id).filter(
-        shift_expertise.c.shift_id.in_(shift_ids)
-    ).all()
-    
-    shift_details = db.query(Shift.id, Shift.time_start, Shift.time_end).filter(
-        Shift.id.in_(shift_ids)
-    ).all()
+    snapshot = load_solver_snapshot(db, solution.team_id)
 
-    # Creating a mapping from shift_id to (start_time, end_time)
-    shift_times = {shift[0]: {'start': shift[1], 'end': shift[2]} for shift in shift_details}
     # Grouping assignments by shift_id and day_id for slot assignment
     grouped_assignments = defaultdict(list)
     for a in assignments:
         grouped_assignments[(a.shift_id, a.day_id)].append(a)
+    shift_ids = [sid for sid in dict.fromkeys(a.shift_id for a in assignments) if sid in snapshot["shifts"]]
 
     # Assigning slots based on the grouped assignments
     locked_assignments = []
@@ -139,29 +413,17 @@ def regenerate_solution(db: Session, solution_id: int):
             })
     
     # Preparing the request data for CSP
-    request_data = {
+    request_data = _snapshot_request_data(snapshot, shift_ids)
+    request_data.update({
         "team_id": solution.team_id,  
         "week_id": solution.week_id,
         "shifts": [{'shift_id': shift_id, 'day_id': day_id, 'slot': slot, 'locked': (any(a.locked for a in group))} for (shift_id, day_id), group in grouped_assignments.items() for slot in range(1, len(group) + 1)],
         "shift_times": [
-        {
-            "id": shift_id,
-            "start": shift["start"],
-            "end": shift["end"]
-        }
-        for shift_id, shift in shift_times.items()
-    ],
+            {"id": detail["id"], "start": detail["start"], "end": detail["end"]}
+            for detail in request_data.pop("shift_details")
+        ],
         "locked_assignments": locked_assignments,
         "original_assignments": original_assignments, 
-        "users": users,
-        "user_availability": [{"user_id": ua[0], "day_id": ua[1]} for ua in user_availability],
-        "shift_expertise": [{"shift_id": se[0], "expertise_id": se[1]} for se in shift_expertise_list],
-        "user_expertise": [{"user_id": ue[0], "expertise_id": ue[1]} for ue in user_expertise_list],
-    }
+    })
 
-    # Debugging output
-    print("[DEBUG] Request data:", request_data)
-    
     return request_data
-
-
@@ -21,6 +21,8 @@ from app.routes.team_invitation_route import router as team_invitation_router
 from app.routes.week_route import router as week_router
 from app.routes.solution_route import router as solution_router
 from app.routes.websocket_route import router as websocket_router
+from app.services.solver_pool import solver_pool
+from app.services.solve_progress import solve_progress
 # lifespan runs on start up and shutdown
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -34,6 +36,9 @@ async def lifespan(app: FastAPI):
         yield  
     finally:
         db.close()
+        # stopping the solver worker processes on shutdown
+        solver_pool.shutdown()
+        solve_progress.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -1,105 +1,221 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Optional
 from sqlalchemy.orm import Session
 from app.dependencies.db_config import get_db
 from app.crud.scheduling_crud import *
 from fastapi import APIRouter, Depends, HTTPException
-from app.models import User, Solution, Assignment
-import datetime
+from app.models import User
 from app.dependencies.auth import require_role
-from app.CSPs.solver_csp import ShiftAssignmentSolver
-from app.CSPs.regen_csp import RegenerateCSP
+from app.CSPs.engines import ENGINES, run_assignment_solver, run_regeneration_solver
+from app.CSPs.fairness import OBJECTIVES
+from app.CSPs.regen_csp import REGEN_MODES
+from app.CSPs.local_search import IMPROVE_MAX_TIME_MS
+from app.services.solver_pool import solver_pool, SOLVER_TIMEOUT_SECONDS
+from app.services.schedule_jobs import schedule_jobs
+from app.services.batch_schedule import run_batch
+from app.services.solve_progress import solve_progress
+from app.services.solver_cache import solver_cache, fingerprint
 from app.schemas.schedule_schema import *
 
 router = APIRouter()
 
+# a solve cant ask for more time then the solver pool waits for it
+MAX_TIME_LIMIT_MS = int(SOLVER_TIMEOUT_SECONDS * 1000)
+
+
+# the extra solver settings sent to the engine, built from the query parameters
+def solver_options(time_limit_ms, count, objective, hours_weight, nights_weight, weekends_weight, warm_start=False, improve_ms=None):
+    if objective is not None and objective not in OBJECTIVES:
+        raise HTTPException(status_code=400, detail=f"Unknown objective {objective}")
+    return {
+        "time_limit_ms": time_limit_ms,
+        "count": count,
+        "objective": objective,
+        "weights": {"hours": hours_weight, "nights": nights_weight, "weekends": weekends_weight},
+        "improve_ms": improve_ms,
+        # swapped for the previous roster once the database is open
+        "warm_start": warm_start,
+    }
+
+
 @router.post("/assign-shifts/{team_id}/{week_id}", response_model=ShiftAssignmentResponse)
 async def assign_shifts(
     team_id: int,
     week_id: int, 
+    to_week_id: Optional[int] = Query(None, description="Last week of a roster over several weeks, every week from week_id to this one is solved together"),
+    engine: Optional[str] = Query(None, description="Solving engine to use (csp or cpsat)"),
+    time_limit_ms: Optional[int] = Query(None, ge=1, le=MAX_TIME_LIMIT_MS, description="Time budget for the whole solve, the best partial roster is returned (but not saved) when it runs out"),
+    count: int = Query(1, ge=1, le=10, description="Number of different rosters to generate, each saved as its own DRAFT solution"),
+    objective: Optional[str] = Query(None, description="Set to fairness to spread hours, nights and weekends evenly, cpsat optimizes the spread while csp only tries the least loaded user first"),
+    hours_weight: Optional[float] = Query(None, ge=0, description="Weight of the hours spread in the fairness objective"),
+    nights_weight: Optional[float] = Query(None, ge=0, description="Weight of the night shift spread in the fairness objective"),
+    weekends_weight: Optional[float] = Query(None, ge=0, description="Weight of the weekend shift spread in the fairness objective"),
+    warm_start: bool = Query(False, description="Start from the teams most recent ACTIVE roster so staff keep similar shifts"),
+    improve_ms: Optional[int] = Query(None, ge=1, le=IMPROVE_MAX_TIME_MS, description="Time budget for a local search that makes the roster fairer after it is found"),
     db: Session = Depends(get_db),
     current_user: User = Depends(require_role(["Employer"]))
 ):
     # auth
     if current_user.team_id != team_id:
         raise HTTPException(status_code=403, detail="You are not authorized to assign shifts for this team")
+    # checking the engine before loading any data
+    if engine is not None and engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown solver engine {engine}")
+    options = solver_options(time_limit_ms, count, objective, hours_weight, nights_weight, weekends_weight, warm_start, improve_ms)
+
+    # Requesting the data, with last weeks active roster as fixed context
+    request_data = create_schedule(db, team_id, week_id, to_week_id)
+    week_ids = request_data["week_ids"]
+    if options.pop("warm_start"):
+        options["hint"] = load_previous_roster(db, team_id, len(week_ids))
 
-    # Requesting the data
-    request_data = create_schedule(db, team_id, week_id)
-
-    # Initialize CSP solver with the request data
-    solver = ShiftAssignmentSolver(
-        users=request_data["users"],
-        shifts=request_data["shifts"],
-        shift_details=request_data["shift_details"],
-        user_availability=request_data["user_availability"],
-        user_expertise=request_data["user_expertise"],
-        shift_expertise=request_data["shift_expertise"]
-    )
     print(request_data)
 
-    # calling the solve function within the shiftAssignmentSolver
-    result = solver.solve() 
+    # solving with the chosen engine (csp by default) in the solver process pool
+    # so the event loop stays free while the roster is built
+    # an identical earlier solve (same team data and settings) is reused straight away
+    cache_key = fingerprint(request_data, engine, options)
+    result = solver_cache.get(cache_key)
+    if result is None:
+        # progress goes to the employers websocket if they have one open, they can cancel there too
+        # only one solve runs per team and week, a solve still running for any of its weeks is cancelled
+        async with solve_progress.track(current_user.id, "assign_shifts", [(team_id, w) for w in week_ids]) as progress:
+            result = await solver_pool.run(run_assignment_solver, request_data, engine, options, progress, cancel=progress.cancel)
+        solver_cache.put(cache_key, result)
+        # a cancelled or replaced roster isnt saved, so only the newest one is
+        solve_progress.raise_if_stopped(progress, result)
+    else:
+        # the cached roster is the newest one for its weeks
+        for w in week_ids:
+            solve_progress.supersede((team_id, w))
     # if there are no assignments show 400 stats code
     if not result["assignments"]:
+        # the checks before the search found why there is no roster
+        if result.get("diagnosis"):
+            raise HTTPException(status_code=400, detail={"message": "No valid shift assignments found", "reasons": result["diagnosis"]})
+        if result.get("timed_out"):
+            raise HTTPException(status_code=400, detail=result["failure_reasons"][0])
         raise HTTPException(status_code=400, detail="No valid shift assignments found")
-    
-    # creating solution entry for each solution available
-    for formatted_assignment in result["assignments"]:
-        solution = Solution(
-            team_id=team_id,
-            week_id=week_id,
-            status="DRAFT", 
-            created_at=datetime.datetime.now()
+
+    # a partial roster from the time limit has empty slots, it is shown to the employer
+    # but not saved so it can never be activated with gaps in it
+    if result.get("timed_out"):
+        return dict(
+            result,
+            assignments=[split_roster_by_week(roster, week_ids) for roster in result["assignments"]],
+            message=f"{result['message']}, it was not saved",
         )
-        db.add(solution)
-        db.commit()  
-
-        # Creating assignments for each solution
-        for assignment in formatted_assignment:
-            user_id = assignment["user_id"]
-            shift_id = assignment["shift_id"]
-            day_id = assignment["day_id"]
-            
-            assignment_obj = Assignment(
-                user_id=user_id,
-                shift_id=shift_id,
-                day_id=day_id,
-                team_id=team_id,
-                solution_id=solution.id,
-                locked=False
-            )
-            db.add(assignment_obj)
-
-        db.commit()  
-
-#    returning the solutions with the assignemnts
-    return result
+
+    # creating solution entry for each solution available (one per week on a longer roster)
+    save_horizon_solutions(db, team_id, week_ids, result["assignments"])
+
+#    returning the solutions with the assignemnts, each with its own week and day of the week
+    return dict(result, assignments=[split_roster_by_week(roster, week_ids) for roster in result["assignments"]])
+
+# starts generating the schedule in the background and returns the job straight away
+# the employer gets a websocket message with the new solution id once it finishes
+@router.post("/jobs/assign-shifts/{team_id}/{week_id}", response_model=ScheduleJobResponse, status_code=202)
+async def submit_assign_shifts_job(
+    team_id: int,
+    week_id: int,
+    engine: Optional[str] = Query(None, description="Solving engine to use (csp or cpsat)"),
+    time_limit_ms: Optional[int] = Query(None, ge=1, le=MAX_TIME_LIMIT_MS, description="Time budget for the whole solve, the job fails when it runs out before a full roster is found"),
+    count: int = Query(1, ge=1, le=10, description="Number of different rosters to generate, each saved as its own DRAFT solution"),
+    objective: Optional[str] = Query(None, description="Set to fairness to spread hours, nights and weekends evenly, cpsat optimizes the spread while csp only tries the least loaded user first"),
+    hours_weight: Optional[float] = Query(None, ge=0, description="Weight of the hours spread in the fairness objective"),
+    nights_weight: Optional[float] = Query(None, ge=0, description="Weight of the night shift spread in the fairness objective"),
+    weekends_weight: Optional[float] = Query(None, ge=0, description="Weight of the weekend shift spread in the fairness objective"),
+    warm_start: bool = Query(False, description="Start from the teams most recent ACTIVE roster so staff keep similar shifts"),
+    improve_ms: Optional[int] = Query(None, ge=1, le=IMPROVE_MAX_TIME_MS, description="Time budget for a local search that makes the roster fairer after it is found"),
+    current_user: User = Depends(require_role(["Employer"]))
+):
+    if current_user.team_id != team_id:
+        raise HTTPException(status_code=403, detail="You are not authorized to assign shifts for this team")
+    if engine is not None and engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown solver engine {engine}")
+    options = solver_options(time_limit_ms, count, objective, hours_weight, nights_weight, weekends_weight, warm_start, improve_ms)
+
+    return schedule_jobs.submit(current_user.id, team_id, week_id, engine, options)
+
+# stops the solve running for a team and week (from /assign-shifts or a job), nothing is saved for it
+@router.post("/cancel/{team_id}/{week_id}")
+async def cancel_assign_shifts(
+    team_id: int,
+    week_id: int,
+    current_user: User = Depends(require_role(["Employer"]))
+):
+    if current_user.team_id != team_id:
+        raise HTTPException(status_code=403, detail="You are not authorized to assign shifts for this team")
+    if not solve_progress.cancel_key((team_id, week_id)):
+        raise HTTPException(status_code=404, detail="No solve is running for this week")
+    return {"team_id": team_id, "week_id": week_id, "cancelled": True}
+
+# generates DRAFT rosters for many teams at once (admins only), like next weeks rosters for the whole site
+# the teams are loaded together, solved in parallel in the solver pool and saved in one transaction
+@router.post("/batch/assign-shifts", response_model=BatchScheduleResponse)
+async def batch_assign_shifts(
+    batch: BatchScheduleRequest,
+    engine: Optional[str] = Query(None, description="Solving engine to use (csp or cpsat)"),
+    time_limit_ms: Optional[int] = Query(None, ge=1, le=MAX_TIME_LIMIT_MS, description="Time budget for each teams solve, a team whose time runs out before a full roster is found fails"),
+    count: int = Query(1, ge=1, le=10, description="Number of different rosters to generate per team"),
+    objective: Optional[str] = Query(None, description="Set to fairness to spread hours, nights and weekends evenly, cpsat optimizes the spread while csp only tries the least loaded user first"),
+    hours_weight: Optional[float] = Query(None, ge=0, description="Weight of the hours spread in the fairness objective"),
+    nights_weight: Optional[float] = Query(None, ge=0, description="Weight of the night shift spread in the fairness objective"),
+    weekends_weight: Optional[float] = Query(None, ge=0, description="Weight of the weekend shift spread in the fairness objective"),
+    improve_ms: Optional[int] = Query(None, ge=1, le=IMPROVE_MAX_TIME_MS, description="Time budget for a local search that makes each roster fairer after it is found"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_role(["Admin"]))
+):
+    if engine is not None and engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown solver engine {engine}")
+    if not batch.teams:
+        raise HTTPException(status_code=400, detail="No teams to schedule")
+    options = solver_options(time_limit_ms, count, objective, hours_weight, nights_weight, weekends_weight, improve_ms=improve_ms)
+    options.pop("warm_start")
+
+    return await run_batch(db, [(tw.team_id, tw.week_id) for tw in batch.teams], engine, options, user_id=current_user.id)
+
+# hit and miss counts of the solver result cache
+@router.get("/solver-cache")
+async def get_solver_cache_stats(current_user: User = Depends(require_role(["Employer"]))):
+    return solver_cache.stats()
+
+# gets the status and progress of a schedule job
+@router.get("/jobs/{job_id}", response_model=ScheduleJobResponse)
+async def get_schedule_job(
+    job_id: str,
+    current_user: User = Depends(require_role(["Employer"]))
+):
+    job = schedule_jobs.get(job_id)
+    # jobs from other teams are treated as not existing
+    if not job or job["team_id"] != current_user.team_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @router.post("/regenerate/{solution_id}", response_model=ShiftAssignmentRegenerationResponse)
 async def reassign_shifts(
     solution_id: int,
+    mode: str = Query("different", description="different for a new roster, repair to keep the roster and change as few slots as possible"),
+    target_changes: Optional[int] = Query(None, ge=0, description="In repair mode, the least number of slots to change"),
+    time_limit_ms: Optional[int] = Query(None, ge=1, le=MAX_TIME_LIMIT_MS, description="Time budget for a repair, the fewest changes found by then is kept"),
     db: Session = Depends(get_db),
     current_user: User = Depends(require_role(["Employer"]))
 ):
+    if mode not in REGEN_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown regeneration mode {mode}")
     # Requesting the data
     request_data = regenerate_solution(db, solution_id)
     
     if current_user.team_id != request_data["team_id"]:
         raise HTTPException(status_code=403, detail="You are not authorized to assign shifts for this team")
 
-    # Initialising CSP solver with the request data from thhe regenerate solution function in the crud file
-    solver = RegenerateCSP(
-        users=request_data["users"],
-        shifts=request_data["shifts"],
-        user_availability=request_data["user_availability"],
-        user_expertise=request_data["user_expertise"],
-        shift_expertise=request_data["shift_expertise"],
-        shift_details=request_data["shift_times"],
-        original_assignments=request_data["original_assignments"],
-        locked_assignments=request_data["locked_assignments"],
-    )
-
-    result = solver.solve()
+    # Running the regeneration CSP with the request data from the regenerate solution function in the crud file
+    # in the solver process pool so other requests arent blocked
+    options = {"mode": mode, "target_changes": target_changes, "time_limit_ms": time_limit_ms}
+    # regenerating the same solution again replaces the one still running
+    async with solve_progress.track(current_user.id, "regenerate", [("solution", solution_id)]) as progress:
+        result = await solver_pool.run(run_regeneration_solver, request_data, options, progress, cancel=progress.cancel)
+    solve_progress.raise_if_stopped(progress, result)
 
     if not result["assignments"]:
         return {
@@ -114,37 +230,7 @@ async def reassign_shifts(
         }
 
 
-    # Creating assignment objects from the solved data
-    solution = db.query(Solution).filter(Solution.id == solution_id).first()
-    if not solution:
-        raise HTTPException(status_code=404, detail="Solution not found")
-
-    # updating the solution status to draft if its not 
-    solution.status = "DRAFT"
-    solution.created_at = datetime.datetime.now()
-    db.commit()
-
-    # Delete existing assignments for that solution
-    db.query(Assignment).filter(Assignment.solution_id == solution_id).delete()
-    db.commit()
-
-    # Inserting the updated assignments (including locked ones)
-    for assignment in result["assignments"]:
-        user_id = assignment["user_id"]
-        shift_id = assignment["shift_id"]
-        day_id = assignment["day_id"]
-        locked = assignment["locked"]
-
-        assignment_obj = Assignment(
-            user_id=user_id,
-            shift_id=shift_id,
-            day_id=day_id,
-            team_id=request_data["team_id"],
-            solution_id=solution.id,
-            locked=locked
-        )
-        db.add(assignment_obj)
-
-    db.commit()
+    # Replacing the solution's assignments with the regenerated ones in a single transaction
+    replace_solution_assignments(db, solution_id, request_data["team_id"], result["assignments"])
 
     return result
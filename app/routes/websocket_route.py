@@ -1,5 +1,7 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+import json
 from app.services.websocket_manager import manager
+from app.services.solve_progress import solve_progress
 from app.dependencies.auth import decode_access_token  
 
 router = APIRouter()
@@ -28,6 +30,21 @@ async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(str(user_id), websocket)
     try:
         while True:
-            await websocket.receive_text()
+            message = await websocket.receive_text()
+            await handle_message(str(user_id), message)
     except WebSocketDisconnect:
         manager.disconnect(str(user_id), websocket)
+
+
+# messages the client can send, anything else is ignored
+#   {"type": "cancel_solve", "solve_id": ...} stops one of the users running solves
+async def handle_message(user_id: str, message: str):
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return
+    if not isinstance(data, dict) or data.get("type") != "cancel_solve":
+        return
+    solve_id = data.get("solve_id")
+    cancelled = solve_progress.cancel(user_id, solve_id)
+    await manager.send_to_user(user_id, json.dumps({"type": "cancel_solve", "solve_id": solve_id, "cancelled": cancelled}))
@@ -7,11 +7,43 @@ class ShiftAssignment(BaseModel):
     shift_id: int
     day_id: int
     slot: int
+    # the week the assignment is in, on a roster over several weeks
+    week_id: Optional[int] = None
+
+
+class UserTotals(BaseModel):
+    user_id: int
+    hours: float
+    nights: int
+    weekends: int
+    days: int
+
+
+class ImprovementStats(BaseModel):
+    time_limit_ms: int
+    moves: int
+    accepted_moves: int
+    objective_before: float
+    objective_after: float
+    transitions_before: int
+    transitions_after: int
 
 
 class ShiftAssignmentResponse(BaseModel):
     total_solutions: int
     assignments: List[List[ShiftAssignment]]
+    # filled in when the time limit ran out and only a partial roster was found, which isnt saved
+    timed_out: Optional[bool] = False
+    skipped_count: Optional[int] = 0
+    skipped_assignments: Optional[List[Any]] = []
+    failure_reasons: Optional[List[str]] = []
+    message: Optional[str] = None
+    # fairness of each roster (weighted spread, lower is fairer) and the totals per user
+    # only cpsat optimizes it, csp tries the least loaded user first for each slot and takes the first roster
+    objective_values: Optional[List[float]] = []
+    user_totals: Optional[List[List[UserTotals]]] = []
+    # what the local search changed, when it was asked for
+    improvement: Optional[ImprovementStats] = None
 
 
 class ShiftAssignmentRegenerationResponse(BaseModel):
@@ -23,3 +55,47 @@ class ShiftAssignmentRegenerationResponse(BaseModel):
     skipped_assignments: Optional[List[Any]] = []
     failure_reasons: Optional[List[str]] = []
     message: Optional[str] = None
+
+
+class ScheduleJobResponse(BaseModel):
+    job_id: str
+    team_id: int
+    week_id: int
+    status: str
+    stage: str
+    progress: int
+    solution_ids: List[int] = []
+    total_solutions: int = 0
+    error: Optional[str] = None
+    created_at: float
+    finished_at: Optional[float] = None
+
+
+class TeamWeek(BaseModel):
+    team_id: int
+    week_id: int
+
+
+class BatchScheduleRequest(BaseModel):
+    teams: List[TeamWeek]
+
+
+class BatchTeamResult(BaseModel):
+    team_id: int
+    week_id: int
+    status: str
+    solve_seconds: float
+    total_solutions: int = 0
+    solution_ids: List[int] = []
+    timed_out: bool = False
+    error: Optional[Any] = None
+
+
+class BatchScheduleResponse(BaseModel):
+    teams: List[BatchTeamResult]
+    load_seconds: float
+    solve_seconds: float
+    save_seconds: float
+    total_seconds: float
+    completed: int
+    failed: int
@@ -0,0 +1,166 @@
+# Generating rosters for many teams in one go, like rolling out next weeks rosters for the whole site
+#
+# The inputs of every team are loaded together in a few set based queries, the solves are fanned out
+# over the solver process pool (so it scales with the cores) and every roster is saved in a single
+# transaction at the end. Each team gets its own status and timing in the report.
+# Every solve is registered with solve_progress like any other, so a newer solve for the same team
+# and week (or a cancel) stops it, and a roster replaced before the save is left out of it.
+#
+# Can also be run from the command line:
+#   python -m app.services.batch_schedule 1:5 2:5 3:5
+#   python -m app.services.batch_schedule 1:5 2:5 --engine cpsat --time-limit-ms 20000
+import argparse
+import asyncio
+import json
+import time
+from contextlib import AsyncExitStack
+from fastapi import HTTPException
+from app.dependencies.db_config import SessionLocal
+from app.crud.scheduling_crud import create_schedules, save_team_rosters
+from app.CSPs.engines import ENGINES, run_assignment_solver
+from app.CSPs.fairness import OBJECTIVES
+from app.services.solver_pool import solver_pool
+from app.services.solver_cache import solver_cache, fingerprint
+from app.services.solve_progress import solve_progress
+
+
+# solving one team in the pool, returns its report entry, the rosters to save and its progress channel
+# the solve stays tracked until the stack is closed, so it can still be replaced until the batch is saved
+async def _solve_team(team_id, week_id, request_data, engine, options, pool, slots, user_id, stack):
+    report = {
+        "team_id": team_id,
+        "week_id": week_id,
+        "status": "failed",
+        "solve_seconds": 0.0,
+        "total_solutions": 0,
+        "solution_ids": [],
+        "timed_out": False,
+        "error": None,
+    }
+    if request_data is None:
+        report["error"] = "Week not found"
+        return report, [], None
+    key = (team_id, week_id)
+    progress = None
+    # only as many solves as there are workers are handed to the pool at once, so a big batch
+    # doesnt fill the pools queue and get turned away
+    async with slots:
+        started = time.perf_counter()
+        try:
+            cache_key = fingerprint(request_data, engine, options)
+            result = solver_cache.get(cache_key)
+            if result is None:
+                progress = await stack.enter_async_context(solve_progress.track(user_id, "batch", [key]))
+                result = await pool.run(run_assignment_solver, request_data, engine, options, progress, cancel=progress.cancel)
+                solver_cache.put(cache_key, result)
+                solve_progress.raise_if_stopped(progress, result)
+            else:
+                solve_progress.supersede(key)
+        except HTTPException as e:
+            report["error"] = e.detail
+            return report, [], progress
+        except Exception as e:
+            print(f"[BATCH] Solving team {team_id} week {week_id} failed: {e}")
+            report["error"] = "Schedule generation failed"
+            return report, [], progress
+        finally:
+            report["solve_seconds"] = time.perf_counter() - started
+
+    if not result["assignments"]:
+        reasons = result.get("failure_reasons") or ["No valid shift assignments found"]
+        report["error"] = reasons[0]
+        return report, [], progress
+    # a partial roster from the time limit has empty slots, so it isnt saved
+    if result.get("timed_out"):
+        report.update(timed_out=True, error=f"{result['message']}, it was not saved")
+        return report, [], progress
+    report.update(status="completed", total_solutions=result["total_solutions"])
+    return report, result["assignments"], progress
+
+
+# runs the batch and returns the report:
+#   teams: one entry per (team_id, week_id) with its status, solve time, solution ids and error
+#   load_seconds, solve_seconds, save_seconds, total_seconds: time spent in each stage
+#   completed, failed: how many teams ended each way
+#   user_id is who gets the progress of every solve over the websocket (None from the command line)
+async def run_batch(db, team_weeks, engine=None, options=None, pool=solver_pool, user_id=None):
+    started = time.perf_counter()
+    team_weeks = list(dict.fromkeys(team_weeks))
+    schedules = create_schedules(db, team_weeks)
+    loaded = time.perf_counter()
+
+    slots = asyncio.Semaphore(max(1, pool.workers))
+    async with AsyncExitStack() as stack:
+        solved = await asyncio.gather(*[
+            _solve_team(team_id, week_id, schedules.get((team_id, week_id)), engine, options or {}, pool, slots, user_id, stack)
+            for team_id, week_id in team_weeks
+        ])
+        solving_done = time.perf_counter()
+
+        # a roster replaced by a newer solve (or cancelled) while the other teams were solving isnt saved
+        to_save = []
+        for report, rosters, progress in solved:
+            if rosters and progress is not None:
+                try:
+                    # the result itself was checked when its solve ended
+                    solve_progress.raise_if_stopped(progress, {})
+                except HTTPException as e:
+                    report.update(status="failed", error=e.detail)
+                    rosters = []
+            to_save.append((report, rosters))
+
+        # every roster of every team saved together, one DRAFT solution each
+        team_rosters = [
+            (report["team_id"], report["week_id"], roster)
+            for report, rosters in to_save for roster in rosters
+        ]
+        if team_rosters:
+            solution_ids = iter(save_team_rosters(db, team_rosters))
+            for report, rosters in to_save:
+                report["solution_ids"] = [next(solution_ids) for _ in rosters]
+        finished = time.perf_counter()
+
+    teams = [report for report, _ in to_save]
+    completed = sum(1 for report in teams if report["status"] == "completed")
+    return {
+        "teams": teams,
+        "load_seconds": loaded - started,
+        "solve_seconds": solving_done - loaded,
+        "save_seconds": finished - solving_done,
+        "total_seconds": finished - started,
+        "completed": completed,
+        "failed": len(teams) - completed,
+    }
+
+
+# "team_id:week_id" from the command line
+def _team_week(value):
+    try:
+        team_id, week_id = value.split(":")
+        return int(team_id), int(week_id)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} should be team_id:week_id")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate DRAFT rosters for many teams at once")
+    parser.add_argument("team_weeks", nargs="+", type=_team_week, help="team and week to schedule, as team_id:week_id")
+    parser.add_argument("--engine", choices=sorted(ENGINES), help="solving engine to use (default: csp)")
+    parser.add_argument("--time-limit-ms", type=int, help="time budget for each solve")
+    parser.add_argument("--objective", choices=OBJECTIVES, help="set to fairness to spread hours, nights and weekends evenly")
+    args = parser.parse_args(argv)
+
+    options = {"time_limit_ms": args.time_limit_ms, "objective": args.objective}
+    db = SessionLocal()
+    try:
+        report = asyncio.run(run_batch(db, args.team_weeks, args.engine, options))
+    finally:
+        db.close()
+        solver_pool.shutdown()
+        solve_progress.shutdown()
+    print(json.dumps(report, indent=2))
+    return 0 if not report["failed"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
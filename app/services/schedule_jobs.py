@@ -0,0 +1,118 @@
+import asyncio
+import json
+import time
+import uuid
+from fastapi import HTTPException
+from app.dependencies.db_config import SessionLocal
+from app.crud.scheduling_crud import create_schedule, save_generated_solutions, load_previous_roster
+from app.CSPs.engines import run_assignment_solver
+from app.services.solver_pool import solver_pool
+from app.services.solver_cache import solver_cache, fingerprint
+from app.services.websocket_manager import manager
+from app.services.solve_progress import solve_progress
+
+# finished jobs are forgotten after an hour
+JOB_TTL_SECONDS = 60 * 60
+
+
+class ScheduleJobManager:
+    # Keeps track of schedule generation jobs running in the background.
+    # Submitting returns straight away with a job id, the job then loads the data, solves in the
+    # solver pool, saves the solution and tells the employer over the websocket when it is done.
+    def __init__(self):
+        self.jobs = {}
+        # holding on to the running tasks so they arent garbage collected
+        self._tasks = {}
+
+    def submit(self, user_id, team_id, week_id, engine=None, options=None):
+        self._prune()
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {
+            "job_id": job_id,
+            "user_id": user_id,
+            "team_id": team_id,
+            "week_id": week_id,
+            "status": "queued",
+            "stage": "queued",
+            "progress": 0,
+            "solution_ids": [],
+            "total_solutions": 0,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+        self._tasks[job_id] = asyncio.create_task(self._run(job_id, engine, options))
+        return self.jobs[job_id]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _update(self, job_id, **changes):
+        self.jobs[job_id].update(changes)
+
+    def _prune(self):
+        # dropping finished jobs past their time to live
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for job_id, job in list(self.jobs.items()):
+            if job["finished_at"] and job["finished_at"] < cutoff:
+                del self.jobs[job_id]
+
+    async def _run(self, job_id, engine, options):
+        job = self.jobs[job_id]
+        db = SessionLocal()
+        try:
+            self._update(job_id, status="running", stage="loading", progress=10)
+            request_data = create_schedule(db, job["team_id"], job["week_id"])
+            options = dict(options or {})
+            if options.pop("warm_start", False):
+                options["hint"] = load_previous_roster(db, job["team_id"])
+
+            self._update(job_id, stage="solving", progress=30)
+            cache_key = fingerprint(request_data, engine, options)
+            result = solver_cache.get(cache_key)
+            key = (job["team_id"], job["week_id"])
+            if result is None:
+                # the employer sees the search go on over the websocket and can cancel it there,
+                # a newer solve for the same team and week cancels this one
+                async with solve_progress.track(job["user_id"], "schedule_job", [key]) as progress:
+                    result = await solver_pool.run(run_assignment_solver, request_data, engine, options, progress, cancel=progress.cancel)
+                solver_cache.put(cache_key, result)
+                solve_progress.raise_if_stopped(progress, result)
+            else:
+                solve_progress.supersede(key)
+            if not result["assignments"]:
+                reasons = result.get("failure_reasons") or ["No valid shift assignments found"]
+                raise HTTPException(status_code=400, detail=reasons[0])
+            # a partial roster from the time limit has empty slots, so it isnt saved
+            if result.get("timed_out"):
+                raise HTTPException(status_code=400, detail=f"{result['message']}, it was not saved")
+
+            self._update(job_id, stage="saving", progress=90)
+            solution_ids = save_generated_solutions(db, job["team_id"], job["week_id"], result["assignments"])
+            self._update(
+                job_id, status="completed", stage="completed", progress=100,
+                solution_ids=solution_ids, total_solutions=result["total_solutions"],
+            )
+        except HTTPException as e:
+            status = "cancelled" if e.status_code == 409 else "failed"
+            self._update(job_id, status=status, stage=status, error=e.detail)
+        except Exception as e:
+            print(f"[JOB] Schedule job {job_id} failed: {e}")
+            self._update(job_id, status="failed", stage="failed", error="Schedule generation failed")
+        finally:
+            db.close()
+            self._update(job_id, finished_at=time.time())
+            self._tasks.pop(job_id, None)
+
+        # letting the employer know the job finished
+        await manager.send_to_user(str(job["user_id"]), json.dumps({
+            "type": "schedule_job",
+            "job_id": job_id,
+            "status": job["status"],
+            "solution_ids": job["solution_ids"],
+            "error": job["error"],
+        }))
+
+
+# Create a global instance of ScheduleJobManager
+schedule_jobs = ScheduleJobManager()
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import multiprocessing
+import queue
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from app.CSPs.progress import ProgressChannel, PROGRESS_INTERVAL_MS
+from app.services.websocket_manager import manager
+
+# what the employer is told when a solve is stopped before its roster is saved
+STOP_DETAILS = {
+    "cancelled": "The solve was cancelled",
+    "superseded": "A newer solve for this week replaced this one",
+}
+
+
+class SolveProgress:
+    # Keeps track of the solves running in the solver pool, streams their progress to the employer
+    # who started them over the websocket and lets them cancel a solve over the same connection.
+    # Each solve gets a ProgressChannel whose queue and cancel flag live in a multiprocessing
+    # manager, so the solver can use them from a solver pool worker. While the solve runs its
+    # events are read off the queue and sent on as they come in.
+    # A solve can be registered under keys like (team_id, week_id), one per week it covers, and
+    # only one solve runs per key: a new one cancels the one already running, so its worker is
+    # freed straight away and only the newest roster gets saved.
+    # A solve that ends with an error (like the solver pool timing out) is cancelled as well, so
+    # a worker still searching for it stops.
+    def __init__(self, interval_ms=PROGRESS_INTERVAL_MS):
+        self.interval_ms = interval_ms
+        # solve_id -> {"user_id", "kind", "keys", "channel"}
+        self.solves = {}
+        # key -> solve_id of the newest solve for it
+        self.current = {}
+        self._manager = None
+
+    def _get_manager(self):
+        # started on first use, spawn avoids forking the running server
+        if self._manager is None:
+            self._manager = multiprocessing.get_context("spawn").Manager()
+        return self._manager
+
+    @asynccontextmanager
+    async def track(self, user_id, kind, keys=()):
+        # gives a channel to pass to the solver, its stop_reason says why it was cancelled
+        user_id = str(user_id)
+        keys = list(keys)
+        shared = self._get_manager()
+        solve_id = uuid.uuid4().hex
+        channel = ProgressChannel(solve_id, shared.Queue(), shared.Event(), self.interval_ms)
+        self.solves[solve_id] = {"user_id": user_id, "kind": kind, "keys": keys, "channel": channel}
+        for key in keys:
+            # a newer solve for the same key replaces the one still running
+            self.supersede(key)
+            self.current[key] = solve_id
+        # the solve id comes first so the employer can cancel before the solver even starts
+        await self._send(user_id, {"type": "solve_progress", "solve_id": solve_id, "stage": "queued", "kind": kind})
+        forwarding = asyncio.create_task(self._forward(user_id, channel))
+        status = "failed"
+        try:
+            yield channel
+            status = channel.stop_reason or "finished"
+        except BaseException:
+            # a timed out or failed solve (or a request dropped while it waits) can leave its worker
+            # searching with nothing else to stop it
+            self._stop(solve_id, channel.stop_reason or "cancelled")
+            raise
+        finally:
+            forwarding.cancel()
+            # whatever came in after the last read still goes out, then the end of the solve
+            for event in await asyncio.to_thread(self._drain, channel):
+                await self._send(user_id, event)
+            await self._send(user_id, {"type": "solve_progress", "solve_id": solve_id, "stage": status, "kind": kind})
+            self.solves.pop(solve_id, None)
+            for key in keys:
+                if self.current.get(key) == solve_id:
+                    del self.current[key]
+
+    def _stop(self, solve_id, reason):
+        channel = self.solves[solve_id]["channel"]
+        channel.stop_reason = reason
+        channel.cancel.set()
+
+    def cancel(self, user_id, solve_id):
+        # only the user who started a solve can cancel it, returns whether it was cancelled
+        solve = self.solves.get(solve_id)
+        if not solve or solve["user_id"] != str(user_id):
+            return False
+        self._stop(solve_id, "cancelled")
+        return True
+
+    def supersede(self, key):
+        # stopping the solve running for a key as a newer roster is on its way (or already there)
+        solve_id = self.current.pop(key, None)
+        if solve_id in self.solves:
+            self._stop(solve_id, "superseded")
+
+    def cancel_key(self, key):
+        # cancelling the solve running for a key (like a team and week), returns whether there was one
+        solve_id = self.current.get(key)
+        if solve_id not in self.solves:
+            return False
+        self._stop(solve_id, "cancelled")
+        return True
+
+    @staticmethod
+    def raise_if_stopped(channel, result):
+        # a cancelled roster isnt saved, nor one that was replaced while it was being finished
+        reason = channel.stop_reason or ("cancelled" if result.get("cancelled") else None)
+        if reason:
+            raise HTTPException(status_code=409, detail=STOP_DETAILS[reason])
+
+    @staticmethod
+    def _drain(channel):
+        # everything waiting on the queue, read in a thread as the manager calls block
+        events = []
+        while True:
+            try:
+                events.append(channel.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    async def _forward(self, user_id, channel):
+        while True:
+            for event in await asyncio.to_thread(self._drain, channel):
+                await self._send(user_id, event)
+            await asyncio.sleep(self.interval_ms / 1000.0)
+
+    async def _send(self, user_id, event):
+        # the events are only sent while the user has a websocket open
+        if manager.is_connected(user_id):
+            await manager.send_to_user(user_id, json.dumps(event))
+
+    def shutdown(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+# Create a global instance of SolveProgress
+solve_progress = SolveProgress()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import time as time_of_day
+from dotenv import load_dotenv
+from app.CSPs.engines import DEFAULT_ENGINE
+
+load_dotenv()
+
+# how many solver results are kept in memory, the least recently used go first
+SOLVER_CACHE_SIZE = int(os.getenv("SOLVER_CACHE_SIZE", 128))
+# how long a cached result can be reused for
+SOLVER_CACHE_TTL_SECONDS = float(os.getenv("SOLVER_CACHE_TTL_SECONDS", 600))
+# optional folder to also keep the results on disk, so they survive a restart and are shared by workers
+SOLVER_CACHE_DIR = os.getenv("SOLVER_CACHE_DIR") or None
+
+
+def _normalize_time(value):
+    # shift times come in as "HH:MM" strings or datetime.time objects
+    if isinstance(value, time_of_day):
+        return value.strftime("%H:%M")
+    return value
+
+
+# turning the solver input into one canonical form, so the same team and week always gives the
+# same fingerprint whatever order the rows came out of the database in
+def fingerprint(request_data, engine=None, options=None):
+    canonical = {
+        "engine": engine or DEFAULT_ENGINE,
+        "users": sorted(request_data["users"]),
+        "shifts": sorted((s["shift_id"], s["day_id"], s["slot"]) for s in request_data["shifts"]),
+        "shift_details": sorted(
+            (d["id"], _normalize_time(d["start"]), _normalize_time(d["end"]), d["users"])
+            for d in request_data["shift_details"]
+        ),
+        "user_availability": sorted({(ua["user_id"], ua["day_id"]) for ua in request_data["user_availability"]}),
+        "user_expertise": sorted({(ue["user_id"], ue["expertise_id"]) for ue in request_data["user_expertise"]}),
+        "shift_expertise": sorted({(se["shift_id"], se["expertise_id"]) for se in request_data["shift_expertise"]}),
+        "fixed_assignments": sorted(
+            (a["shift_id"], a["day_id"], a["slot"], a["user_id"]) for a in request_data.get("fixed_assignments", [])
+        ),
+        "options": options or {},
+    }
+    encoded = json.dumps(canonical, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class SolverCache:
+    # Remembers solver results by the fingerprint of their input, so pressing generate again for
+    # the same team and week with nothing changed returns straight away. Any change to the users,
+    # shifts, days off, expertise or settings gives a new fingerprint, so a stale roster is never
+    # returned. Results that ran out of time or were cancelled are not kept as a second try
+    # could do better.
+    def __init__(self, size=SOLVER_CACHE_SIZE, ttl=SOLVER_CACHE_TTL_SECONDS, directory=SOLVER_CACHE_DIR):
+        self.size = size
+        self.ttl = ttl
+        self.directory = directory
+        # fingerprint -> (stored at, result), oldest use first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _expired(self, stored_at):
+        return time.time() - stored_at > self.ttl
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key)) as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return entry["stored_at"], entry["result"]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self.directory:
+            entry = self._read_disk(key)
+        if entry is None or self._expired(entry[0]):
+            self._drop(key)
+            self.misses += 1
+            return None
+        # marking it as the most recently used
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        if result.get("timed_out") or result.get("cancelled"):
+            return
+        entry = (time.time(), result)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if self.directory:
+            with open(self._path(key), "w") as file:
+                json.dump({"stored_at": entry[0], "result": result}, file)
+        # dropping the least recently used results past the size limit
+        while len(self._entries) > self.size:
+            oldest, _ = self._entries.popitem(last=False)
+            self._drop(oldest)
+        if self.directory:
+            self._trim_disk()
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _trim_disk(self):
+        # other workers write to the same folder, so it is trimmed by age as well
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(files) <= self.size:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for key in list(self._entries):
+            self._drop(key)
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "size": self.size,
+            "ttl_seconds": self.ttl,
+            "disk": bool(self.directory),
+        }
+
+
+# Create a global instance of SolverCache
+solver_cache = SolverCache()
@@ -0,0 +1,75 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+load_dotenv()
+
+# number of worker processes solving rosters, defaults to every core on the machine
+SOLVER_WORKERS = int(os.getenv("SOLVER_WORKERS", os.cpu_count() or 1))
+# how many solves can be running or waiting at once before new ones are turned away
+SOLVER_MAX_PENDING = int(os.getenv("SOLVER_MAX_PENDING", SOLVER_WORKERS * 2))
+# how long a request waits for a solve before giving up, the solve itself is stopped by then too
+SOLVER_TIMEOUT_SECONDS = float(os.getenv("SOLVER_TIMEOUT_SECONDS", 60))
+
+
+class SolverPool:
+    # Runs the CPU heavy solvers in separate processes so the event loop
+    # (and every other request and websocket on the worker) keeps responding.
+    def __init__(self, workers=SOLVER_WORKERS, max_pending=SOLVER_MAX_PENDING, timeout=SOLVER_TIMEOUT_SECONDS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+
+    def _get_executor(self):
+        # creating the processes on first use, spawn avoids forking the running server
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def run(self, func, *args, cancel=None):
+        # func gets a deadline keyword (seconds since the epoch) it has to finish by, and cancel
+        # is an optional event the solve watches, set when the request gives up on it
+        # turning the request away straight away if the queue is full
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="The scheduler is busy, please try again shortly",
+                headers={"Retry-After": "5"},
+            )
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # the time spent waiting for a free worker counts, so the deadline is set from now
+            deadline = time.time() + self.timeout
+            future = loop.run_in_executor(self._get_executor(), partial(func, *args, deadline=deadline))
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            # the worker keeps going after the request gives up, so it is told to stop
+            # and is free for the next solve
+            if cancel is not None:
+                cancel.set()
+            raise HTTPException(
+                status_code=504,
+                detail=f"Solving took longer then {self.timeout:g} seconds",
+            )
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Create a global instance of SolverPool
+solver_pool = SolverPool()
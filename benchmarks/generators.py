@@ -0,0 +1,94 @@
+# synthetic team generators for the solver benchmarks
+# every generator returns data in the same shape create_schedule builds for the solvers
+import random
+from datetime import time
+
+
+def generate_team(n_users=20, n_shifts=4, max_users_per_shift=3, n_expertise=3,
+                  expertise_density=0.3, availability_rate=0.1, overnight_rate=0.25,
+                  days=range(1, 8), seed=0):
+    # seeded so every engine gets the exact same team
+    rng = random.Random(seed)
+    users = list(range(1, n_users + 1))
+
+    shift_details = []
+    shift_expertise = []
+    for shift_id in range(1, n_shifts + 1):
+        if rng.random() < overnight_rate:
+            # night shifts run past midnight
+            start_hour = rng.choice([20, 21, 22, 23])
+        else:
+            start_hour = rng.choice([6, 7, 8, 9, 10, 12, 14])
+        length = rng.choice([6, 8, 10, 12])
+        shift_details.append({
+            "id": shift_id,
+            "start": time(start_hour, 0),
+            "end": time((start_hour + length) % 24, 0),
+            "users": rng.randint(1, max_users_per_shift),
+        })
+        # some shifts need one expertise out of the pool
+        if n_expertise and rng.random() < expertise_density:
+            shift_expertise.append({"shift_id": shift_id, "expertise_id": rng.randint(1, n_expertise)})
+
+    user_expertise = []
+    for user in users:
+        for expertise_id in range(1, n_expertise + 1):
+            if rng.random() < expertise_density:
+                user_expertise.append({"user_id": user, "expertise_id": expertise_id})
+
+    # approved days off
+    user_availability = [
+        {"user_id": user, "day_id": day}
+        for user in users for day in days
+        if rng.random() < availability_rate
+    ]
+
+    # every shift runs every day, expanded into one slot per user needed
+    shifts = [
+        {"day_id": day, "shift_id": detail["id"], "slot": slot}
+        for day in days for detail in shift_details for slot in range(detail["users"])
+    ]
+
+    return {
+        "users": users,
+        "shifts": shifts,
+        "shift_details": shift_details,
+        "user_availability": user_availability,
+        "user_expertise": user_expertise,
+        "shift_expertise": shift_expertise,
+    }
+
+
+# turning a generated team plus a roster into the data regenerate_solution builds
+# a share of the slots are locked and some extra days off are approved to force changes
+def generate_regeneration(request_data, roster, lock_rate=0.2, new_unavailable=2, seed=0):
+    rng = random.Random(seed)
+    original_assignments = [
+        {"user_id": a["user_id"], "shift_id": a["shift_id"], "day_id": a["day_id"], "slot": a["slot"]}
+        for a in roster
+    ]
+    locked_keys = {
+        (a["shift_id"], a["day_id"], a["slot"]) for a in original_assignments if rng.random() < lock_rate
+    }
+    locked_assignments = [
+        a for a in original_assignments if (a["shift_id"], a["day_id"], a["slot"]) in locked_keys
+    ]
+    user_availability = list(request_data["user_availability"])
+    unlocked = [a for a in original_assignments if (a["shift_id"], a["day_id"], a["slot"]) not in locked_keys]
+    for a in rng.sample(unlocked, min(new_unavailable, len(unlocked))):
+        user_availability.append({"user_id": a["user_id"], "day_id": a["day_id"]})
+
+    return {
+        "users": request_data["users"],
+        "shifts": [
+            {"shift_id": a["shift_id"], "day_id": a["day_id"], "slot": a["slot"],
+             "locked": (a["shift_id"], a["day_id"], a["slot"]) in locked_keys}
+            for a in original_assignments
+        ],
+        "user_availability": user_availability,
+        "user_expertise": request_data["user_expertise"],
+        "shift_expertise": request_data["shift_expertise"],
+        "shift_details": request_data["shift_details"],
+        "original_assignments": original_assignments,
+        "locked_assignments": locked_assignments,
+    }
@@ -0,0 +1,212 @@
+# Benchmark harness for the shift assignment solvers
+#
+# Runs every engine (and RegenerateCSP) over synthetic teams and prints the results as JSON:
+#   python -m benchmarks.solver_benchmark
+#   python -m benchmarks.solver_benchmark --scenario large --seeds 5 --timeout 30
+#   python -m benchmarks.solver_benchmark --output bench.json --baseline old_bench.json
+#
+# Each solve runs in its own process so a search that never returns can be stopped at the timeout.
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from constraint import Constraint
+from app.CSPs.engines import ENGINES
+from app.CSPs.cpsat_solver import CPSATShiftSolver
+from app.CSPs.regen_csp import RegenerateCSP
+from benchmarks.generators import generate_team, generate_regeneration
+
+# team sizes the benchmark runs by default
+SCENARIOS = {
+    "small": {"n_users": 8, "n_shifts": 3, "max_users_per_shift": 2},
+    "medium": {"n_users": 20, "n_shifts": 5, "max_users_per_shift": 3},
+    "large": {"n_users": 50, "n_shifts": 8, "max_users_per_shift": 4},
+    "expert-heavy": {"n_users": 25, "n_shifts": 5, "max_users_per_shift": 3, "expertise_density": 0.6},
+    "overnight-heavy": {"n_users": 25, "n_shifts": 5, "max_users_per_shift": 3, "overnight_rate": 0.6},
+    "tight-availability": {"n_users": 25, "n_shifts": 5, "max_users_per_shift": 3, "availability_rate": 0.3},
+    # a roster over four weeks, where the day limit holds over every 7 days in a row
+    "large-4-weeks": {"n_users": 50, "n_shifts": 8, "max_users_per_shift": 4, "days": list(range(1, 29))},
+}
+
+
+class NodeCounter(Constraint):
+    # Counts how many values the backtracking search tries.
+    # It is added first on every variable so it runs once per value tried and never prunes.
+    def __init__(self):
+        self.nodes = 0
+
+    def __call__(self, variables, domains, assignments, forwardcheck=False):
+        self.nodes += 1
+        return True
+
+    def preProcess(self, variables, domains, constraints, vconstraints):
+        # single variable constraints normally get removed here, the counter has to stay
+        pass
+
+
+def _count_nodes(problem):
+    # putting the counter in front of every other constraint
+    counter = NodeCounter()
+    for variable in problem._variables:
+        problem._constraints.insert(0, (counter, [variable]))
+    return counter
+
+
+def _build_solver(engine, request_data):
+    if engine == "regen":
+        return RegenerateCSP(**request_data)
+    if engine == "repair":
+        return RegenerateCSP(**request_data, mode="repair")
+    if engine == "csp":
+        # solved as one problem, split into components the counter would sit on a problem that
+        # is never searched and report 0 nodes
+        return ENGINES[engine](**request_data, decompose=False)
+    return ENGINES[engine](**request_data)
+
+
+def _run_once(engine, request_data, queue):
+    # building and solving inside the child process, timing both steps
+    # the solvers print debug messages, keeping them out of the JSON report
+    sys.stdout = open(os.devnull, "w")
+    tracemalloc.start()
+    start = time.perf_counter()
+    solver = _build_solver(engine, request_data)
+    counter = _count_nodes(solver.problem) if hasattr(solver, "problem") else None
+    built = time.perf_counter()
+    result = solver.solve()
+    finished = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if counter is not None:
+        nodes = counter.nodes
+    elif isinstance(solver, CPSATShiftSolver):
+        nodes = solver.stats.get("branches", 0)
+    else:
+        nodes = None
+
+    queue.put({
+        "status": "solved" if result["assignments"] else "no_solution",
+        "build_seconds": built - start,
+        "solve_seconds": finished - built,
+        "wall_seconds": finished - start,
+        "nodes": nodes,
+        "peak_memory_bytes": peak,
+    })
+
+
+def run_case(engine, request_data, timeout):
+    # running one solve in a child process and stopping it if it goes over the timeout
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_once, args=(engine, request_data, queue))
+    start = time.perf_counter()
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        return {"status": "timeout", "wall_seconds": time.perf_counter() - start, "nodes": None, "peak_memory_bytes": None}
+    if queue.empty():
+        return {"status": "error", "wall_seconds": time.perf_counter() - start, "nodes": None, "peak_memory_bytes": None}
+    return queue.get()
+
+
+def _summary(runs):
+    solved = [r for r in runs if r["status"] == "solved"]
+    times = sorted(r["wall_seconds"] for r in solved)
+    return {
+        "runs": len(runs),
+        "success_rate": len(solved) / len(runs) if runs else 0.0,
+        "timeouts": sum(1 for r in runs if r["status"] == "timeout"),
+        "median_wall_seconds": times[len(times) // 2] if times else None,
+        "max_wall_seconds": times[-1] if times else None,
+        "max_peak_memory_bytes": max((r["peak_memory_bytes"] for r in solved), default=None),
+        "max_nodes": max((r["nodes"] for r in solved if r["nodes"] is not None), default=None),
+    }
+
+
+def run_benchmark(scenarios, engines, seeds, timeout, include_regen=True):
+    report = {"timeout_seconds": timeout, "seeds": seeds, "scenarios": {}}
+    for name in scenarios:
+        scenario = {"params": SCENARIOS[name], "engines": {}}
+        teams = [generate_team(seed=seed, **SCENARIOS[name]) for seed in range(seeds)]
+        for engine in engines:
+            runs = [run_case(engine, team, timeout) for team in teams]
+            scenario["engines"][engine] = {"summary": _summary(runs), "runs": runs}
+
+        if include_regen:
+            # regeneration (a different roster and a minimal change repair) starts from a
+            # cp-sat roster for the same team
+            runs = {"regen": [], "repair": []}
+            for seed, team in enumerate(teams):
+                roster = CPSATShiftSolver(**team).solve()["assignments"]
+                for mode, mode_runs in runs.items():
+                    if not roster:
+                        mode_runs.append({"status": "no_solution", "wall_seconds": 0.0, "nodes": None, "peak_memory_bytes": None})
+                        continue
+                    regen_data = generate_regeneration(team, roster[0], seed=seed)
+                    mode_runs.append(run_case(mode, regen_data, timeout))
+            for mode, mode_runs in runs.items():
+                scenario["engines"][mode] = {"summary": _summary(mode_runs), "runs": mode_runs}
+        report["scenarios"][name] = scenario
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    # listing every scenario/engine that got slower or solves less often then the baseline
+    regressions = []
+    for name, scenario in report["scenarios"].items():
+        for engine, result in scenario["engines"].items():
+            old = baseline.get("scenarios", {}).get(name, {}).get("engines", {}).get(engine)
+            if not old:
+                continue
+            new_summary, old_summary = result["summary"], old["summary"]
+            if new_summary["success_rate"] < old_summary["success_rate"]:
+                regressions.append(f"{name}/{engine}: success rate {old_summary['success_rate']:.2f} -> {new_summary['success_rate']:.2f}")
+            old_time, new_time = old_summary["median_wall_seconds"], new_summary["median_wall_seconds"]
+            if old_time and new_time and new_time > old_time * tolerance:
+                regressions.append(f"{name}/{engine}: median time {old_time:.3f}s -> {new_time:.3f}s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the roster solvers on synthetic teams")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run (default: all)")
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES), help="engine to run (default: all)")
+    parser.add_argument("--seeds", type=int, default=3, help="number of generated teams per scenario")
+    parser.add_argument("--timeout", type=float, default=20.0, help="seconds before a solve counts as failed")
+    parser.add_argument("--no-regen", action="store_true", help="skip the RegenerateCSP runs (regen and repair)")
+    parser.add_argument("--output", help="file to write the JSON report to (default: stdout)")
+    parser.add_argument("--baseline", help="previous JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor against the baseline")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        scenarios=args.scenario or list(SCENARIOS),
+        engines=args.engine or list(ENGINES),
+        seeds=args.seeds,
+        timeout=args.timeout,
+        include_regen=not args.no_regen,
+    )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[REGRESSION] {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+# Tests for generating the rosters of many teams at once
+import asyncio
+from unittest.mock import patch, MagicMock
+from fastapi import HTTPException
+from app.services.batch_schedule import run_batch, _team_week
+from test_solvers import make_request_data, assert_valid_roster
+from test_schedule_jobs import local_progress
+
+
+# Stands in for the solver pool, solving straight in the test process
+class InlinePool:
+    workers = 2
+
+    def __init__(self):
+        self.calls = 0
+
+    async def run(self, func, *args, cancel=None):
+        self.calls += 1
+        return func(*args)
+
+
+@patch("app.services.batch_schedule.solve_progress", new_callable=local_progress)
+@patch("app.services.batch_schedule.solver_cache")
+@patch("app.services.batch_schedule.save_team_rosters")
+@patch("app.services.batch_schedule.create_schedules")
+def test_batch_solves_every_team_and_saves_once(mock_create_schedules, mock_save, mock_cache, mock_progress):
+    impossible = make_request_data()
+    # nobody has the expertise the third shift needs
+    impossible["user_expertise"] = []
+    mock_create_schedules.return_value = {(1, 5): make_request_data(), (2, 5): impossible, (3, 5): make_request_data()}
+    mock_save.return_value = [10, 11]
+    mock_cache.get.return_value = None
+    pool = InlinePool()
+
+    # team 4 asked for a week that doesnt exist
+    report = asyncio.run(run_batch(MagicMock(), [(1, 5), (2, 5), (3, 5), (4, 5)], "cpsat", {}, pool))
+
+    assert pool.calls == 3
+    assert (report["completed"], report["failed"]) == (2, 2)
+    teams = {team["team_id"]: team for team in report["teams"]}
+    assert teams[1]["status"] == "completed" and teams[1]["solution_ids"] == [10]
+    assert teams[3]["solution_ids"] == [11]
+    assert teams[2]["error"] == "Nobody with the required expertise is available for shift 3 on day 1"
+    assert teams[4]["error"] == "Week not found" and teams[4]["solve_seconds"] == 0.0
+    # both rosters went to the database in a single save
+    mock_save.assert_called_once()
+    team_rosters = mock_save.call_args.args[1]
+    assert [(team_id, week_id) for team_id, week_id, _ in team_rosters] == [(1, 5), (3, 5)]
+    assert_valid_roster(make_request_data(), team_rosters[0][2])
+
+
+@patch("app.services.batch_schedule.solve_progress", new_callable=local_progress)
+@patch("app.services.batch_schedule.solver_cache")
+@patch("app.services.batch_schedule.save_team_rosters")
+@patch("app.services.batch_schedule.create_schedules")
+def test_batch_reports_a_busy_pool_per_team(mock_create_schedules, mock_save, mock_cache, mock_progress):
+    mock_create_schedules.return_value = {(1, 5): make_request_data()}
+    mock_cache.get.return_value = None
+    pool = InlinePool()
+
+    async def busy(func, *args, cancel=None):
+        raise HTTPException(status_code=503, detail="The scheduler is busy, please try again shortly")
+    pool.run = busy
+
+    report = asyncio.run(run_batch(MagicMock(), [(1, 5)], None, {}, pool))
+
+    assert report["teams"][0]["status"] == "failed"
+    assert report["teams"][0]["error"] == "The scheduler is busy, please try again shortly"
+    mock_save.assert_not_called()
+
+
+@patch("app.services.batch_schedule.solve_progress", new_callable=local_progress)
+@patch("app.services.batch_schedule.solver_cache")
+@patch("app.services.batch_schedule.save_team_rosters")
+@patch("app.services.batch_schedule.create_schedules")
+def test_batch_doesnt_save_a_partial_roster(mock_create_schedules, mock_save, mock_cache, mock_progress):
+    mock_create_schedules.return_value = {(1, 5): make_request_data()}
+    mock_cache.get.return_value = None
+    pool = InlinePool()
+
+    async def partial(func, *args, cancel=None):
+        return {
+            "assignments": [[{"user_id": 1, "shift_id": 1, "day_id": 1, "slot": 0}]],
+            "total_solutions": 0,
+            "timed_out": True,
+            "message": "Time limit of 5 ms reached, returning the best partial roster",
+        }
+    pool.run = partial
+
+    report = asyncio.run(run_batch(MagicMock(), [(1, 5)], None, {"time_limit_ms": 5}, pool))
+
+    team = report["teams"][0]
+    assert team["status"] == "failed" and team["timed_out"]
+    assert team["error"] == "Time limit of 5 ms reached, returning the best partial roster, it was not saved"
+    mock_save.assert_not_called()
+
+
+@patch("app.services.batch_schedule.solve_progress", new_callable=local_progress)
+@patch("app.services.batch_schedule.solver_cache")
+@patch("app.services.batch_schedule.save_team_rosters")
+@patch("app.services.batch_schedule.create_schedules")
+def test_batch_skips_a_roster_replaced_before_the_save(mock_create_schedules, mock_save, mock_cache, mock_progress):
+    mock_create_schedules.return_value = {(1, 5): make_request_data(), (2, 5): make_request_data()}
+    mock_save.return_value = [11]
+    mock_cache.get.return_value = None
+    pool = InlinePool()
+    cancels = []
+
+    async def solve(func, *args, cancel=None):
+        cancels.append(cancel)
+        # a newer solve for team 1 starts while team 2 is still solving
+        if len(cancels) == 2:
+            mock_progress.supersede((1, 5))
+        return func(*args)
+    pool.run = solve
+
+    report = asyncio.run(run_batch(MagicMock(), [(1, 5), (2, 5)], None, {}, pool, user_id=7))
+
+    teams = {team["team_id"]: team for team in report["teams"]}
+    assert teams[1]["status"] == "failed" and teams[1]["error"] == "A newer solve for this week replaced this one"
+    assert teams[2]["status"] == "completed" and teams[2]["solution_ids"] == [11]
+    assert cancels[0].is_set() and not cancels[1].is_set()
+    team_rosters = mock_save.call_args.args[1]
+    assert [(team_id, week_id) for team_id, week_id, _ in team_rosters] == [(2, 5)]
+    # every solve is done with once the batch is saved
+    assert mock_progress.solves == {} and mock_progress.current == {}
+
+
+def test_team_week_argument():
+    assert _team_week("3:12") == (3, 12)
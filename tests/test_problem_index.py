@@ -0,0 +1,58 @@
+# Tests for the shared integer form of a roster problem
+import random
+from app.CSPs.problem_index import ProblemIndex
+from test_solvers import make_request_data
+
+
+def make_index(request_data):
+    return ProblemIndex(
+        request_data["users"], request_data["shifts"], request_data["shift_details"],
+        request_data["user_availability"], request_data["user_expertise"], request_data["shift_expertise"],
+    )
+
+
+def test_index_masks_availability_and_minutes():
+    request_data = make_request_data()
+    index = make_index(request_data)
+
+    # only users 5 and 6 have the expertise bit shift 3 needs, the other shifts need nothing
+    assert [u for u in index.users if index.qualified(u, 3)] == [5, 6]
+    assert all(index.qualified(u, 1) for u in index.users)
+
+    # user 1 is off on day 1 and user 2 on day 3
+    assert index.available.shape == (8, 7)
+    assert not index.available[index.user_index[1], index.day_index[1]]
+    assert not index.available[index.user_index[2], index.day_index[3]]
+    assert index.available.sum() == 8 * 7 - 2
+
+    # the night shift runs from 22:00 to 06:00 the next morning
+    assert index.shift_minutes[2] == (22 * 60, 30 * 60)
+    assert index.shift_hours[2] == 8
+
+
+def test_index_domains_follow_the_team_order():
+    request_data = make_request_data()
+    request_data["users"] = [8, 7, 6, 5, 4, 3, 2, 1]
+    domains = make_index(request_data).domains()
+
+    # one key per slot, in the order the team was given in
+    assert len(domains) == len(request_data["shifts"])
+    assert domains[1, 1, 0] == [8, 7, 6, 5, 4, 3, 2]
+    assert domains[3, 3, 0] == [6, 5]
+
+
+def test_vectorized_domains_match_a_plain_check():
+    # a bigger random team with more expertise then fit in one 64 bit word
+    random.seed(7)
+    request_data = make_request_data()
+    request_data["users"] = list(range(1, 61))
+    request_data["user_availability"] = [{"user_id": u, "day_id": random.randint(1, 7)} for u in range(1, 61)]
+    request_data["user_expertise"] = [{"user_id": u, "expertise_id": random.randint(1, 80)} for u in range(1, 61) for _ in range(3)]
+    request_data["shift_expertise"] = [{"shift_id": 3, "expertise_id": e} for e in range(60, 81)]
+    domains = make_index(request_data).domains()
+
+    off = {(ua["user_id"], ua["day_id"]) for ua in request_data["user_availability"]}
+    experts = {ue["user_id"] for ue in request_data["user_expertise"] if ue["expertise_id"] >= 60}
+    for (sid, day, slot), users in domains.items():
+        expected = [u for u in request_data["users"] if (u, day) not in off and (sid != 3 or u in experts)]
+        assert users == expected
@@ -0,0 +1,259 @@
+# Tests for solver progress events and cancelling a solve
+import asyncio
+import json
+import queue
+import time
+import threading
+import pytest
+from unittest.mock import patch, AsyncMock
+from fastapi import HTTPException
+from app.CSPs.progress import ProgressChannel
+from app.CSPs.solver_csp import ShiftAssignmentSolver
+from app.CSPs.cpsat_solver import CPSATShiftSolver
+from app.CSPs.regen_csp import RegenerateCSP
+from app.services.solve_progress import SolveProgress
+from app.services.solver_pool import SolverPool
+from app.CSPs.engines import run_assignment_solver
+from test_solvers import make_request_data, make_regeneration_data, assert_valid_roster
+
+
+# A channel on a plain queue, the same as the one the server hands to a worker
+def make_channel(interval_ms=0):
+    return ProgressChannel("abc", queue.Queue(), threading.Event(), interval_ms)
+
+
+def read_events(channel):
+    events = []
+    while not channel.events.empty():
+        events.append(channel.events.get())
+    return events
+
+
+def test_channel_rate_limits_search_updates():
+    channel = make_channel(interval_ms=60000)
+    assert channel.emit("searching", nodes=64)
+    # too soon after the last one, but a forced event always goes through
+    assert not channel.emit("searching", nodes=128)
+    assert channel.emit("solution_found", force=True, best_objective=3.0)
+
+    events = read_events(channel)
+    assert [e["stage"] for e in events] == ["searching", "solution_found"]
+    assert events[0] == {"type": "solve_progress", "solve_id": "abc", "stage": "searching", "nodes": 64}
+
+
+def test_channel_rate_limits_each_stage_on_its_own():
+    channel = make_channel(interval_ms=60000)
+    assert channel.emit("searching", nodes=64)
+    # a new roster isnt held back by the search updates, nor a forced event by the last roster
+    assert channel.emit("solution_found", best_objective=3.0)
+    assert channel.emit("searching", force=True, nodes=128)
+    assert not channel.emit("solution_found", best_objective=2.0)
+    assert not channel.emit("searching", nodes=256)
+
+    assert [e.get("nodes") for e in read_events(channel)] == [64, None, 128]
+
+
+def test_csp_reports_progress_while_solving():
+    request_data = make_request_data()
+    channel = make_channel()
+    solver = ShiftAssignmentSolver(**request_data, decompose=False, progress=channel)
+    # checking on every node so even this small team reports its search
+    solver.search.check_every = 1
+    result = solver.solve()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+    stages = [e["stage"] for e in read_events(channel)]
+    assert stages[0] == "model_built"
+    assert "searching" in stages
+    assert stages[-1] == "solution_found"
+
+
+def test_csp_stops_when_cancelled():
+    request_data = make_request_data()
+    channel = make_channel()
+    channel.cancel.set()
+    solver = ShiftAssignmentSolver(**request_data, decompose=False, progress=channel)
+    solver.search.check_every = 4
+    result = solver.solve()
+
+    # the few slots filled before the cancel come back as a partial roster, marked as cancelled
+    assert result["cancelled"] and not result["timed_out"]
+    assert result["total_solutions"] == 0
+    assert "Solve cancelled before this slot could be filled" in result["failure_reasons"]
+    assert solver.search.nodes == 4
+
+
+def test_regeneration_stops_when_cancelled():
+    request_data = make_request_data()
+    roster = CPSATShiftSolver(**request_data).solve()["assignments"][0]
+    channel = make_channel()
+    channel.cancel.set()
+    solver = RegenerateCSP(**make_regeneration_data(request_data, roster), mode="repair", progress=channel)
+    solver.search.check_every = 1
+    result = solver.solve()
+
+    assert result["cancelled"]
+    assert result["assignments"] == []
+    assert read_events(channel)[0]["stage"] == "model_built"
+
+
+def test_cpsat_reports_each_roster_found():
+    request_data = make_request_data()
+    channel = make_channel()
+    result = CPSATShiftSolver(**request_data, progress=channel).solve()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+    stages = [e["stage"] for e in read_events(channel)]
+    assert stages[0] == "model_built"
+    assert "solution_found" in stages
+
+
+def test_cpsat_rate_limits_rosters_after_the_first():
+    request_data = make_request_data()
+    channel = make_channel(interval_ms=60000)
+    result = CPSATShiftSolver(**request_data, objective="fairness", progress=channel).solve()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+    # the optimizing search finds several rosters, only the first one is sent straight away
+    stages = [e["stage"] for e in read_events(channel)]
+    assert stages == ["model_built", "solution_found"]
+
+
+# A multiprocessing manager stand in, so the test doesnt start another process
+class LocalShared:
+    Queue = queue.Queue
+    Event = threading.Event
+
+
+@patch("app.services.solve_progress.manager")
+def test_progress_is_forwarded_to_the_employer(mock_manager):
+    mock_manager.is_connected.return_value = True
+    mock_manager.send_to_user = AsyncMock()
+    progress = SolveProgress(interval_ms=1)
+    progress._manager = LocalShared()
+
+    async def run():
+        async with progress.track(7, "assign_shifts") as channel:
+            channel.emit("model_built", force=True, slots=28)
+            # someone else cant cancel the solve, the employer who started it can
+            assert not progress.cancel(8, channel.solve_id)
+            assert progress.cancel(7, channel.solve_id)
+        return channel
+
+    channel = asyncio.run(run())
+
+    sent = [json.loads(call.args[1]) for call in mock_manager.send_to_user.call_args_list]
+    assert all(call.args[0] == "7" for call in mock_manager.send_to_user.call_args_list)
+    assert [e["stage"] for e in sent] == ["queued", "model_built", "cancelled"]
+    assert {e["solve_id"] for e in sent} == {channel.solve_id}
+    # the finished solve is forgotten
+    assert progress.solves == {}
+
+
+@patch("app.services.solve_progress.manager")
+def test_solve_runs_without_a_websocket(mock_manager):
+    mock_manager.is_connected.return_value = False
+    mock_manager.send_to_user = AsyncMock()
+    progress = SolveProgress(interval_ms=1)
+    progress._manager = LocalShared()
+
+    async def run():
+        async with progress.track(7, "assign_shifts", [(1, 5)]) as channel:
+            channel.emit("model_built", force=True, slots=28)
+            # the solve can still be cancelled by team and week
+            assert progress.cancel_key((1, 5))
+        return channel
+
+    channel = asyncio.run(run())
+
+    assert channel.cancelled() and channel.stop_reason == "cancelled"
+    # nobody to send the events to
+    mock_manager.send_to_user.assert_not_called()
+    assert progress.current == {}
+
+
+@patch("app.services.solve_progress.manager")
+def test_newer_solve_replaces_the_running_one(mock_manager):
+    mock_manager.is_connected.return_value = False
+    progress = SolveProgress(interval_ms=1)
+    progress._manager = LocalShared()
+
+    async def run():
+        async with progress.track(7, "assign_shifts", [(1, 5)]) as first:
+            # generate pressed again for the same week while the first solve runs
+            async with progress.track(7, "schedule_job", [(1, 5)]) as second:
+                assert first.cancelled() and first.stop_reason == "superseded"
+                assert not second.cancelled()
+                # another week isnt touched
+                async with progress.track(7, "assign_shifts", [(1, 6)]) as other:
+                    pass
+                assert not other.cancelled()
+                assert progress.current[(1, 5)] == second.solve_id
+            # the first one finishing doesnt drop the newer one
+            assert progress.current == {}
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    # the replaced roster isnt saved, the newest one is
+    with pytest.raises(HTTPException) as error:
+        progress.raise_if_stopped(first, {"assignments": [{}], "cancelled": False})
+    assert error.value.status_code == 409
+    assert error.value.detail == "A newer solve for this week replaced this one"
+    progress.raise_if_stopped(second, {"assignments": [{}]})
+
+
+@patch("app.services.solve_progress.manager")
+def test_solve_over_several_weeks_holds_every_week(mock_manager):
+    mock_manager.is_connected.return_value = False
+    progress = SolveProgress(interval_ms=1)
+    progress._manager = LocalShared()
+
+    async def run():
+        async with progress.track(7, "assign_shifts", [(1, 5), (1, 6)]) as horizon:
+            # a single week solve for the second week replaces the roster over both weeks
+            async with progress.track(7, "assign_shifts", [(1, 6)]) as single:
+                assert horizon.cancelled() and horizon.stop_reason == "superseded"
+                # and a new roster over both weeks replaces the single week again
+                async with progress.track(7, "assign_shifts", [(1, 5), (1, 6)]) as newer:
+                    assert single.cancelled()
+                    assert progress.current == {(1, 5): newer.solve_id, (1, 6): newer.solve_id}
+            assert progress.current == {}
+
+    asyncio.run(run())
+
+
+# Stands in for a solve that only stops when it is told to
+def wait_for_cancel(channel, deadline=None):
+    return channel.cancel.wait(30)
+
+
+@patch("app.services.solve_progress.manager")
+def test_timed_out_solve_stops_its_worker(mock_manager):
+    mock_manager.is_connected.return_value = False
+    pool = SolverPool(workers=1, max_pending=2, timeout=1)
+    progress = SolveProgress(interval_ms=1)
+
+    async def run():
+        with pytest.raises(HTTPException) as error:
+            async with progress.track(7, "assign_shifts", [(1, 5)]) as channel:
+                # the pool isnt given the cancel flag, so only the end of the solve can stop it
+                await pool.run(wait_for_cancel, channel)
+        assert error.value.status_code == 504
+        assert channel.cancelled()
+        assert progress.solves == {} and progress.current == {}
+
+        # the only worker is free again for the next solve
+        pool.timeout = 20
+        start = time.perf_counter()
+        result = await pool.run(run_assignment_solver, make_request_data(), "cpsat")
+        assert time.perf_counter() - start < 20
+        return result
+
+    try:
+        result = asyncio.run(run())
+    finally:
+        pool.shutdown()
+        progress.shutdown()
+
+    assert_valid_roster(make_request_data(), result["assignments"][0])
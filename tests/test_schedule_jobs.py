@@ -0,0 +1,89 @@
+# Tests for the background schedule generation jobs
+import asyncio
+import json
+import queue
+import threading
+from unittest.mock import patch, AsyncMock
+from app.services.schedule_jobs import ScheduleJobManager
+from app.services.solve_progress import SolveProgress
+from test_solvers import make_request_data
+
+
+# Runs the solver straight in the test process instead of the worker pool
+async def run_inline(func, *args, cancel=None):
+    return func(*args)
+
+
+# A solve registry on plain queues, so the tests dont start a multiprocessing manager
+class LocalShared:
+    Queue = queue.Queue
+    Event = threading.Event
+
+
+def local_progress():
+    progress = SolveProgress(interval_ms=1)
+    progress._manager = LocalShared()
+    return progress
+
+
+# Submits a job and waits for its background task to finish
+async def submit_and_wait(jobs, *args):
+    job = jobs.submit(*args)
+    await jobs._tasks[job["job_id"]]
+    return job
+
+
+@patch("app.services.schedule_jobs.solve_progress", new_callable=local_progress)
+@patch("app.services.schedule_jobs.solver_cache")
+@patch("app.services.schedule_jobs.manager")
+@patch("app.services.schedule_jobs.solver_pool")
+@patch("app.services.schedule_jobs.save_generated_solutions")
+@patch("app.services.schedule_jobs.create_schedule")
+@patch("app.services.schedule_jobs.SessionLocal")
+def test_job_completes_and_notifies_employer(mock_session, mock_create_schedule, mock_save, mock_pool, mock_manager, mock_cache, progress):
+    mock_create_schedule.return_value = make_request_data()
+    mock_cache.get.return_value = None
+    mock_pool.run = run_inline
+    mock_save.return_value = [42]
+    mock_manager.send_to_user = AsyncMock()
+
+    jobs = ScheduleJobManager()
+    job = asyncio.run(submit_and_wait(jobs, 7, 1, 5, "cpsat"))
+
+    # the job was updated in place and can be polled by id
+    assert jobs.get(job["job_id"])["status"] == "completed"
+    assert job["progress"] == 100
+    assert job["solution_ids"] == [42]
+    # the employer who submitted it got the solution id over the websocket
+    user_id, message = mock_manager.send_to_user.call_args.args
+    assert user_id == "7"
+    assert json.loads(message)["solution_ids"] == [42]
+    # the roster was cached and the solve was let go of once it finished
+    mock_cache.put.assert_called_once()
+    assert progress.solves == {} and progress.current == {}
+
+
+@patch("app.services.schedule_jobs.solve_progress", new_callable=local_progress)
+@patch("app.services.schedule_jobs.solver_cache")
+@patch("app.services.schedule_jobs.manager")
+@patch("app.services.schedule_jobs.solver_pool")
+@patch("app.services.schedule_jobs.save_generated_solutions")
+@patch("app.services.schedule_jobs.create_schedule")
+@patch("app.services.schedule_jobs.SessionLocal")
+def test_job_fails_when_no_roster(mock_session, mock_create_schedule, mock_save, mock_pool, mock_manager, mock_cache, progress):
+    mock_cache.get.return_value = None
+    request_data = make_request_data()
+    # nobody has the expertise the third shift needs
+    request_data["user_expertise"] = []
+    mock_create_schedule.return_value = request_data
+    mock_pool.run = run_inline
+    mock_manager.send_to_user = AsyncMock()
+
+    jobs = ScheduleJobManager()
+    job = asyncio.run(submit_and_wait(jobs, 7, 1, 5, "cpsat"))
+
+    assert job["status"] == "failed"
+    # the first reason found before the search
+    assert job["error"] == "Nobody with the required expertise is available for shift 3 on day 1"
+    mock_save.assert_not_called()
+    assert json.loads(mock_manager.send_to_user.call_args.args[1])["status"] == "failed"
@@ -0,0 +1,251 @@
+# Tests for loading the solver data from the database, using an in memory sqlite database
+import datetime
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from fastapi import HTTPException
+from app.dependencies.db_config import Base
+from app.models import User, Shift, Week, UserAvailability, Solution, Assignment
+from app.association import day_shift_team, user_expertise, shift_expertise
+from app.crud.scheduling_crud import create_schedule, regenerate_solution
+
+
+# Created a fresh database with one team: 3 users, a 2 person day shift on Mon/Tue
+# and a night shift on Mon needing expertise 1
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.add(Week(id=1, week_number=1, start_date=datetime.date(2025, 1, 6), end_date=datetime.date(2025, 1, 12)))
+    for user_id in (1, 2, 3):
+        session.add(User(id=user_id, first_name=f"user{user_id}", email=f"u{user_id}@x.com", mobile_number=str(user_id), team_id=1))
+    # a user from another team that should never show up
+    session.add(User(id=4, first_name="other", email="u4@x.com", mobile_number="4", team_id=2))
+    session.add(Shift(id=1, name="Day", time_start=datetime.time(8), time_end=datetime.time(16), no_of_users=2, team_id=1))
+    session.add(Shift(id=2, name="Night", time_start=datetime.time(22), time_end=datetime.time(6), no_of_users=1, team_id=1))
+    session.add(UserAvailability(user_id=2, team_id=1, day_id=1, approved=True))
+    session.add(UserAvailability(user_id=3, team_id=1, day_id=2, approved=False))
+    session.flush()
+    session.execute(day_shift_team.insert(), [
+        {"day_id": 1, "shift_id": 1, "team_id": 1},
+        {"day_id": 2, "shift_id": 1, "team_id": 1},
+        {"day_id": 1, "shift_id": 2, "team_id": 1},
+    ])
+    session.execute(user_expertise.insert(), [{"user_id": 1, "expertise_id": 1}, {"user_id": 4, "expertise_id": 1}])
+    session.execute(shift_expertise.insert(), [{"shift_id": 2, "expertise_id": 1}, {"shift_id": 2, "expertise_id": 2}])
+    session.commit()
+    yield session
+    session.close()
+
+
+# Counts the SQL statements sent while the block runs
+def count_queries(session, func, *args):
+    statements = []
+    listener = lambda *a: statements.append(a[2])
+    event.listen(session.get_bind(), "before_cursor_execute", listener)
+    try:
+        result = func(session, *args)
+    finally:
+        event.remove(session.get_bind(), "before_cursor_execute", listener)
+    return result, len(statements)
+
+
+def test_create_schedule_loads_team_in_three_queries(db):
+    request_data, queries = count_queries(db, create_schedule, 1, 1)
+
+    # the team, the shifts and last weeks roster (there isnt one for week 1)
+    assert queries == 3
+    assert request_data["week_ids"] == [1]
+    assert request_data["fixed_assignments"] == []
+    assert sorted(request_data["users"]) == [1, 2, 3]
+    assert request_data["shifts"] == [
+        {"day_id": 1, "shift_id": 1, "slot": 0},
+        {"day_id": 1, "shift_id": 1, "slot": 1},
+        {"day_id": 1, "shift_id": 2, "slot": 0},
+        {"day_id": 2, "shift_id": 1, "slot": 0},
+        {"day_id": 2, "shift_id": 1, "slot": 1},
+    ]
+    # only approved days off and only this teams expertise
+    assert request_data["user_availability"] == [{"user_id": 2, "day_id": 1}]
+    assert request_data["user_expertise"] == [{"user_id": 1, "expertise_id": 1}]
+    assert sorted((se["shift_id"], se["expertise_id"]) for se in request_data["shift_expertise"]) == [(2, 1), (2, 2)]
+    night = next(d for d in request_data["shift_details"] if d["id"] == 2)
+    assert night == {"id": 2, "start": datetime.time(22), "end": datetime.time(6), "users": 1}
+
+
+def test_create_schedule_missing_week(db):
+    with pytest.raises(HTTPException) as error:
+        create_schedule(db, 1, 99)
+    assert error.value.status_code == 404
+
+
+def test_regenerate_solution_builds_slots(db):
+    db.add(Solution(id=1, team_id=1, week_id=1, status="DRAFT", created_at=datetime.datetime.now()))
+    db.add_all([
+        Assignment(user_id=1, shift_id=2, day_id=1, team_id=1, solution_id=1, locked=True),
+        Assignment(user_id=2, shift_id=1, day_id=2, team_id=1, solution_id=1, locked=False),
+        Assignment(user_id=3, shift_id=1, day_id=2, team_id=1, solution_id=1, locked=False),
+    ])
+    db.commit()
+
+    request_data, queries = count_queries(db, regenerate_solution, 1)
+
+    assert queries == 3
+    assert request_data["team_id"] == 1 and request_data["week_id"] == 1
+    assert request_data["locked_assignments"] == [{"user_id": 1, "shift_id": 2, "day_id": 1, "slot": 1}]
+    assert [(a["shift_id"], a["day_id"], a["slot"]) for a in request_data["original_assignments"]] == [(2, 1, 1), (1, 2, 1), (1, 2, 2)]
+    assert sorted(t["id"] for t in request_data["shift_times"]) == [1, 2]
+
+
+def test_save_generated_solutions_bulk_inserts(db):
+    from app.crud.scheduling_crud import save_generated_solutions
+    rosters = [
+        [{"user_id": 1, "shift_id": 2, "day_id": 1, "slot": 0}, {"user_id": 3, "shift_id": 1, "day_id": 1, "slot": 0}],
+        [{"user_id": 3, "shift_id": 2, "day_id": 1, "slot": 0}],
+    ]
+    solution_ids, queries = count_queries(db, save_generated_solutions, 1, 1, rosters)
+
+    # one insert per solution and then every assignment in a single insert
+    assert queries == 3
+    assert len(solution_ids) == 2
+    saved = db.query(Assignment).order_by(Assignment.id).all()
+    assert [(a.solution_id, a.user_id) for a in saved] == [(solution_ids[0], 1), (solution_ids[0], 3), (solution_ids[1], 3)]
+
+
+def test_save_generated_solutions_rolls_back(db):
+    from app.crud.scheduling_crud import save_generated_solutions
+    # the second assignment is missing its user so the insert fails half way
+    rosters = [[{"user_id": 1, "shift_id": 2, "day_id": 1}, {"shift_id": 1, "day_id": 1}]]
+    with pytest.raises(KeyError):
+        save_generated_solutions(db, 1, 1, rosters)
+
+    # neither the solution nor any assignment was kept
+    assert db.query(Solution).count() == 0
+    assert db.query(Assignment).count() == 0
+
+
+def test_replace_solution_assignments(db):
+    from app.crud.scheduling_crud import save_generated_solutions, replace_solution_assignments
+    [solution_id] = save_generated_solutions(db, 1, 1, [[{"user_id": 1, "shift_id": 2, "day_id": 1}]])
+    replace_solution_assignments(db, solution_id, 1, [
+        {"user_id": 2, "shift_id": 2, "day_id": 1, "locked": False},
+        {"user_id": 3, "shift_id": 1, "day_id": 2, "locked": True},
+    ])
+
+    saved = db.query(Assignment).filter(Assignment.solution_id == solution_id).order_by(Assignment.id).all()
+    assert [(a.user_id, a.locked) for a in saved] == [(2, False), (3, True)]
+
+
+def test_load_previous_roster_uses_latest_active(db):
+    from app.crud.scheduling_crud import load_previous_roster
+    db.add_all([
+        Solution(id=1, team_id=1, week_id=1, status="ACTIVE", created_at=datetime.datetime(2025, 1, 1)),
+        Solution(id=2, team_id=1, week_id=1, status="ACTIVE", created_at=datetime.datetime(2025, 1, 8)),
+        # newer but only a draft, and another teams active roster
+        Solution(id=3, team_id=1, week_id=1, status="DRAFT", created_at=datetime.datetime(2025, 1, 9)),
+        Solution(id=4, team_id=2, week_id=1, status="ACTIVE", created_at=datetime.datetime(2025, 1, 10)),
+    ])
+    db.add_all([
+        Assignment(user_id=1, shift_id=1, day_id=1, team_id=1, solution_id=1, locked=False),
+        Assignment(user_id=2, shift_id=1, day_id=1, team_id=1, solution_id=2, locked=False),
+        Assignment(user_id=3, shift_id=1, day_id=1, team_id=1, solution_id=2, locked=False),
+        Assignment(user_id=1, shift_id=2, day_id=1, team_id=1, solution_id=2, locked=False),
+        Assignment(user_id=3, shift_id=2, day_id=1, team_id=1, solution_id=3, locked=False),
+    ])
+    db.commit()
+
+    hint, queries = count_queries(db, load_previous_roster, 1)
+
+    assert queries == 1
+    assert hint == [
+        {"user_id": 2, "shift_id": 1, "day_id": 1, "slot": 0},
+        {"user_id": 3, "shift_id": 1, "day_id": 1, "slot": 1},
+        {"user_id": 1, "shift_id": 2, "day_id": 1, "slot": 0},
+    ]
+    # a team without an active roster gets no hint
+    assert load_previous_roster(db, 5) == []
+
+
+def test_create_schedule_over_several_weeks(db):
+    db.add_all([
+        Week(id=2, week_number=2, start_date=datetime.date(2025, 1, 13), end_date=datetime.date(2025, 1, 19)),
+        Week(id=3, week_number=3, start_date=datetime.date(2025, 1, 20), end_date=datetime.date(2025, 1, 26)),
+        # week 1 has an active roster, so it is the fixed context before week 2
+        Solution(id=1, team_id=1, week_id=1, status="ACTIVE", created_at=datetime.datetime(2025, 1, 1)),
+    ])
+    db.add_all([
+        Assignment(user_id=1, shift_id=2, day_id=7, team_id=1, solution_id=1, locked=False),
+        Assignment(user_id=3, shift_id=1, day_id=7, team_id=1, solution_id=1, locked=False),
+    ])
+    db.commit()
+
+    request_data, queries = count_queries(db, create_schedule, 1, 2, 3)
+
+    assert queries == 3
+    assert request_data["week_ids"] == [2, 3]
+    # the second week carries on from day 8 and the days off repeat every week
+    assert sorted({s["day_id"] for s in request_data["shifts"]}) == [1, 2, 8, 9]
+    assert len(request_data["shifts"]) == 10
+    assert request_data["user_availability"] == [{"user_id": 2, "day_id": 1}, {"user_id": 2, "day_id": 8}]
+    # last sunday is day 0 just before the first monday
+    assert request_data["fixed_assignments"] == [
+        {"user_id": 1, "shift_id": 2, "day_id": 0, "slot": 0},
+        {"user_id": 3, "shift_id": 1, "day_id": 0, "slot": 0},
+    ]
+
+    # a range with a missing week or going backwards is refused
+    with pytest.raises(HTTPException) as error:
+        create_schedule(db, 1, 2, 4)
+    assert error.value.status_code == 404
+    with pytest.raises(HTTPException) as error:
+        create_schedule(db, 1, 3, 2)
+    assert error.value.status_code == 400
+
+
+def test_save_horizon_solutions_splits_weeks(db):
+    from app.crud.scheduling_crud import save_horizon_solutions
+    db.add(Week(id=2, week_number=2, start_date=datetime.date(2025, 1, 13), end_date=datetime.date(2025, 1, 19)))
+    db.commit()
+    roster = [{"user_id": 1, "shift_id": 1, "day_id": 7, "slot": 0}, {"user_id": 2, "shift_id": 1, "day_id": 8, "slot": 0}]
+
+    [solution_ids] = save_horizon_solutions(db, 1, [1, 2], [roster])
+
+    # one solution per week, with the day of the week back to 1 to 7
+    saved = db.query(Solution.week_id, Assignment.user_id, Assignment.day_id).join(Assignment).order_by(Assignment.id).all()
+    assert saved == [(1, 1, 7), (2, 2, 1)]
+    assert len(solution_ids) == 2
+
+
+def test_create_schedules_loads_many_teams_in_four_queries(db):
+    from app.crud.scheduling_crud import create_schedules
+    # a second team with its own shift, and last weeks active roster for team 1
+    db.add_all([
+        Week(id=2, week_number=2, start_date=datetime.date(2025, 1, 13), end_date=datetime.date(2025, 1, 19)),
+        Shift(id=3, name="Late", time_start=datetime.time(12), time_end=datetime.time(20), no_of_users=1, team_id=2),
+        Solution(id=1, team_id=1, week_id=1, status="ACTIVE", created_at=datetime.datetime(2025, 1, 1)),
+        # team 2 only has a draft so it has no fixed context
+        Solution(id=2, team_id=2, week_id=1, status="DRAFT", created_at=datetime.datetime(2025, 1, 1)),
+    ])
+    db.add_all([
+        Assignment(user_id=1, shift_id=2, day_id=7, team_id=1, solution_id=1, locked=False),
+        Assignment(user_id=4, shift_id=3, day_id=7, team_id=2, solution_id=2, locked=False),
+    ])
+    db.flush()
+    db.execute(day_shift_team.insert(), [{"day_id": 3, "shift_id": 3, "team_id": 2}])
+    db.commit()
+
+    schedules, queries = count_queries(db, create_schedules, [(1, 2), (2, 2), (2, 99)])
+
+    # the people, the shifts, the active solutions of the week before and their assignments
+    assert queries == 4
+    # the week that doesnt exist is left out
+    assert sorted(schedules) == [(1, 2), (2, 2)]
+    # every team gets the same data create_schedule would load for it on its own
+    single = create_schedule(db, 1, 2)
+    assert schedules[1, 2] == single
+    assert schedules[1, 2]["fixed_assignments"] == [{"user_id": 1, "shift_id": 2, "day_id": 0, "slot": 0}]
+    assert schedules[2, 2]["users"] == [4]
+    assert schedules[2, 2]["shifts"] == [{"day_id": 3, "shift_id": 3, "slot": 0}]
+    assert schedules[2, 2]["fixed_assignments"] == []
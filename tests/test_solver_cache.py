@@ -0,0 +1,61 @@
+# Tests for the solver result cache
+from unittest.mock import patch
+from app.services.solver_cache import SolverCache, fingerprint
+from test_solvers import make_request_data
+
+
+def test_fingerprint_ignores_row_order_but_not_changes():
+    request_data = make_request_data()
+    key = fingerprint(request_data, "csp", {"count": 1})
+
+    # the same data in a different order is the same solve
+    shuffled = make_request_data()
+    shuffled["users"].reverse()
+    shuffled["shifts"].reverse()
+    shuffled["user_expertise"].reverse()
+    assert fingerprint(shuffled, "csp", {"count": 1}) == key
+
+    # any real change gives a new key so an old roster is never reused
+    changed = make_request_data()
+    changed["user_availability"].append({"user_id": 3, "day_id": 5})
+    assert fingerprint(changed, "csp", {"count": 1}) != key
+    assert fingerprint(request_data, "cpsat", {"count": 1}) != key
+    assert fingerprint(request_data, "csp", {"count": 2}) != key
+
+
+def test_cache_hits_misses_and_lru():
+    cache = SolverCache(size=2, ttl=60)
+    assert cache.get("a") is None
+    cache.put("a", {"assignments": [[1]]})
+    cache.put("b", {"assignments": [[2]]})
+    assert cache.get("a") == {"assignments": [[1]]}
+    # b is now the least recently used so it goes when c comes in
+    cache.put("c", {"assignments": [[3]]})
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 2, 2)
+
+
+def test_cache_expires_and_skips_timed_out_results():
+    cache = SolverCache(size=10, ttl=60)
+    with patch("app.services.solver_cache.time.time", return_value=1000):
+        cache.put("a", {"assignments": [[1]]})
+        cache.put("partial", {"assignments": [[1]], "timed_out": True})
+    with patch("app.services.solver_cache.time.time", return_value=1030):
+        assert cache.get("a") is not None
+        assert cache.get("partial") is None
+    with patch("app.services.solver_cache.time.time", return_value=1061):
+        assert cache.get("a") is None
+
+
+def test_cache_on_disk_survives_a_new_instance(tmp_path):
+    cache = SolverCache(size=10, ttl=60, directory=str(tmp_path))
+    cache.put("a", {"assignments": [[{"user_id": 1}]], "total_solutions": 1})
+
+    # a fresh cache (like after a restart or in another worker) reads it back from disk
+    other = SolverCache(size=10, ttl=60, directory=str(tmp_path))
+    assert other.get("a") == {"assignments": [[{"user_id": 1}]], "total_solutions": 1}
+    other.clear()
+    assert SolverCache(size=10, ttl=60, directory=str(tmp_path)).get("a") is None
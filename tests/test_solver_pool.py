@@ -0,0 +1,71 @@
+# Tests for running the solvers in the worker process pool
+import asyncio
+import multiprocessing
+import time
+import pytest
+from fastapi import HTTPException
+from app.services.solver_pool import SolverPool
+from app.CSPs.engines import run_assignment_solver, with_deadline
+# Reusing the small team from the solver tests
+from test_solvers import make_request_data, assert_valid_roster
+
+
+def test_pool_solves_in_worker_process():
+    pool = SolverPool(workers=1, max_pending=2, timeout=60)
+    request_data = make_request_data()
+    try:
+        result = asyncio.run(pool.run(run_assignment_solver, request_data, "cpsat"))
+    finally:
+        pool.shutdown()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+    # the pending count goes back down once the solve is done
+    assert pool.pending == 0
+
+
+def test_pool_rejects_when_queue_full():
+    pool = SolverPool(workers=1, max_pending=1, timeout=60)
+    # pretending a solve is already running
+    pool.pending = 1
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(pool.run(run_assignment_solver, make_request_data(), "cpsat"))
+
+    assert error.value.status_code == 503
+    assert pool.pending == 1
+
+
+# Stands in for a solve that only stops when it is told to
+def wait_for_cancel(cancel, deadline=None):
+    return cancel.wait(30)
+
+
+def test_pool_stops_the_solve_on_timeout():
+    pool = SolverPool(workers=1, max_pending=2, timeout=1)
+    shared = multiprocessing.get_context("spawn").Manager()
+    cancel = shared.Event()
+    try:
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(pool.run(wait_for_cancel, cancel, cancel=cancel))
+        assert error.value.status_code == 504
+        assert cancel.is_set()
+
+        # the only worker is free again, so the next solve doesnt wait for the first one
+        pool.timeout = 20
+        start = time.perf_counter()
+        request_data = make_request_data()
+        result = asyncio.run(pool.run(run_assignment_solver, request_data, "cpsat"))
+        assert time.perf_counter() - start < 20
+    finally:
+        pool.shutdown()
+        shared.shutdown()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+
+
+def test_deadline_caps_the_solver_time():
+    # a solve asking for more time then is left only gets what is left
+    options = with_deadline({"time_limit_ms": 60000}, time.time() + 2)
+    assert 0 < options["max_time_ms"] <= 2000
+    assert options["time_limit_ms"] == 60000
+    assert with_deadline(None, None) is None
@@ -0,0 +1,496 @@
+# Tests for the shift assignment solvers, these dont need the database as the solvers only take plain data
+import pytest
+from datetime import time
+from collections import defaultdict
+from app.CSPs.solver_csp import ShiftAssignmentSolver
+from app.CSPs.cpsat_solver import CPSATShiftSolver
+from app.CSPs.regen_csp import RegenerateCSP
+
+# Engines that share the same inputs and output shape
+ENGINES = [ShiftAssignmentSolver, CPSATShiftSolver]
+
+
+# Created a small team with a day shift, a night shift and one shift needing expertise
+def make_request_data():
+    users = [1, 2, 3, 4, 5, 6, 7, 8]
+    shift_details = [
+        {"id": 1, "start": time(8, 0), "end": time(16, 0), "users": 2},
+        {"id": 2, "start": time(22, 0), "end": time(6, 0), "users": 1},
+        {"id": 3, "start": "09:00", "end": "17:00", "users": 1},
+    ]
+    shifts = []
+    for day in range(1, 8):
+        for detail in shift_details:
+            for slot in range(detail["users"]):
+                shifts.append({"day_id": day, "shift_id": detail["id"], "slot": slot})
+    return {
+        "users": users,
+        "shifts": shifts,
+        "shift_details": shift_details,
+        "user_availability": [{"user_id": 1, "day_id": 1}, {"user_id": 2, "day_id": 3}],
+        "user_expertise": [{"user_id": 5, "expertise_id": 1}, {"user_id": 6, "expertise_id": 1}],
+        "shift_expertise": [{"shift_id": 3, "expertise_id": 1}],
+    }
+
+
+# Checks every hard rule the route relies on against a returned roster
+def assert_valid_roster(request_data, roster, max_days=5):
+    assert len(roster) == len(request_data["shifts"])
+    unavailable = {(ua["user_id"], ua["day_id"]) for ua in request_data["user_availability"]}
+    experts = {ue["user_id"] for ue in request_data["user_expertise"]}
+    user_days = defaultdict(list)
+    for a in roster:
+        assert (a["user_id"], a["day_id"]) not in unavailable
+        if a["shift_id"] == 3:
+            assert a["user_id"] in experts
+        user_days[a["user_id"]].append((a["day_id"], a["shift_id"]))
+    for user, days in user_days.items():
+        day_ids = [d for d, _ in days]
+        # one shift a day and no more then the max days
+        assert len(day_ids) == len(set(day_ids))
+        assert len(day_ids) <= max_days
+        # no day shift the morning after a night shift
+        for day, shift_id in days:
+            if shift_id == 2:
+                assert (day + 1, 1) not in days
+                assert (day + 1, 3) not in days
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_solver_returns_valid_roster(engine):
+    request_data = make_request_data()
+    result = engine(**request_data).solve()
+
+    assert result["total_solutions"] == 1
+    assert_valid_roster(request_data, result["assignments"][0])
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_no_solution_when_nobody_qualified(engine):
+    request_data = make_request_data()
+    # removing every user with the expertise the third shift needs
+    request_data["user_expertise"] = []
+    result = engine(**request_data).solve()
+
+    assert result["assignments"] == [] and result["total_solutions"] == 0
+    # one reason per day the third shift runs, found before any search
+    assert [(p["type"], p["shift_id"], p["day_id"]) for p in result["diagnosis"]] == [("no_qualified_user", 3, day) for day in range(1, 8)]
+    assert result["failure_reasons"][0] == "Nobody with the required expertise is available for shift 3 on day 1"
+
+
+# Checking the day counter gives the same solutions as checking the whole roster at the end
+def test_max_days_constraint_matches_full_check():
+    from constraint import Problem
+    from itertools import product
+    from app.CSPs.constraints import MaxDaysConstraint
+    keys = [(1, day, 0) for day in range(1, 5)] + [(2, 2, 0)]
+    problem = Problem()
+    for key in keys:
+        problem.addVariable(key, [1, 2, 3])
+    problem.addConstraint(MaxDaysConstraint(2, {key: key[1] for key in keys}), keys)
+    found = {tuple(sol[key] for key in keys) for sol in problem.getSolutionIter()}
+
+    expected = set()
+    for users in product([1, 2, 3], repeat=len(keys)):
+        user_days = defaultdict(set)
+        for key, user in zip(keys, users):
+            user_days[user].add(key[1])
+        if all(len(days) <= 2 for days in user_days.values()):
+            expected.add(users)
+    assert found == expected
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_solver_respects_tight_max_days(engine):
+    request_data = make_request_data()
+    # 28 slots shared between 6 users working at most 5 days each
+    request_data["users"] = [1, 2, 3, 4, 5, 6]
+    result = engine(**request_data).solve()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+
+
+# Checking the rest gap table only flags shift pairs with less then 11 hours between them
+def test_rest_conflict_table():
+    from app.CSPs.shift_times import build_shift_minutes, build_rest_conflict_table, rest_conflict_groups
+    minutes = build_shift_minutes(make_request_data()["shift_details"])
+    table = build_rest_conflict_table(minutes)
+
+    # night shift finishing at 6 then a shift at 8 or 9 the next morning
+    assert table.get((2, 1)) and table.get((2, 3))
+    # day shift then the night shift the next evening is fine, as is the same day shift again
+    assert not table.get((1, 2)) and not table.get((1, 1))
+
+    groups = rest_conflict_groups([(2, 1, 0), (1, 2, 0), (1, 2, 1), (1, 3, 0)], table)
+    assert groups == [[(2, 1, 0), (1, 2, 0), (1, 2, 1)]]
+
+
+# A day needing more qualified users then the team has should fail before any search
+def test_csp_detects_impossible_day():
+    request_data = make_request_data()
+    # shift 3 now needs three people a day but only users 5 and 6 have the expertise
+    request_data["shift_details"][2]["users"] = 3
+    request_data["shifts"] += [{"day_id": 4, "shift_id": 3, "slot": 1}, {"day_id": 4, "shift_id": 3, "slot": 2}]
+    solver = ShiftAssignmentSolver(**request_data)
+
+    # the day is caught before the search is even built
+    assert solver.problem._variables == {}
+    result = solver.solve()
+    assert result["assignments"] == []
+    assert [(p["type"], p["day_id"], p["slots"], p["assignable"]) for p in result["diagnosis"]] == [("day_understaffed", 4, 6, 5)]
+
+    # on a possible week the per day constraints are one per day rather then one per pair of slots
+    solver = ShiftAssignmentSolver(**make_request_data())
+    daily = [c for c, _ in solver.problem._constraints if type(c).__name__ == "DayAllDifferentConstraint"]
+    assert len(daily) == 7
+
+
+# The day check sees values the last search left hidden and never empties a domain, so the
+# same problem can be searched again (more rosters, or another repair round)
+def test_day_check_survives_repeat_searches():
+    from constraint import Domain, Problem
+    from app.CSPs.constraints import DayAllDifferentConstraint
+    from app.CSPs.search import TimedBacktrackingSolver
+    day = DayAllDifferentConstraint()
+    first, second = Domain([1]), Domain([1, 2])
+    # user 2 was hidden on the second slot by the last search
+    second.pushState()
+    second.hideValue(2)
+    day.preProcess(["a", "b"], {"a": first, "b": second}, [], {})
+    assert not day.infeasible
+
+    problem = Problem(TimedBacktrackingSolver())
+    problem.addVariables(["a", "b"], [1])
+    problem.addConstraint(DayAllDifferentConstraint(), ["a", "b"])
+    assert problem.getSolution() is None
+    assert problem.getSolution() is None
+    assert problem._variables == {"a": [1], "b": [1]}
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_diagnosis_finds_capacity_problems(engine):
+    import time
+    # 28 slots but 6 users working at most 4 days each
+    request_data = make_request_data()
+    request_data["users"] = [1, 2, 3, 4, 5, 6]
+    start = time.perf_counter()
+    result = engine(**request_data, max_days_per_user=4).solve()
+    assert time.perf_counter() - start < 1
+    assert [p["type"] for p in result["diagnosis"]] == ["week_capacity"]
+    assert result["diagnosis"][0]["capacity"] == 24
+
+    # the night shift now needs the same expertise as shift 3, so users 5 and 6 would have to
+    # cover 14 slots in at most 5 days each
+    request_data = make_request_data()
+    request_data["shift_expertise"].append({"shift_id": 2, "expertise_id": 1})
+    result = engine(**request_data).solve()
+    [problem] = result["diagnosis"]
+    assert problem["type"] == "qualified_capacity"
+    assert (problem["shift_ids"], problem["users"], problem["slots"], problem["capacity"]) == ([2, 3], [5, 6], 14, 10)
+
+
+# Four weeks of slots cant be searched in a millisecond, with a time limit the solver stops
+# and hands back the best partial roster
+def test_csp_time_limit_returns_partial_roster():
+    import time
+    request_data = make_request_data()
+    request_data["shifts"] = [dict(s, day_id=s["day_id"] + week * 7) for week in range(4) for s in request_data["shifts"]]
+    solver = ShiftAssignmentSolver(**request_data, max_days_per_user=28, time_limit_ms=1)
+    # checking the clock on every node so the limit is hit straight away
+    solver.search.check_every = 1
+
+    start = time.perf_counter()
+    result = solver.solve()
+    assert time.perf_counter() - start < 5
+
+    assert result["timed_out"] and result["total_solutions"] == 0
+    filled = result["assignments"][0]
+    assert filled and len(filled) + result["skipped_count"] == len(request_data["shifts"])
+    assert result["failure_reasons"]
+    assert all(s["reason"] for s in result["skipped_assignments"])
+
+
+# Without a time limit of its own the search still stops at the time left in the solver pool
+def test_csp_stops_at_max_time():
+    request_data = make_request_data()
+    request_data["shifts"] = [dict(s, day_id=s["day_id"] + week * 7) for week in range(4) for s in request_data["shifts"]]
+    solver = ShiftAssignmentSolver(**request_data, max_days_per_user=28, max_time_ms=1)
+    solver.search.check_every = 1
+    assert solver.time_limit_ms == 1
+    assert solver.solve()["timed_out"]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_solver_returns_diverse_rosters(engine):
+    request_data = make_request_data()
+    solver = engine(**request_data, count=3, min_difference=4)
+    result = solver.solve()
+
+    assert result["total_solutions"] == 3
+    rosters = []
+    for roster in result["assignments"]:
+        assert_valid_roster(request_data, roster)
+        rosters.append({(a["shift_id"], a["day_id"], a["slot"]): a["user_id"] for a in roster})
+    # every pair of rosters differs in at least min_difference slots
+    for i in range(len(rosters)):
+        for j in range(i + 1, len(rosters)):
+            changed = sum(1 for key in rosters[i] if rosters[i][key] != rosters[j][key])
+            assert changed >= 4
+
+
+# The time limit covers every roster asked for, so asking for more rosters doesnt take longer
+def test_diverse_rosters_share_the_time_limit():
+    import time
+    request_data = make_request_data()
+    solver = ShiftAssignmentSolver(**request_data, count=10, min_difference=1, time_limit_ms=500)
+    find = solver.problem.getSolution
+
+    def slow_search():
+        time.sleep(0.3)
+        return find()
+    solver.problem.getSolution = slow_search
+    result = solver.solve()
+
+    # the second search used up what was left, so no third one was started
+    assert result["total_solutions"] == 2
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_fairness_objective_spreads_hours(engine):
+    request_data = make_request_data()
+    result = engine(**request_data, objective="fairness").solve()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+    totals = result["user_totals"][0]
+    # every user is reported and the hours add up to the whole roster (28 eight hour slots)
+    assert sorted(t["user_id"] for t in totals) == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert sum(t["hours"] for t in totals) == 28 * 8
+    hours = [t["hours"] for t in totals]
+    # without the objective one user can end up with 0 shifts and another with 5
+    assert max(hours) - min(hours) <= 24
+    assert result["objective_values"][0] >= max(hours) - min(hours)
+
+
+def test_cpsat_fairness_is_optimal_on_small_team():
+    request_data = make_request_data()
+    result = CPSATShiftSolver(**request_data, objective="fairness", weights={"nights": 0, "weekends": 0}).solve()
+    hours = [t["hours"] for t in result["user_totals"][0]]
+    # 28 shifts over 8 users can only be split 3 or 4 each
+    assert max(hours) - min(hours) == 8
+    assert result["objective_values"] == [8.0]
+
+
+# Optimizing from the start can use the whole budget on a big team without finding any roster,
+# a 50 user team has to come back with a roster in time
+def test_cpsat_fairness_finds_a_roster_for_a_big_team():
+    import time
+    from benchmarks.generators import generate_team
+    from benchmarks.solver_benchmark import SCENARIOS
+    request_data = generate_team(seed=0, **SCENARIOS["large"])
+    start = time.perf_counter()
+    result = CPSATShiftSolver(**request_data, objective="fairness", time_limit_ms=2000).solve()
+
+    assert time.perf_counter() - start < 4
+    # every slot is filled, once
+    slots = {(s["shift_id"], s["day_id"], s["slot"]) for s in request_data["shifts"]}
+    roster = result["assignments"][0]
+    assert {(a["shift_id"], a["day_id"], a["slot"]) for a in roster} == slots and len(roster) == len(slots)
+    assert len(result["objective_values"]) == 1
+
+
+# Turns a roster into the regenerate_solution data, slots are 1 based there
+def make_regeneration_data(request_data, roster, locked_keys=()):
+    original = [{"user_id": a["user_id"], "shift_id": a["shift_id"], "day_id": a["day_id"], "slot": a["slot"] + 1} for a in roster]
+    return {
+        "users": list(request_data["users"]),
+        "shifts": [{"shift_id": a["shift_id"], "day_id": a["day_id"], "slot": a["slot"], "locked": (a["shift_id"], a["day_id"], a["slot"]) in locked_keys} for a in original],
+        "user_availability": list(request_data["user_availability"]),
+        "user_expertise": request_data["user_expertise"],
+        "shift_expertise": request_data["shift_expertise"],
+        "shift_details": request_data["shift_details"],
+        "original_assignments": original,
+        "locked_assignments": [a for a in original if (a["shift_id"], a["day_id"], a["slot"]) in locked_keys],
+    }
+
+
+def test_repair_changes_only_what_broke():
+    request_data = make_request_data()
+    roster = CPSATShiftSolver(**request_data).solve()["assignments"][0]
+    # locking the first two slots of day 2
+    locked_keys = {(1, 2, 1), (1, 2, 2)}
+    regen_data = make_regeneration_data(request_data, roster, locked_keys)
+    # one unlocked user on day 4 gets the day off approved after the roster was made
+    broken = next(a for a in regen_data["original_assignments"] if a["day_id"] == 4 and a["shift_id"] == 1)
+    regen_data["user_availability"].append({"user_id": broken["user_id"], "day_id": 4})
+
+    result = RegenerateCSP(**regen_data, mode="repair").solve()
+
+    by_key = {(a["shift_id"], a["day_id"], a["slot"]): a for a in result["assignments"]}
+    # the locked slots kept their users
+    for a in regen_data["locked_assignments"]:
+        assert by_key[a["shift_id"], a["day_id"], a["slot"]]["user_id"] == a["user_id"]
+        assert by_key[a["shift_id"], a["day_id"], a["slot"]]["locked"]
+    # the user with the day off was moved and only a couple of slots changed to make room
+    assert by_key[broken["shift_id"], 4, broken["slot"]]["user_id"] != broken["user_id"]
+    assert 1 <= result["changed_count"] <= 3
+    changed = sum(1 for a in regen_data["original_assignments"] if by_key[a["shift_id"], a["day_id"], a["slot"]]["user_id"] != a["user_id"])
+    assert changed == result["changed_count"]
+    repaired = [dict(a, slot=a["slot"] - 1) for a in result["assignments"]]
+    assert_valid_roster(dict(request_data, user_availability=regen_data["user_availability"]), repaired)
+
+
+# Both experts get day 1 off after the roster was made, so nobody can work shift 3 that day
+@pytest.mark.parametrize("mode", ["different", "repair"])
+def test_regenerate_reports_a_slot_nobody_can_work(mode):
+    request_data = make_request_data()
+    roster = CPSATShiftSolver(**request_data).solve()["assignments"][0]
+    regen_data = make_regeneration_data(request_data, roster)
+    regen_data["user_availability"] += [{"user_id": 5, "day_id": 1}, {"user_id": 6, "day_id": 1}]
+
+    result = RegenerateCSP(**regen_data, mode=mode).solve()
+
+    assert result["assignments"] == [] and result["changed_count"] == 0
+    assert result["failure_reasons"] == ["Nobody with the required expertise is available for shift 3 on day 1"]
+
+
+def test_repair_hits_target_changes():
+    request_data = make_request_data()
+    roster = CPSATShiftSolver(**request_data).solve()["assignments"][0]
+    regen_data = make_regeneration_data(request_data, roster)
+
+    # nothing broke so a plain repair keeps the roster, a target forces that many changes
+    assert RegenerateCSP(**regen_data, mode="repair").solve()["changed_count"] == 0
+    result = RegenerateCSP(**regen_data, mode="repair", target_changes=4).solve()
+    assert result["changed_count"] >= 4
+
+
+def test_regenerate_different_roster_counts_changes():
+    request_data = make_request_data()
+    roster = CPSATShiftSolver(**request_data).solve()["assignments"][0]
+    regen_data = make_regeneration_data(request_data, roster, {(2, 3, 1)})
+
+    result = RegenerateCSP(**regen_data).solve()
+
+    by_key = {(a["shift_id"], a["day_id"], a["slot"]): a for a in result["assignments"]}
+    assert by_key[2, 3, 1]["locked"]
+    assert by_key[2, 3, 1]["user_id"] == regen_data["locked_assignments"][0]["user_id"]
+    changed = sum(1 for a in regen_data["original_assignments"] if by_key[a["shift_id"], a["day_id"], a["slot"]]["user_id"] != a["user_id"])
+    assert result["changed_count"] == changed > 0
+
+
+# A different roster that isnt found in time says so, the same as a repair
+def test_regenerate_different_reports_the_time_limit():
+    request_data = make_request_data()
+    request_data["shifts"] = [dict(s, day_id=s["day_id"] + week * 7) for week in range(4) for s in request_data["shifts"]]
+    roster = CPSATShiftSolver(**request_data, max_days_per_user=28).solve()["assignments"][0]
+    regen = RegenerateCSP(**make_regeneration_data(request_data, roster), max_days_per_user=28, time_limit_ms=1)
+    regen.search.check_every = 1
+
+    result = regen.solve()
+
+    assert result["assignments"] == []
+    assert result["failure_reasons"] == ["Time limit of 1 ms reached before a new roster was found"]
+
+
+# Two teams sharing a week but not a single user: users 1-8 as before and users 11-18 who
+# only work shift 4, which needs expertise 2
+def make_split_request_data():
+    request_data = make_request_data()
+    request_data["users"] += [11, 12, 13, 14, 15, 16, 17, 18]
+    request_data["shift_details"].append({"id": 4, "start": time(8, 0), "end": time(16, 0), "users": 2})
+    request_data["shifts"] += [{"day_id": day, "shift_id": 4, "slot": slot} for day in range(1, 8) for slot in range(2)]
+    request_data["shift_expertise"] += [{"shift_id": s, "expertise_id": 3} for s in (1, 2)] + [{"shift_id": 4, "expertise_id": 2}]
+    request_data["user_expertise"] += [{"user_id": u, "expertise_id": 3} for u in range(1, 9)]
+    request_data["user_expertise"] += [{"user_id": u, "expertise_id": 2} for u in range(11, 19)]
+    return request_data
+
+
+def test_connected_components_split_disjoint_pools():
+    from app.CSPs.decompose import connected_components
+    solver = ShiftAssignmentSolver(**make_split_request_data())
+    components = connected_components(solver.shift_keys, solver.problem._variables)
+
+    assert len(components) == 2
+    users = sorted(sorted(users) for _, users in components)
+    assert users == [[1, 2, 3, 4, 5, 6, 7, 8], [11, 12, 13, 14, 15, 16, 17, 18]]
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_csp_solves_components_separately(parallel):
+    request_data = make_split_request_data()
+    result = ShiftAssignmentSolver(**request_data, parallel=parallel).solve()
+
+    roster = result["assignments"][0]
+    assert len(roster) == len(request_data["shifts"])
+    # the shift 4 slots all went to the second pool and every other slot to the first
+    for a in roster:
+        assert (a["user_id"] > 10) == (a["shift_id"] == 4)
+    assert_valid_roster(dict(request_data, shifts=[s for s in request_data["shifts"] if s["shift_id"] != 4]), [a for a in roster if a["shift_id"] != 4])
+    assert len(result["user_totals"][0]) == 16
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_warm_start_keeps_previous_roster(engine):
+    request_data = make_request_data()
+    previous = CPSATShiftSolver(**make_request_data()).solve()["assignments"][0]
+    solver = engine(**request_data, hint=previous)
+    roster = solver.solve()["assignments"][0]
+
+    assert_valid_roster(request_data, roster)
+    # nothing changed since so the previous roster is still valid and comes straight back
+    key = lambda a: (a["shift_id"], a["day_id"], a["slot"], a["user_id"])
+    assert sorted(map(key, roster)) == sorted(map(key, previous))
+    if engine is ShiftAssignmentSolver:
+        # one node per slot, no backtracking at all
+        assert solver.search.nodes == len(request_data["shifts"])
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_local_search_improves_without_breaking_rules(engine):
+    request_data = make_request_data()
+    result = engine(**request_data, improve_ms=200).solve()
+
+    assert_valid_roster(request_data, result["assignments"][0])
+    improvement = result["improvement"]
+    assert improvement["moves"] > 0
+    # a move is only kept when it doesnt make the roster worse
+    assert improvement["objective_after"] <= improvement["objective_before"]
+    assert result["objective_values"] == [improvement["objective_after"]]
+    # plenty of time on a small team to get the hours within one shift of each other
+    hours = [t["hours"] for t in result["user_totals"][0]]
+    assert max(hours) - min(hours) <= 8
+
+
+# The small team over two weeks, the second week numbered on from day 8
+def make_two_week_data():
+    request_data = make_request_data()
+    request_data["shifts"] += [dict(s, day_id=s["day_id"] + 7) for s in request_data["shifts"]]
+    request_data["user_availability"] += [dict(ua, day_id=ua["day_id"] + 7) for ua in request_data["user_availability"]]
+    return request_data
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_two_week_roster_respects_fixed_context(engine):
+    request_data = make_two_week_data()
+    # last week user 1 worked the sunday night and user 3 the last five days
+    request_data["fixed_assignments"] = [{"user_id": 1, "shift_id": 2, "day_id": 0, "slot": 0}] + [
+        {"user_id": 3, "shift_id": 1, "day_id": day, "slot": 0} for day in range(-4, 1)
+    ]
+    roster = engine(**request_data).solve()["assignments"][0]
+
+    # the fixed context is never returned, only the 56 slots of the two weeks
+    assert len(roster) == 56 and min(a["day_id"] for a in roster) == 1
+    worked = defaultdict(dict)
+    for a in roster + request_data["fixed_assignments"]:
+        assert a["day_id"] not in worked[a["user_id"]]
+        worked[a["user_id"]][a["day_id"]] = a["shift_id"]
+    # no morning shift after the sunday night, even though it was last week
+    assert worked[1].get(1) not in (1, 3)
+    # no more then 5 days in any 7 days in a row, so user 3 has to rest on the first two days
+    assert 1 not in worked[3] and 2 not in worked[3]
+    for user, days in worked.items():
+        for start in range(-6, 9):
+            assert sum(1 for day in days if start <= day < start + 7) <= 5
+        for day, shift_id in days.items():
+            if shift_id == 2:
+                assert days.get(day + 1) not in (1, 3)